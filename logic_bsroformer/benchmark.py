@@ -0,0 +1,208 @@
+# coding: utf-8
+
+import io
+import os
+import sys
+import glob
+import copy
+import time
+import torch
+import numpy as np
+from typing import Dict, Iterable, List, Tuple
+
+# Using the embedded version of Python can also correctly import the utils module.
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+from utils.settings import get_model_from_config, parse_args_benchmark
+from utils.model_utils import demix, prefer_target_instrument, load_start_checkpoint, quantize_model_int8
+from utils.model_utils import cast_model_precision, get_inference_precision
+from utils.metrics import sdr
+from utils.audio_utils import prefetch_audio
+
+import warnings
+
+warnings.filterwarnings("ignore")
+
+
+def get_model_size_mb(model: torch.nn.Module) -> float:
+    """
+    Return the size of the serialized state dict in MB. For quantized models this counts
+    the packed int8 weights, which is what actually stays resident during inference.
+    """
+
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / (1024 ** 2)
+
+
+def separate_timed(config, model: torch.nn.Module, mix: np.ndarray, device, model_type: str) -> Tuple[Dict[str, np.ndarray], float]:
+    """
+    Run `demix` on one mixture and measure the wall time.
+    """
+
+    if isinstance(device, str) and device.startswith('cuda'):
+        torch.cuda.synchronize()
+    start_time = time.time()
+    waveforms = demix(config, model, mix, device, model_type=model_type)
+    if isinstance(device, str) and device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return waveforms, time.time() - start_time
+
+
+def get_candidates(args, config, model: torch.nn.Module, device) -> List[Dict]:
+    """
+    Build the list of inference variants compared against the float32 reference.
+
+    Every candidate is a dict with `name`, `model`, `config` and `device` keys.
+    """
+
+    candidates = []
+    if args.quantize_int8:
+        if device != 'cpu':
+            print('INT8 quantization works only on CPU, use --force_cpu. Skip INT8 candidate.')
+        else:
+            candidates.append(dict(
+                name='int8',
+                model=quantize_model_int8(copy.deepcopy(model)),
+                config=config,
+                device=device,
+            ))
+    for depth in args.preview_depth:
+        candidate_config = copy.deepcopy(config)
+        candidate_config.inference['preview_depth'] = depth
+        candidate_config.inference['preview_stride'] = args.preview_stride
+        candidates.append(dict(
+            name=f'depth{depth}' if args.preview_stride == 1 else f'depth{depth}/stride{args.preview_stride}',
+            model=model,
+            config=candidate_config,
+            device=device,
+        ))
+    if args.student_config_path:
+        student, student_config = get_model_from_config(args.model_type, args.student_config_path)
+        if args.student_check_point:
+            student.load_state_dict(torch.load(args.student_check_point, map_location='cpu', weights_only=True))
+        student_config.inference['precision'] = 'fp32'
+        candidates.append(dict(
+            name='student',
+            model=student.eval().to(device),
+            config=student_config,
+            device=device,
+        ))
+    for precision in args.precision:
+        candidate_config = copy.deepcopy(config)
+        candidate_config.inference['precision'] = precision
+        # fp32 on devices without half precision support
+        candidate_config.inference['precision'] = get_inference_precision(candidate_config, device)
+        candidates.append(dict(
+            name=precision,
+            model=cast_model_precision(copy.deepcopy(model), candidate_config.inference['precision']).to(device),
+            config=candidate_config,
+            device=device,
+        ))
+    return candidates
+
+
+def load_mixtures(input_folder: str, sample_rate: int, max_seconds: float) -> Iterable[Tuple[str, np.ndarray]]:
+    """
+    Yield (name, stereo mixture) for every readable track of the folder, cut to `max_seconds`.
+    """
+
+    mixture_paths = sorted(glob.glob(os.path.join(input_folder, '*.*')))
+    print(f"Total files found: {len(mixture_paths)}")
+
+    duration = max_seconds if max_seconds > 0 else None
+    for path, mix, error in prefetch_audio(mixture_paths, sample_rate, duration=duration):
+        if error is not None:
+            print(f'Cannot read track: {path}')
+            print(f'Error message: {str(error)}')
+            continue
+
+        if len(mix.shape) == 1:
+            mix = np.stack([mix, mix], axis=0)
+
+        yield os.path.basename(path), mix
+
+
+def compare_models(args, config, model: torch.nn.Module, candidates: List[Dict], device,
+                   mixtures: Iterable[Tuple[str, np.ndarray]] = None, reference_name: str = 'fp32') -> None:
+    """
+    Separate every track with the reference model and all candidates. SDR of the candidate
+    is measured against the reference output, so it shows only the quality cost of the
+    optimization, not the quality of the model itself.
+
+    By default the tracks of `args.input_folder` are used, `mixtures` can give other (name, mix) pairs.
+    """
+
+    sample_rate = getattr(config.audio, 'sample_rate', 44100)
+    instruments = prefer_target_instrument(config)
+
+    if mixtures is None:
+        mixtures = load_mixtures(args.input_folder, sample_rate, args.max_seconds)
+
+    ref_time = 0.
+    total_time = {c['name']: 0. for c in candidates}
+    sdr_values = {c['name']: {instr: [] for instr in instruments} for c in candidates}
+
+    for name, mix in mixtures:
+        reference, elapsed = separate_timed(config, model, mix, device, args.model_type)
+        ref_time += elapsed
+        print(f"{name}: {reference_name} {elapsed:.2f} sec")
+
+        for candidate in candidates:
+            estimates, elapsed = separate_timed(
+                candidate['config'], candidate['model'], mix, candidate['device'], args.model_type
+            )
+            total_time[candidate['name']] += elapsed
+            line = []
+            for instr in instruments:
+                value = sdr(reference[instr][None, ...], estimates[instr][None, ...])[0]
+                sdr_values[candidate['name']][instr].append(value)
+                line.append(f"{instr}: {value:.2f}")
+            print(f"  {candidate['name']} {elapsed:.2f} sec, SDR vs {reference_name}: {', '.join(line)}")
+
+    print(f"Reference {reference_name}: {ref_time:.2f} sec, model size {get_model_size_mb(model):.1f} MB")
+    for candidate in candidates:
+        name = candidate['name']
+        values = [np.mean(v) for v in sdr_values[name].values() if len(v) > 0]
+        speedup = ref_time / total_time[name] if total_time[name] > 0 else 0.
+        print(
+            f"{name}: {total_time[name]:.2f} sec (x{speedup:.2f}), "
+            f"model size {get_model_size_mb(candidate['model']):.1f} MB, "
+            f"mean SDR vs {reference_name}: {np.mean(values) if values else float('nan'):.2f} dB"
+        )
+        for instr, v in sdr_values[name].items():
+            if len(v) > 0:
+                print(f"    {instr}: {np.mean(v):.2f} dB")
+
+
+def benchmark(dict_args):
+    args = parse_args_benchmark(dict_args)
+    device = "cpu"
+    if args.force_cpu:
+        device = "cpu"
+    elif torch.cuda.is_available():
+        device = f'cuda:{args.device_ids[0]}' if isinstance(args.device_ids, list) else f'cuda:{args.device_ids}'
+
+    print("Using device: ", device)
+
+    model, config = get_model_from_config(args.model_type, args.config_path)
+    if args.start_check_point != '':
+        load_start_checkpoint(args, model, type_='inference')
+    model.eval()
+
+    # reference output is always computed in float32
+    config.inference['precision'] = 'fp32'
+
+    candidates = get_candidates(args, config, model, device)
+    model = model.to(device)
+
+    if len(candidates) == 0:
+        print('No inference mode to compare, choose at least one of the benchmark options.')
+        return
+
+    compare_models(args, config, model, candidates, device)
+
+
+if __name__ == "__main__":
+    benchmark(None)
@@ -0,0 +1,198 @@
+# coding: utf-8
+
+import os
+import sys
+import copy
+import time
+import torch
+import torch.nn as nn
+import numpy as np
+from tqdm.auto import tqdm
+from torch.utils.data import DataLoader
+from typing import Iterable, Tuple
+
+# Using the embedded version of Python can also correctly import the utils module.
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+from utils.settings import get_model_from_config, parse_args_distill, initialize_environment
+from utils.model_utils import get_optimizer, save_weights, load_not_compatible_weights, load_start_checkpoint
+from utils.audio_utils import prepare_data
+from utils.dataset import SyntheticMixDataset
+from utils.losses import choice_loss
+from benchmark import compare_models, load_mixtures
+
+import warnings
+
+warnings.filterwarnings("ignore")
+
+
+def synthetic_mixtures(config, num_tracks: int, max_seconds: float) -> Iterable[Tuple[str, np.ndarray]]:
+    """
+    Yield (name, mix) synthetic mixtures for the report when no validation folder is given.
+    """
+
+    dataset = SyntheticMixDataset(config, batch_size=1, num_steps=num_tracks)
+    sample_rate = getattr(config.audio, 'sample_rate', 44100)
+    dataset.chunk_size = int(max(max_seconds, 1) * sample_rate)
+    for i in range(num_tracks):
+        _, mix = dataset[i]
+        yield f'synthetic_{i}', mix.numpy()
+
+
+def get_train_loader(args, config, batch_size: int) -> DataLoader:
+    """
+    Loader of real tracks (MSSDataset) if `--data_path` is given, of synthetic mixtures otherwise.
+    """
+
+    if args.data_path:
+        return prepare_data(config, args, batch_size)
+
+    print('No --data_path, distill on synthetic mixtures')
+    return DataLoader(
+        SyntheticMixDataset(config, batch_size=batch_size),
+        batch_size=batch_size,
+        num_workers=args.num_workers,
+        pin_memory=args.pin_memory
+    )
+
+
+def train_one_epoch(args, config, student: nn.Module, teacher: nn.Module, train_loader: DataLoader,
+                    optimizer: torch.optim.Optimizer, loss_func, scaler: torch.amp.GradScaler, device,
+                    use_amp: bool) -> float:
+    """
+    Train the student for one epoch on the outputs of the frozen teacher for the same mixtures.
+    With `--ground_truth_coef` > 0 the loss against the dataset stems is added.
+
+    Returns:
+        Mean loss of the epoch.
+    """
+
+    student.train()
+    gradient_accumulation_steps = int(getattr(config.training, 'gradient_accumulation_steps', 1))
+    device_type = torch.device(device).type
+    instruments = config.training.instruments
+    target_index = None
+    if config.training.target_instrument is not None:
+        target_index = instruments.index(config.training.target_instrument)
+
+    loss_val = 0.
+    total = 0
+    pbar = tqdm(train_loader)
+    for i, (batch, mixes) in enumerate(pbar):
+        x = mixes.to(device)
+
+        with torch.autocast(device_type=device_type, enabled=use_amp):
+            with torch.no_grad():
+                y_teacher = teacher(x).float()
+            if target_index is not None:
+                y_teacher = y_teacher[:, target_index:target_index + 1]
+
+            y = student(x)
+            loss = loss_func(y, y_teacher, x)
+            if args.ground_truth_coef > 0:
+                loss = loss + args.ground_truth_coef * loss_func(y, batch.to(device), x)
+            loss = loss / gradient_accumulation_steps
+
+        scaler.scale(loss).backward()
+        if config.training.grad_clip:
+            scaler.unscale_(optimizer)
+            nn.utils.clip_grad_norm_(student.parameters(), config.training.grad_clip)
+
+        if ((i + 1) % gradient_accumulation_steps == 0) or (i == len(train_loader) - 1):
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+
+        li = loss.item() * gradient_accumulation_steps
+        loss_val += li
+        total += 1
+        pbar.set_postfix({'loss': 100 * li, 'avg_loss': 100 * loss_val / total})
+
+    return loss_val / max(total, 1)
+
+
+def distill(dict_args):
+    args = parse_args_distill(dict_args)
+    initialize_environment(args.seed, args.results_path)
+
+    device = "cpu"
+    if args.force_cpu:
+        device = "cpu"
+    elif torch.cuda.is_available():
+        device = f'cuda:{args.device_ids[0]}'
+
+    print("Using device: ", device)
+
+    teacher, teacher_config = get_model_from_config(args.model_type, args.teacher_config_path)
+    student, config = get_model_from_config(args.model_type, args.config_path)
+
+    if list(teacher_config.training.instruments) != list(config.training.instruments):
+        raise ValueError(
+            f'Teacher and student must separate the same instruments: '
+            f'{teacher_config.training.instruments} != {config.training.instruments}'
+        )
+
+    if args.teacher_check_point != '':
+        # same checkpoint formats as inference.py
+        teacher_args = copy.copy(args)
+        teacher_args.start_check_point = args.teacher_check_point
+        teacher_args.lora_checkpoint = ''
+        load_start_checkpoint(teacher_args, teacher, type_='valid')
+    else:
+        print('No teacher checkpoint, the teacher has random weights (use only for testing)')
+    if args.start_check_point != '':
+        print(f'Start student from checkpoint: {args.start_check_point}')
+        load_not_compatible_weights(student, args.start_check_point, verbose=False)
+
+    teacher = teacher.to(device).eval()
+    for p in teacher.parameters():
+        p.requires_grad = False
+    student = student.to(device)
+
+    if args.num_epochs > 0:
+        config.training.num_epochs = args.num_epochs
+    if args.num_steps > 0:
+        config.training.num_steps = args.num_steps
+
+    batch_size = config.training.batch_size
+    train_loader = get_train_loader(args, config, batch_size)
+    optimizer = get_optimizer(config, student)
+    loss_func = choice_loss(args, config)
+
+    use_amp = getattr(config.training, 'use_amp', True) and device.startswith('cuda')
+    scaler = torch.amp.GradScaler('cuda', enabled=use_amp)
+
+    print(
+        f"Teacher params: {sum(p.numel() for p in teacher.parameters()) / 1e6:.2f}M, "
+        f"student params: {sum(p.numel() for p in student.parameters()) / 1e6:.2f}M"
+    )
+
+    store_path = f'{args.results_path}/{args.model_type}_student.ckpt'
+    for epoch in range(config.training.num_epochs):
+        start_time = time.time()
+        loss = train_one_epoch(
+            args, config, student, teacher, train_loader, optimizer, loss_func, scaler, device, use_amp
+        )
+        print(f'Epoch {epoch}: loss {loss:.6f}, {time.time() - start_time:.1f} sec')
+        save_weights(store_path, student, [device], False)
+
+    print(f'Student checkpoint: {store_path}')
+
+    # speed/SDR report of the student against the teacher
+    student.eval()
+    teacher_config.inference['precision'] = 'fp32'
+    config.inference['precision'] = 'fp32'
+
+    sample_rate = getattr(config.audio, 'sample_rate', 44100)
+    if args.valid_path:
+        mixtures = load_mixtures(args.valid_path, sample_rate, args.max_seconds)
+    else:
+        mixtures = synthetic_mixtures(config, 2, args.max_seconds)
+
+    candidates = [dict(name='student', model=student, config=config, device=device)]
+    compare_models(args, teacher_config, teacher, candidates, device, mixtures=mixtures, reference_name='teacher')
+
+
+if __name__ == "__main__":
+    distill(None)
@@ -0,0 +1,42 @@
+# coding: utf-8
+
+import os
+import sys
+import time
+
+# Using the embedded version of Python can also correctly import the utils module.
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+from utils.settings import get_model_from_config, parse_args_export_onnx
+from utils.model_utils import load_start_checkpoint
+from utils.onnx_utils import export_onnx, get_onnx_path
+
+import warnings
+
+warnings.filterwarnings("ignore")
+
+
+def export(dict_args):
+    args = parse_args_export_onnx(dict_args)
+
+    if args.model_type != 'bs_roformer':
+        print(f'ONNX export supports only bs_roformer, got: {args.model_type}')
+        return
+
+    start_time = time.time()
+    model, config = get_model_from_config(args.model_type, args.config_path)
+    if args.start_check_point != '':
+        load_start_checkpoint(args, model, type_='inference')
+
+    output_path = args.output_path
+    if output_path == '':
+        output_path = get_onnx_path(args.start_check_point) if args.start_check_point else 'bs_roformer.onnx'
+
+    export_onnx(model, config, output_path, opset_version=args.opset_version)
+    print(f"ONNX model saved to: {output_path}")
+    print(f"Elapsed time: {time.time() - start_time:.2f} seconds.")
+
+
+if __name__ == "__main__":
+    export(None)
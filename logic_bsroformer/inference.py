@@ -2,33 +2,157 @@
 __author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
 
 import time
-import librosa
 import sys
 import os
 import glob
+import hashlib
+import threading
 import torch
-import soundfile as sf
 import numpy as np
 from tqdm.auto import tqdm
 import torch.nn as nn
+from typing import Dict, List, Optional, Tuple, Union
+from ml_collections import ConfigDict
 
 # Using the embedded version of Python can also correctly import the utils module.
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(current_dir)
 
-from utils.audio_utils import normalize_audio, denormalize_audio, draw_spectrogram
-from utils.settings import get_model_from_config, parse_args_inference
+from utils.audio_utils import normalize_audio, denormalize_audio, prefetch_audio, StemWriter, SpectrogramWriter
+from utils.audio_utils import AudioSource, iter_audio_sources
+from utils.manifest import Manifest
+from utils.settings import get_model_from_config, parse_args_inference, load_config
 from utils.model_utils import demix
-from utils.model_utils import prefer_target_instrument, apply_tta, load_start_checkpoint
+from utils.model_utils import prefer_target_instrument, apply_tta, load_start_checkpoint, load_int8_checkpoint
+from utils.model_utils import get_inference_precision, load_half_checkpoint, cast_model_precision
+from utils.model_utils import load_checkpoint_mmap, get_memory_budget, allocate_accumulator
+from utils.model_utils import setup_attention_backend, get_attention_cache_path, fuse_model_attention
 
 import warnings
 
 warnings.filterwarnings("ignore")
 
 
+def separate_mix(model, args, config, device, mix: Union[np.ndarray, AudioSource],
+                 pbar: bool = False, checkpoint_key: Optional[str] = None) -> Dict[str, np.ndarray]:
+    """
+    Separate one mixture with the options of `args` (normalization, TTA, instrumental).
+
+    Parameters:
+    ----------
+    model : torch.nn.Module
+        Pre-trained model for source separation.
+    args : Namespace
+        Arguments with processing options.
+    config : Dict
+        Configuration object with audio and inference settings.
+    device : torch.device
+        Device for model inference (CPU or CUDA).
+    mix : Union[np.ndarray, AudioSource]
+        Mixture with shape (channels, time) or (time,) at the sample rate of the model. An `AudioSource`
+        is read chunk by chunk (loaded whole only for normalization or TTA).
+    pbar : bool, optional
+        If True, displays a progress bar during chunk processing. Default is False.
+    checkpoint_key : str, optional
+        Key of the resumable separation of this track with `config.inference.resume_dir` (see `get_resume_key`).
+
+    Returns:
+    -------
+    Dict[str, np.ndarray]
+        Separated stems with shape (channels, time), with 'instrumental' if `args.extract_instrumental` is set.
+    """
+
+    instruments = prefer_target_instrument(config)
+    normalize = 'normalize' in config.inference and config.inference['normalize'] is True
+
+    if isinstance(mix, AudioSource) and (normalize or args.use_tta):
+        # they work on the whole track
+        mix = mix.read_all()
+
+    # If mono audio we must adjust it depending on model
+    if len(mix.shape) == 1:
+        mix = np.expand_dims(mix, axis=0)
+        if 'num_channels' in config.audio:
+            if config.audio['num_channels'] == 2:
+                print(f'Convert mono track to stereo...')
+                mix = np.concatenate([mix, mix], axis=0)
+
+    # not modified in place by normalization, demix or TTA, so no copy is needed
+    mix_orig = mix
+    if normalize:
+        mix, norm_params = normalize_audio(mix)
+
+    waveforms_orig = demix(config, model, mix, device, model_type=args.model_type, pbar=pbar,
+                           checkpoint_key=checkpoint_key)
+
+    if args.use_tta:
+        waveforms_orig = apply_tta(config, model, mix, waveforms_orig, device, args.model_type)
+
+    if args.extract_instrumental:
+        instr = 'vocals' if 'vocals' in instruments else instruments[0]
+        if isinstance(mix_orig, AudioSource):
+            # the mixture is read again block by block, into a memory-mapped buffer with --memmap_accumulators
+            instrumental = allocate_accumulator(mix_orig.shape, config).numpy()
+            for start in range(0, mix_orig.length, 2 ** 20):
+                end = min(start + 2 ** 20, mix_orig.length)
+                np.subtract(mix_orig.read(start, end), waveforms_orig[instr][:, start:end], out=instrumental[:, start:end])
+            waveforms_orig['instrumental'] = instrumental
+        elif get_memory_budget(config) > 0 and mix_orig.flags.writeable and mix_orig.dtype == np.float32:
+            # low memory mode: the mixture is not used anymore, it becomes the instrumental
+            waveforms_orig['instrumental'] = np.subtract(mix_orig, waveforms_orig[instr], out=mix_orig)
+        else:
+            waveforms_orig['instrumental'] = mix_orig - waveforms_orig[instr]
+
+    if normalize:
+        for instr in waveforms_orig:
+            waveforms_orig[instr] = denormalize_audio(waveforms_orig[instr], norm_params, inplace=True)
+
+    return waveforms_orig
+
+
+def get_resume_key(args, config, path: str) -> str:
+    """
+    Name of the resumable separation of the file `path`: a hash of the file (path, size and mtime), of the
+    model files and of the configuration, so a checkpoint is only resumed by the same separation.
+    """
+
+    settings = config.to_dict()
+    settings['inference'] = {
+        k: v for k, v in settings['inference'].items() if k not in ['resume_dir', 'checkpoint_interval', 'resume_min_seconds']
+    }
+    files = [path, args.start_check_point, args.lora_checkpoint, args.onnx_model]
+    files = [(os.path.abspath(f), os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in files if f and os.path.isfile(f)]
+    options = [args.model_type, args.quantize_int8, args.attention_backend]
+
+    h = hashlib.sha1(repr((files, options, sorted(settings.items(), key=lambda kv: kv[0]))).encode())
+    return f'{os.path.splitext(os.path.basename(path))[0]}_{h.hexdigest()[:16]}'
+
+
+def get_input_paths(args) -> List[str]:
+    """
+    Input files of `--input_files` and of the list file `--input_list` ('-' reads the list from stdin, one path
+    per line), in this order, or all files of `--input_folder` if no list is given.
+    """
+
+    paths = list(args.input_files or [])
+    if args.input_list:
+        if args.input_list == '-':
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(args.input_list, encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        paths += [line.strip() for line in lines if line.strip()]
+
+    if not paths and args.input_folder:
+        paths = sorted(glob.glob(os.path.join(args.input_folder, '*.*')))
+    return paths
+
+
 def run_folder(model, args, config, device, verbose: bool = False):
     """
-    Process a folder of audio files for source separation.
+    Process a folder or a list of audio files (see `get_input_paths`) for source separation.
+    With `args.manifest` only the files which are not recorded as processed in the manifest are processed,
+    and with `args.watch` the folder is polled for new files until interrupted.
 
     Parameters:
     ----------
@@ -47,80 +171,155 @@ def run_folder(model, args, config, device, verbose: bool = False):
     start_time = time.time()
     model.eval()
 
-    mixture_paths = sorted(glob.glob(os.path.join(args.input_folder, '*.*')))
     sample_rate = getattr(config.audio, 'sample_rate', 44100)
 
-    print(f"Total files found: {len(mixture_paths)}. Using sample rate: {sample_rate}")
+    if args.resume_dir:
+        config.inference['resume_dir'] = args.resume_dir
+        config.inference['checkpoint_interval'] = args.checkpoint_interval
+        config.inference['resume_min_seconds'] = args.resume_min_seconds
+    # the separation of the long enough tracks is checkpointed and resumed after a crash
+    resumable = bool(getattr(config.inference, 'resume_dir', ''))
+    resume_min_length = float(getattr(config.inference, 'resume_min_seconds', 0)) * sample_rate
+
+    file_list = bool(args.input_files or args.input_list)
+    manifest = None
+    if args.manifest:
+        # incremental processing: only the new, changed or failed files recorded in the manifest
+        manifest = Manifest(args.manifest, args.max_attempts)
+        if file_list:
+            batches = [manifest.pending(paths=manifest.add(get_input_paths(args)))]
+        elif args.watch > 0:
+            print(f"Watching {args.input_folder} every {args.watch} seconds, Ctrl+C to stop")
+            batches = manifest.watch(args.input_folder, args.watch)
+        else:
+            manifest.scan(args.input_folder, force=True)
+            batches = [manifest.pending()]
+    else:
+        batches = [get_input_paths(args)]
 
     instruments = prefer_target_instrument(config)[:]
+    if args.extract_instrumental and 'instrumental' not in instruments:
+        instruments.append('instrumental')
     os.makedirs(args.store_dir, exist_ok=True)
 
-    if not verbose:
-        mixture_paths = tqdm(mixture_paths, desc="Total progress")
+    codec = 'flac' if getattr(args, 'flac_file', False) else 'wav'
+    subtype = args.pcm_type if args.flac_file else 'FLOAT'
 
     if args.disable_detailed_pbar:
         detailed_pbar = False
     else:
         detailed_pbar = True
 
-    for path in mixture_paths:
-        print(f"Processing track: {path}")
-        try:
-            mix, sr = librosa.load(path, sr=sample_rate, mono=False)
-        except Exception as e:
-            print(f'Cannot read track: {format(path)}')
-            print(f'Error message: {str(e)}')
-            continue
-
-        # If mono audio we must adjust it depending on model
-        if len(mix.shape) == 1:
-            mix = np.expand_dims(mix, axis=0)
-            if 'num_channels' in config.audio:
-                if config.audio['num_channels'] == 2:
-                    print(f'Convert mono track to stereo...')
-                    mix = np.concatenate([mix, mix], axis=0)
-
-        mix_orig = mix.copy()
-        if 'normalize' in config.inference:
-            if config.inference['normalize'] is True:
-                mix, norm_params = normalize_audio(mix)
-
-        waveforms_orig = demix(config, model, mix, device, model_type=args.model_type, pbar=detailed_pbar)
-
-        if args.use_tta:
-            waveforms_orig = apply_tta(config, model, mix, waveforms_orig, device, args.model_type)
-
-        if args.extract_instrumental:
-            instr = 'vocals' if 'vocals' in instruments else instruments[0]
-            waveforms_orig['instrumental'] = mix_orig - waveforms_orig[instr]
-            if 'instrumental' not in instruments:
-                instruments.append('instrumental')
-
-        file_name = os.path.splitext(os.path.basename(path))[0]
-
-        output_dir = os.path.join(args.store_dir, file_name)
-        os.makedirs(output_dir, exist_ok=True)
-
-        for instr in instruments:
-            estimates = waveforms_orig[instr]
-            if 'normalize' in config.inference:
-                if config.inference['normalize'] is True:
-                    estimates = denormalize_audio(estimates, norm_params)
-
-            codec = 'flac' if getattr(args, 'flac_file', False) else 'wav'
-            subtype = 'PCM_16' if args.flac_file and args.pcm_type == 'PCM_16' else 'FLOAT'
-
-            output_path = os.path.join(output_dir, f"{instr}.{codec}")
-            sf.write(output_path, estimates.T, sr, subtype=subtype)
-            if args.draw_spectro > 0:
-                output_img_path = os.path.join(output_dir, f"{instr}.jpg")
-                draw_spectrogram(estimates.T, sr, args.draw_spectro, output_img_path)
+    # stems of a track are encoded and written while the next track is separated,
+    # at most one track of stems is waiting for the writer
+    writer = StemWriter(args.writer_threads, max_pending=len(instruments))
+    # spectrograms of --draw_spectro are drawn in worker processes
+    spectrogram_writer = SpectrogramWriter(args.spectro_workers)
+
+    # tracks with a stem which can not be written and tracks with all stems written, appended by the writer
+    # threads and recorded in the manifest by this thread
+    write_errors = []
+    written = []
+    written_lock = threading.Lock()
+
+    def record_writes():
+        while manifest is not None and write_errors:
+            path, error = write_errors.pop()
+            manifest.fail(path, error)
+        while manifest is not None and written:
+            manifest.finish(written.pop())
+
+    sr = sample_rate
+    with writer, spectrogram_writer:
+        for mixture_paths in batches:
+            print(f"Total files found: {len(mixture_paths)}. Using sample rate: {sample_rate}")
+
+            if args.stream_input:
+                # tracks are read chunk by chunk during the separation
+                mixtures = iter_audio_sources(mixture_paths, sample_rate, getattr(config.audio, 'num_channels', None))
+            else:
+                # the next tracks are decoded in background threads while the current one is separated
+                mixtures = prefetch_audio(mixture_paths, sample_rate, args.decode_threads)
+            if not verbose:
+                mixtures = tqdm(mixtures, total=len(mixture_paths), desc="Total progress")
+
+            for path, mix, error in mixtures:
+                if manifest is not None and not manifest.start(path):
+                    print(f"Skip track changed or removed since the scan: {path}")
+                    continue
+
+                print(f"Processing track: {path}")
+                if error is not None:
+                    print(f'Cannot read track: {format(path)}')
+                    print(f'Error message: {str(error)}')
+                    if manifest is not None:
+                        manifest.fail(path, error)
+                    continue
+
+                try:
+                    resume = resumable and mix.shape[-1] >= resume_min_length
+                    checkpoint_key = get_resume_key(args, config, path) if resume else None
+                    waveforms_orig = separate_mix(
+                        model, args, config, device, mix, pbar=detailed_pbar, checkpoint_key=checkpoint_key
+                    )
+                except Exception as e:
+                    if manifest is None:
+                        raise
+                    print(f'Cannot separate track: {path}\nError message: {str(e)}')
+                    manifest.fail(path, e)
+                    continue
+
+                file_name = os.path.splitext(os.path.basename(path))[0]
+
+                output_dir = os.path.join(args.store_dir, file_name)
+                os.makedirs(output_dir, exist_ok=True)
+
+                def on_error(e: Exception, path: str = path):
+                    write_errors.append((path, e))
+
+                # the track is done once all its stems are written
+                remaining = [1 if args.stems_npy else len(instruments)]
+
+                def on_done(path: str = path, remaining: list = remaining):
+                    with written_lock:
+                        remaining[0] -= 1
+                        if remaining[0] == 0:
+                            written.append(path)
+
+                if args.stems_npy:
+                    writer.submit_npy(
+                        output_dir, {instr: waveforms_orig[instr] for instr in instruments}, sr, on_error, on_done
+                    )
+                else:
+                    for instr in instruments:
+                        output_path = os.path.join(output_dir, f"{instr}.{codec}")
+                        writer.submit(output_path, waveforms_orig[instr], sr, subtype, on_error, on_done)
+
+                if args.draw_spectro > 0:
+                    spectrogram_writer.submit(
+                        {instr: waveforms_orig[instr] for instr in instruments}, sr, args.draw_spectro,
+                        {instr: os.path.join(output_dir, f"{instr}.jpg") for instr in instruments}
+                    )
+
+                record_writes()
+
+            if manifest is not None:
+                # record the last tracks before waiting for new files
+                writer.flush()
+                record_writes()
+
+    record_writes()
+    if manifest is not None:
+        manifest.close()
 
     print(f"Elapsed time: {time.time() - start_time:.2f} seconds.")
 
 
-def proc_folder(dict_args):
-    args = parse_args_inference(dict_args)
+def get_device(args) -> str:
+    """
+    Choose the inference device from the command-line arguments: CUDA if available, then MPS, then CPU.
+    """
+
     device = "cpu"
     if args.force_cpu:
         device = "cpu"
@@ -129,16 +328,99 @@ def proc_folder(dict_args):
         device = f'cuda:{args.device_ids[0]}' if isinstance(args.device_ids, list) else f'cuda:{args.device_ids}'
     elif torch.backends.mps.is_available():
         device = "mps"
+    return device
+
+
+def load_model(args, device) -> Tuple[nn.Module, ConfigDict, str]:
+    """
+    Build the model and load the checkpoint with the inference options of `args`
+    (ONNX Runtime, INT8, precision, fast loading, preview depth, fused attention, attention backend).
+
+    Returns:
+    -------
+    Tuple[nn.Module, ConfigDict, str]
+        The model ready for `demix`, its configuration and the device it runs on.
+    """
+
+    if args.onnx_model and (args.preview_depth > 0 or args.preview_stride > 1):
+        print('Preview depth is not supported with ONNX Runtime, running all transformer blocks.')
+
+    if args.onnx_model:
+        from utils.onnx_utils import OnnxRoformer
+        print("Using device: cpu (ONNX Runtime)")
+        config = load_config(args.model_type, args.config_path)
+        config.inference['precision'] = 'fp32'
+        if args.tf_chunking:
+            config.inference['tf_chunking'] = True
+        model = OnnxRoformer(args.onnx_model, config, num_threads=args.onnx_threads)
+        return model, config, 'cpu'
 
     print("Using device: ", device)
 
-    model_load_start_time = time.time()
     torch.backends.cudnn.benchmark = True
 
-    model, config = get_model_from_config(args.model_type, args.config_path)
+    if args.quantize_int8 and device != 'cpu':
+        print('INT8 quantization works only on CPU, use --force_cpu. Running in float32.')
+        args.quantize_int8 = False
+
+    if args.quantize_int8 and args.precision not in [None, 'fp32']:
+        print('INT8 quantization runs in fp32, --precision is ignored.')
+        args.precision = 'fp32'
 
-    if args.start_check_point != '':
+    fast_load = args.fast_load and args.start_check_point != ''
+    if fast_load and (args.quantize_int8 or args.precision in ['bf16', 'fp16'] or args.lora_checkpoint):
+        print('--fast_load is used only for float32 checkpoints without LoRA, loading normally.')
+        fast_load = False
+
+    if fast_load:
+        # no memory and no random init for the weights, they are replaced by the checkpoint tensors
+        with torch.device('meta'):
+            model, config = get_model_from_config(args.model_type, args.config_path)
+    else:
+        model, config = get_model_from_config(args.model_type, args.config_path)
+
+    if args.precision is not None:
+        config.inference['precision'] = args.precision
+    precision = get_inference_precision(config, device)
+    print(f"Inference precision: {precision}")
+    # half precision weights only where it is supported, see get_inference_precision
+    half_weights = args.precision is not None and precision in ['bf16', 'fp16']
+    if args.precision is not None:
+        config.inference['precision'] = precision
+
+    if args.quantize_int8 and args.start_check_point != '':
+        model = load_int8_checkpoint(args, model, config)
+    elif half_weights and args.start_check_point != '':
+        model = load_half_checkpoint(args, model, precision, config)
+    elif fast_load:
+        model = load_checkpoint_mmap(args, model, device)
+    elif args.start_check_point != '':
         load_start_checkpoint(args, model, type_='inference')
+    elif half_weights:
+        model = cast_model_precision(model, precision)
+
+    if args.preview_depth > 0 or args.preview_stride > 1:
+        config.inference['preview_depth'] = args.preview_depth
+        config.inference['preview_stride'] = args.preview_stride
+        print(f"Preview quality: depth {args.preview_depth or 'all'}, stride {args.preview_stride}")
+
+    if args.tf_chunking:
+        config.inference['tf_chunking'] = True
+        print("Chunking in time-frequency domain")
+
+    if args.memory_budget > 0:
+        config.inference['memory_budget'] = args.memory_budget
+        print(f"Memory budget: {args.memory_budget} GB")
+    if args.memmap_accumulators:
+        config.inference['memmap_accumulators'] = True
+        print("Overlap-add accumulators are memory-mapped")
+    if args.scratch_dir:
+        config.inference['scratch_dir'] = args.scratch_dir
+
+    if args.fused_attention:
+        config.inference['fused_attention'] = True
+    if getattr(config.inference, 'fused_attention', False):
+        fuse_model_attention(model)
 
     print("Instruments: {}".format(config.training.instruments))
 
@@ -148,6 +430,21 @@ def proc_folder(dict_args):
 
     model = model.to(device)
 
+    setup_attention_backend(
+        model, config, device, args.attention_backend, cache_path=get_attention_cache_path(args.start_check_point)
+    )
+
+    return model, config, device
+
+
+def proc_folder(dict_args):
+    args = parse_args_inference(dict_args)
+    device = get_device(args)
+
+    model_load_start_time = time.time()
+
+    model, config, device = load_model(args, device)
+
     print("Model load time: {:.2f} sec".format(time.time() - model_load_start_time))
 
     run_folder(model, args, config, device, verbose=True)
@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import platform
+from functools import partial
+from collections import namedtuple
+
+import torch
+from torch import einsum
+import torch.nn.functional as F
+
+try:
+    from sageattention import sageattn
+    _has_sage_attention = True
+except ImportError:
+    _has_sage_attention = False
+
+# constants
+
+AttentionBackend = namedtuple('AttentionBackend', ['fn', 'is_available'])
+
+ATTENTION_BACKENDS = dict()
+
+# only this many elements of the (b h i j) similarity matrix are used for benchmarking,
+# attention cost is linear in the number of sequences so the ranking does not change
+
+BENCHMARK_MAX_ELEMENTS = 2 ** 26
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+def default(v, d):
+    return v if exists(v) else d
+
+def register_backend(name, is_available = lambda device: True):
+    def inner(fn):
+        ATTENTION_BACKENDS[name] = AttentionBackend(fn, is_available)
+        return fn
+    return inner
+
+def get_backend(name):
+    assert name in ATTENTION_BACKENDS, f'unknown attention backend {name}, must be one of {list(ATTENTION_BACKENDS)}'
+    return ATTENTION_BACKENDS[name].fn
+
+def available_backends(device):
+    device = torch.device(device)
+    return [name for name, backend in ATTENTION_BACKENDS.items() if backend.is_available(device)]
+
+# backends
+# all of them take q, k, v of shape (b h n d) and an optional softmax scale, no dropout (inference only)
+
+@register_backend('sdpa')
+def sdpa_attention(q, k, v, scale = None):
+    # pytorch chooses the kernel itself
+    return F.scaled_dot_product_attention(q, k, v, scale = scale)
+
+@register_backend('sdpa_flash', lambda device: device.type in ('cuda', 'cpu'))
+def sdpa_flash_attention(q, k, v, scale = None):
+    if q.is_cuda:
+        return torch.ops.aten._scaled_dot_product_flash_attention(q, k, v, scale = scale)[0]
+    return torch.ops.aten._scaled_dot_product_flash_attention_for_cpu(q, k, v, scale = scale)[0]
+
+@register_backend('sdpa_efficient', lambda device: device.type == 'cuda')
+def sdpa_efficient_attention(q, k, v, scale = None):
+    return torch.ops.aten._scaled_dot_product_efficient_attention(q, k, v, None, False, scale = scale)[0]
+
+@register_backend('sdpa_math')
+def sdpa_math_attention(q, k, v, scale = None):
+    return torch.ops.aten._scaled_dot_product_attention_math(q, k, v, scale = scale)[0]
+
+@register_backend('sage', lambda device: _has_sage_attention and device.type == 'cuda')
+def sage_attention(q, k, v, scale = None):
+    return sageattn(q, k, v, tensor_layout = 'HND', is_causal = False, sm_scale = scale)
+
+@register_backend('einsum')
+def einsum_attention(q, k, v, scale = None):
+    scale = default(scale, q.shape[-1] ** -0.5)
+    sim = einsum('b h i d, b h j d -> b h i j', q, k) * scale
+    attn = sim.softmax(dim = -1)
+    return einsum('b h i j, b h j d -> b h i d', attn, v)
+
+@register_backend('chunked')
+def chunked_attention(q, k, v, scale = None, chunk_size = 256):
+    """
+    memory efficient attention with online softmax (Rabe & Staats, flash attention style) in plain pytorch
+    queries and keys are processed in blocks of chunk_size, only a (b h chunk_size chunk_size) similarity
+    is alive at a time, so memory grows linearly with the sequence length on any device
+    """
+
+    scale = default(scale, q.shape[-1] ** -0.5)
+    q_len, k_len = q.shape[-2], k.shape[-2]
+
+    if q_len <= chunk_size and k_len <= chunk_size:
+        return sdpa_attention(q, k, v, scale = scale)
+
+    out = torch.empty_like(q)
+
+    for q_start in range(0, q_len, chunk_size):
+        q_chunk = q[..., q_start:q_start + chunk_size, :] * scale
+
+        acc = None
+        row_max = None
+        row_sum = None
+
+        for k_start in range(0, k_len, chunk_size):
+            k_chunk = k[..., k_start:k_start + chunk_size, :]
+            v_chunk = v[..., k_start:k_start + chunk_size, :]
+
+            sim = einsum('b h i d, b h j d -> b h i j', q_chunk, k_chunk).float()
+            block_max = sim.amax(dim = -1, keepdim = True)
+
+            if row_max is None:
+                new_max = block_max
+            else:
+                new_max = torch.maximum(row_max, block_max)
+
+            exp_sim = (sim - new_max).exp_()
+            block_sum = exp_sim.sum(dim = -1, keepdim = True)
+            block_out = einsum('b h i j, b h j d -> b h i d', exp_sim.to(v.dtype), v_chunk).float()
+
+            if row_max is None:
+                acc, row_sum = block_out, block_sum
+            else:
+                correction = (row_max - new_max).exp_()
+                acc = acc.mul_(correction).add_(block_out)
+                row_sum = row_sum.mul_(correction).add_(block_sum)
+
+            row_max = new_max
+
+        out[..., q_start:q_start + chunk_size, :] = (acc / row_sum).to(q.dtype)
+
+    return out
+
+# backends which materialize the full (b h i j) similarity matrix
+
+MATERIALIZING_BACKENDS = {'einsum', 'sdpa_math'}
+
+# benchmark
+
+_benchmark_cache = dict()
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def _device_name(device):
+    if device.type == 'cuda':
+        return torch.cuda.get_device_name(device)
+    return f'{device.type} {platform.machine()} {platform.processor()} {os.cpu_count()} threads {torch.get_num_threads()}'
+
+def _read_cache_file(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+def _write_cache_file(path, file_key, result):
+    # merged with the results of other processes, replaced at once so readers never see a partial file
+    results = _read_cache_file(path)
+    results[file_key] = result
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(results, f, indent = 1)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f'Cannot cache attention benchmark to {path}: {e}')
+
+def benchmark_backends(
+    shape,
+    device,
+    dtype = torch.float32,
+    scale = None,
+    candidates = None,
+    repeats = 3,
+    max_similarity_bytes = 2 ** 30,
+    backend_kwargs = None,
+    verbose = False,
+    cache_path = None
+):
+    """
+    time every available backend on random q, k, v of the given (b h n d) shape and return the fastest name
+    backends which fail or give a different result from the math kernel are skipped
+    backends materializing the similarity matrix are skipped if it would be larger than max_similarity_bytes
+    for the full shape, so the winner also fits in memory at inference
+    results are cached per (shape, device, dtype), so it only runs once per process
+    with cache_path they are also kept in that json file, keyed by the device model and the torch version,
+    so later processes on the same machine skip the benchmark
+    """
+
+    device = torch.device(device)
+    backend_kwargs = default(backend_kwargs, dict())
+    key = (tuple(shape), str(device), dtype, scale, max_similarity_bytes, str(backend_kwargs))
+
+    if key in _benchmark_cache:
+        return _benchmark_cache[key]
+
+    candidates = default(candidates, available_backends(device))
+
+    file_key = None
+    if exists(cache_path):
+        file_key = json.dumps(dict(
+            shape = list(shape), device = _device_name(device), dtype = str(dtype), scale = scale,
+            max_similarity_bytes = max_similarity_bytes, backend_kwargs = backend_kwargs,
+            candidates = sorted(candidates), torch = torch.__version__
+        ), sort_keys = True, default = str)
+
+        cached = _read_cache_file(cache_path).get(file_key)
+        if exists(cached):
+            winner, timings = cached
+            if verbose:
+                print(f'Attention benchmark for {tuple(shape)} read from {cache_path}')
+            _benchmark_cache[key] = (winner, timings)
+            return winner, timings
+
+    batch, heads, seq_len, dim_head = shape
+
+    similarity_bytes = batch * heads * seq_len * seq_len * torch.finfo(dtype).bits // 8
+    if exists(max_similarity_bytes) and similarity_bytes > max_similarity_bytes:
+        skipped = [name for name in candidates if name in MATERIALIZING_BACKENDS]
+        candidates = [name for name in candidates if name not in MATERIALIZING_BACKENDS]
+        if verbose and len(skipped) > 0:
+            print(f'Attention backends {skipped} need {similarity_bytes / 2 ** 30:.1f} GB for {tuple(shape)}, skip them')
+
+    batch = max(1, min(batch, BENCHMARK_MAX_ELEMENTS // (heads * seq_len * seq_len)))
+
+    q, k, v = (torch.randn(batch, heads, seq_len, dim_head, device = device, dtype = dtype) for _ in range(3))
+
+    with torch.inference_mode():
+        reference = sdpa_math_attention(q, k, v, scale = scale).float()
+
+        timings = dict()
+        for name in candidates:
+            fn = partial(get_backend(name), **backend_kwargs.get(name, dict()))
+            try:
+                out = fn(q, k, v, scale = scale)
+                _synchronize(device)
+            except (RuntimeError, NotImplementedError, TypeError) as e:
+                if verbose:
+                    print(f'Attention backend {name} is not usable for {tuple(shape)}: {str(e).splitlines()[0]}')
+                continue
+
+            if not torch.allclose(out.float(), reference, atol = 5e-2, rtol = 5e-2):
+                if verbose:
+                    print(f'Attention backend {name} gives wrong result for {tuple(shape)}, skip it')
+                continue
+
+            best = float('inf')
+            for _ in range(repeats):
+                start = time.perf_counter()
+                fn(q, k, v, scale = scale)
+                _synchronize(device)
+                best = min(best, time.perf_counter() - start)
+            timings[name] = best
+
+    del q, k, v, reference
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+
+    winner = min(timings, key = timings.get) if len(timings) > 0 else 'sdpa'
+    _benchmark_cache[key] = (winner, timings)
+    if exists(file_key):
+        _write_cache_file(cache_path, file_key, (winner, timings))
+    return winner, timings
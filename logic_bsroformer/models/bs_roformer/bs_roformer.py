@@ -6,13 +6,18 @@ from torch.nn import Module, ModuleList
 import torch.nn.functional as F
 
 from models.bs_roformer.attend import Attend
+from models.bs_roformer.attention_backends import benchmark_backends
+try:
+    from models.bs_roformer.attend_sage import Attend as AttendSage
+except:
+    pass
 
 from torch.utils.checkpoint import checkpoint
 
 from beartype.typing import Tuple, Optional, List, Callable
 from beartype import beartype
 
-from rotary_embedding_torch import RotaryEmbedding
+from models.bs_roformer.rotary import RotaryEmbedding
 
 from einops import rearrange, pack, unpack
 from einops.layers.torch import Rearrange
@@ -90,6 +95,7 @@ class Attention(Module):
     ):
         super().__init__()
         self.heads = heads
+        self.dim_head = dim_head
         self.scale = dim_head ** -0.5
         dim_inner = heads * dim_head
 
@@ -121,8 +127,8 @@ class Attention(Module):
         q, k, v = rearrange(qkv, 'b n (qkv h d) -> qkv b h n d', qkv=3, h=self.heads)
 
         if exists(self.rotary_embed):
-            q = self.rotary_embed.rotate_queries_or_keys(q)
-            k = self.rotary_embed.rotate_queries_or_keys(k)
+            # cos / sin tables are cached per sequence length, bfloat16 is rotated in float32
+            q, k = self.rotary_embed.rotate_queries_and_keys_with_tables(q, k)
 
         out = self.attend(q, k, v)
 
@@ -137,6 +143,80 @@ class Attention(Module):
         return out
 
 
+class FusedAttention(Module):
+    """
+    inference only version of Attention with the same weights
+    the RMSNorm gamma and scale are folded into the qkv projection and to_gates is appended to it,
+    so a single wider GEMM gives q, k, v and the gates of the normalized input
+    q, k, v are strided views of its output (no rearrange copies), q and k are rotated together and
+    the gating is done in the copy to the (b n (h d)) layout of to_out
+    the fused weight is a new tensor, not shared with a memory-mapped checkpoint (fast_load): it is built
+    with a single allocation and owned by the module, the other weights stay shared
+    """
+
+    def __init__(self, heads, dim_head, weight, bias, gates_bias, rotary_embed, attend, to_out):
+        super().__init__()
+        self.heads = heads
+        self.dim_head = dim_head
+
+        # no init and no copy, the linear takes the fused weight as it is
+        self.to_qkv_gates = nn.Linear(weight.shape[1], weight.shape[0], bias=exists(bias), device='meta')
+        self.to_qkv_gates.weight = nn.Parameter(weight, requires_grad=False)
+        if exists(bias):
+            self.to_qkv_gates.bias = nn.Parameter(bias, requires_grad=False)
+
+        # without qkv bias only the few gate columns are biased, after the GEMM
+        self.gates_bias = nn.Parameter(gates_bias, requires_grad=False) if exists(gates_bias) else None
+
+        self.rotary_embed = rotary_embed
+        self.attend = attend
+        self.to_out = to_out
+
+    @classmethod
+    @torch.no_grad()
+    def from_attention(cls, attention):
+        norm_scale = attention.norm.gamma.float() * attention.norm.scale
+
+        # the only new weight of the block, scaled in place (float32) or through one float32 temporary (half)
+        weight = torch.cat((attention.to_qkv.weight, attention.to_gates.weight))
+        folded = weight.float().mul_(norm_scale)
+        if folded is not weight:
+            weight.copy_(folded)
+            del folded
+
+        bias, gates_bias = None, attention.to_gates.bias.detach().clone()
+        if exists(attention.to_qkv.bias):
+            bias, gates_bias = torch.cat((attention.to_qkv.bias, attention.to_gates.bias)), None
+
+        return cls(
+            attention.heads, attention.dim_head, weight, bias, gates_bias,
+            attention.rotary_embed, attention.attend, attention.to_out
+        )
+
+    def forward(self, x):
+        b, n, _ = x.shape
+        h, d = self.heads, self.dim_head
+
+        qkv_gates = self.to_qkv_gates(F.normalize(x, dim=-1))
+
+        qkv = qkv_gates[..., :3 * h * d].unflatten(-1, (3, h, d))
+        q, k, v = qkv.permute(2, 0, 3, 1, 4).unbind(0)
+
+        if exists(self.rotary_embed):
+            q, k = self.rotary_embed.rotate_queries_and_keys_with_tables(q, k)
+
+        out = self.attend(q, k, v)
+
+        gates = qkv_gates[..., 3 * h * d:]
+        if exists(self.gates_bias):
+            gates = gates + self.gates_bias
+        gates = gates.sigmoid()
+
+        gated = out.new_empty(b, n, h, d)
+        torch.mul(out.transpose(1, 2), gates.unsqueeze(-1), out=gated)
+
+        return self.to_out(gated.view(b, n, h * d))
+
 
 class LinearAttention(Module):
     """
@@ -370,6 +450,9 @@ DEFAULT_FREQS_PER_BANDS = (
 
 class BSRoformer(Module):
 
+    # any input length is accepted, demix sends the last chunk of a track without padding it to chunk_size
+    variable_length_input = True
+
     @beartype
     def __init__(
             self,
@@ -438,8 +521,11 @@ class BSRoformer(Module):
             shared_out_bias=self.linear_64_bias_0, 
         )
 
-        time_rotary_embed = RotaryEmbedding(dim=dim_head)
-        freq_rotary_embed = RotaryEmbedding(dim=dim_head)
+        # the frequencies are computed at init, on the meta device (fast model loading) this is slow, so they are
+        # always built on cpu. They are small and moved with the model by .to(device)
+        with torch.device('cpu'):
+            time_rotary_embed = RotaryEmbedding(dim=dim_head)
+            freq_rotary_embed = RotaryEmbedding(dim=dim_head)
 
         for _ in range(depth):
             tran_modules = []
@@ -453,6 +539,9 @@ class BSRoformer(Module):
             )
             self.layers.append(nn.ModuleList(tran_modules))
 
+        # indices of the axial transformer blocks which are run, None runs all of them (see set_active_layers)
+        self.active_layers = None
+
         self.final_norm = RMSNorm(dim)
 
         self.stft_kwargs = dict(
@@ -501,22 +590,99 @@ class BSRoformer(Module):
             normalized=multi_stft_normalized
         )
 
-    def forward(
-            self,
-            raw_audio,
-            target=None,
-            return_loss_breakdown=False
-    ):
+    def set_active_layers(self, depth=None, stride=1):
         """
-        einops
+        run only a part of the axial transformer blocks with the same weights, for a fast low quality preview
+        depth - number of leading blocks which are used, None uses all of them
+        stride - run every stride-th block of them, e.g. 2 runs every other block
+        set_active_layers() restores the full model
+        """
+
+        num_layers = len(self.layers)
+        depth = num_layers if depth is None else depth
+        assert 1 <= depth <= num_layers, f'depth must be between 1 and {num_layers}, got {depth}'
+        assert stride >= 1, f'stride must be at least 1, got {stride}'
 
+        active_layers = list(range(0, depth, stride))
+        self.active_layers = None if len(active_layers) == num_layers else active_layers
+
+    def fuse_attention(self):
+        """
+        replace the Attention modules with FusedAttention (inference only, same outputs)
+        returns the number of replaced modules, attention backends set before are kept
+        """
+
+        num_fused = 0
+        for module in self.modules():
+            if not isinstance(module, Transformer):
+                continue
+            for block in module.layers:
+                attention = block[0]
+                # LoRA or quantized projections can not be folded
+                if isinstance(attention, Attention) and type(attention.to_qkv) is nn.Linear \
+                        and type(attention.to_gates) is nn.Linear:
+                    block[0] = FusedAttention.from_attention(attention)
+                    num_fused += 1
+        return num_fused
+
+    def get_attends(self, axis):
+        """
+        all Attend modules of the time ('time') or band ('freq') transformers
+        """
+
+        index = dict(time=-2, freq=-1)[axis]
+        return [module for block in self.layers for module in block[index].modules() if isinstance(module, Attend)]
+
+    def set_attention_backend(self, axis, name, **kwargs):
+        for attend in self.get_attends(axis):
+            attend.set_backend(name, **kwargs)
+
+    def autotune_attention(self, chunk_size, batch_size, device, dtype=torch.float32, attention_chunk_size=256, verbose=True,
+                           cache_path=None):
+        """
+        benchmark the attention backends once on the real shapes of the time axis (stft frames of one chunk)
+        and of the band axis (number of bands), then use the fastest backend for every layer of that axis
+        backends materializing the full attention matrix are not considered when it would not fit in memory,
+        the memory efficient 'chunked' backend (blocks of attention_chunk_size) is used for long chunks then
+        with cache_path the results are read from and saved to that json file (see benchmark_backends)
+        """
+
+        backend_kwargs = dict(chunked=dict(chunk_size=attention_chunk_size))
+
+        attention = next(module for module in self.modules() if isinstance(module, (Attention, FusedAttention)))
+        heads, dim_head = attention.heads, attention.dim_head
+
+        num_frames = chunk_size // self.stft_kwargs['hop_length'] + 1
+        num_bands = len(self.band_split.dim_inputs)
+
+        shapes = dict(
+            time=(batch_size * num_bands, heads, num_frames, dim_head),
+            freq=(batch_size * num_frames, heads, num_bands, dim_head)
+        )
+
+        winners = dict()
+        for axis, shape in shapes.items():
+            winner, timings = benchmark_backends(
+                shape, device, dtype=dtype, backend_kwargs=backend_kwargs, verbose=verbose, cache_path=cache_path
+            )
+            self.set_attention_backend(axis, winner, **backend_kwargs.get(winner, dict()))
+            winners[axis] = winner
+
+            if verbose:
+                timings = ', '.join(f'{name}: {t * 1000:.2f} ms' for name, t in sorted(timings.items(), key=lambda el: el[1]))
+                print(f'Attention backend for {axis} axis {shape}: {winner} ({timings})')
+
+        return winners
+
+    def stft(self, raw_audio):
+        """
         b - batch
+        s - audio channel (1 for mono, 2 for stereo)
         f - freq
         t - time
-        s - audio channel (1 for mono, 2 for stereo)
-        n - number of 'stems'
         c - complex (2)
-        d - feature dimension
+
+        raw audio (b s t) -> real stft representation with stereo merged into frequency (b (f s) t c)
         """
 
         device = raw_audio.device
@@ -524,14 +690,6 @@ class BSRoformer(Module):
         # defining whether model is loaded on MPS (MacOS GPU accelerator)
         x_is_mps = True if device.type == "mps" else False
 
-        if raw_audio.ndim == 2:
-            raw_audio = rearrange(raw_audio, 'b t -> b 1 t')
-
-        channels = raw_audio.shape[1]
-        assert (not self.stereo and channels == 1) or (self.stereo and channels == 2), 'stereo needs to be set to True if passing in audio signal that is stereo (channel dimension of 2). also need to be False if mono (channel dimension of 1)'
-
-        # to stft
-
         raw_audio, batch_audio_channel_packed_shape = pack_one(raw_audio, '* t')
 
         stft_window = self.stft_window_fn(device=device)
@@ -551,23 +709,33 @@ class BSRoformer(Module):
         # merge stereo / mono into the frequency, with frequency leading dimension, for band splitting
         stft_repr = rearrange(stft_repr,'b s f t c -> b (f s) t c')
 
-        x = rearrange(stft_repr, 'b f t c -> b t (f c)')
+        return stft_repr
 
-        if torch.isnan(x).any() or torch.isinf(x).any():
-            raise RuntimeError(f"NaN/Inf in x after stft: {x.isnan().sum()} NaNs, {x.isinf().sum()} Infs")
+    def forward_core(self, x):
+        """
+        Pure tensor part of the model: band split -> axial transformers -> mask estimators.
+        It has no complex numbers and no FFT, so it can be exported to ONNX.
+
+        x (b t (f c)) -> mask (b n t (f c))
+        """
 
         if self.use_torch_checkpoint:
             x = checkpoint(self.band_split, x, use_reentrant=False)
         else:
             x = self.band_split(x)
 
-        if torch.isnan(x).any() or torch.isinf(x).any():
-            raise RuntimeError(f"NaN/Inf in x after band_split: {x.isnan().sum()} NaNs, {x.isinf().sum()} Infs")
+        if not torch.onnx.is_in_onnx_export():
+            if torch.isnan(x).any() or torch.isinf(x).any():
+                raise RuntimeError(f"NaN/Inf in x after band_split: {x.isnan().sum()} NaNs, {x.isinf().sum()} Infs")
 
         # axial / hierarchical attention
 
-        store = [None] * len(self.layers)
-        for i, transformer_block in enumerate(self.layers):
+        layers = self.layers
+        if self.active_layers is not None:
+            layers = [self.layers[i] for i in self.active_layers]
+
+        store = [None] * len(layers)
+        for i, transformer_block in enumerate(layers):
 
             if len(transformer_block) == 3:
                 linear_transformer, time_transformer, freq_transformer = transformer_block
@@ -610,14 +778,30 @@ class BSRoformer(Module):
 
         x = self.final_norm(x)
 
-        num_stems = len(self.mask_estimators)
-
         if self.use_torch_checkpoint:
             mask = torch.stack([checkpoint(fn, x, use_reentrant=False) for fn in self.mask_estimators], dim=1)
         else:
             mask = torch.stack([fn(x) for fn in self.mask_estimators], dim=1)
+
+        return mask
+
+    def istft(self, stft_repr, mask, length):
+        """
+        Apply the estimated masks to the stft representation and go back to audio.
+
+        stft_repr (b (f s) t c), mask (b n t (f c)) -> recon audio (b n s t)
+        """
+
+        device = stft_repr.device
+        x_is_mps = True if device.type == "mps" else False
+        num_stems = mask.shape[1]
+
         mask = rearrange(mask, 'b n t (f c) -> b n f t c', c=2)
 
+        # mask multiply and istft stay in float32 when running under bf16 / fp16 autocast
+
+        mask = mask.float()
+
         # modulate frequency representation
 
         stft_repr = rearrange(stft_repr, 'b f t c -> b 1 f t c')
@@ -633,14 +817,59 @@ class BSRoformer(Module):
 
         stft_repr = rearrange(stft_repr, 'b n (f s) t -> (b n s) f t', s=self.audio_channels)
 
+        stft_window = self.stft_window_fn(device=device)
+
         # same as torch.stft() fix for MacOS MPS above
         try:
-            recon_audio = torch.istft(stft_repr, **self.stft_kwargs, window=stft_window, return_complex=False, length=raw_audio.shape[-1])
+            recon_audio = torch.istft(stft_repr, **self.stft_kwargs, window=stft_window, return_complex=False, length=length)
         except:
-            recon_audio = torch.istft(stft_repr.cpu() if x_is_mps else stft_repr, **self.stft_kwargs, window=stft_window.cpu() if x_is_mps else stft_window, return_complex=False, length=raw_audio.shape[-1]).to(device)
+            recon_audio = torch.istft(stft_repr.cpu() if x_is_mps else stft_repr, **self.stft_kwargs, window=stft_window.cpu() if x_is_mps else stft_window, return_complex=False, length=length).to(device)
 
         recon_audio = rearrange(recon_audio, '(b n s) t -> b n s t', s=self.audio_channels, n=num_stems)
 
+        return recon_audio
+
+    def forward(
+            self,
+            raw_audio,
+            target=None,
+            return_loss_breakdown=False
+    ):
+        """
+        einops
+
+        b - batch
+        f - freq
+        t - time
+        s - audio channel (1 for mono, 2 for stereo)
+        n - number of 'stems'
+        c - complex (2)
+        d - feature dimension
+        """
+
+        device = raw_audio.device
+
+        if raw_audio.ndim == 2:
+            raw_audio = rearrange(raw_audio, 'b t -> b 1 t')
+
+        channels = raw_audio.shape[1]
+        assert (not self.stereo and channels == 1) or (self.stereo and channels == 2), 'stereo needs to be set to True if passing in audio signal that is stereo (channel dimension of 2). also need to be False if mono (channel dimension of 1)'
+
+        # to stft
+
+        stft_repr = self.stft(raw_audio)
+
+        x = rearrange(stft_repr, 'b f t c -> b t (f c)')
+
+        if torch.isnan(x).any() or torch.isinf(x).any():
+            raise RuntimeError(f"NaN/Inf in x after stft: {x.isnan().sum()} NaNs, {x.isinf().sum()} Infs")
+
+        mask = self.forward_core(x)
+
+        num_stems = len(self.mask_estimators)
+
+        recon_audio = self.istft(stft_repr, mask, raw_audio.shape[-1])
+
         if num_stems == 1:
             recon_audio = rearrange(recon_audio, 'b 1 s t -> b s t')
 
@@ -15,7 +15,7 @@ from torch.utils.checkpoint import checkpoint
 from beartype.typing import Tuple, Optional, List, Callable
 from beartype import beartype
 
-from rotary_embedding_torch import RotaryEmbedding
+from models.bs_roformer.rotary import RotaryEmbedding
 
 from einops import rearrange, pack, unpack, reduce, repeat
 from einops.layers.torch import Rearrange
@@ -125,8 +125,8 @@ class Attention(Module):
         q, k, v = rearrange(self.to_qkv(x), 'b n (qkv h d) -> qkv b h n d', qkv=3, h=self.heads)
 
         if exists(self.rotary_embed):
-            q = self.rotary_embed.rotate_queries_or_keys(q)
-            k = self.rotary_embed.rotate_queries_or_keys(k)
+            # cos / sin tables are cached per sequence length, bfloat16 is rotated in float32
+            q, k = self.rotary_embed.rotate_queries_and_keys_with_tables(q, k)
 
         out = self.attend(q, k, v)
 
@@ -353,6 +353,9 @@ class MaskEstimator(Module):
 
 class MelBandRoformer(Module):
 
+    # any input length is accepted, demix sends the last chunk of a track without padding it to chunk_size
+    variable_length_input = True
+
     @beartype
     def __init__(
             self,
@@ -477,6 +480,12 @@ class MelBandRoformer(Module):
         self.register_buffer('num_freqs_per_band', num_freqs_per_band, persistent=False)
         self.register_buffer('num_bands_per_freq', num_bands_per_freq, persistent=False)
 
+        # 1 / number of bands covering each (freq, channel) row of the stft, used to average the overlapping masks
+
+        mask_averaging_scale = repeat(num_bands_per_freq, 'f -> (f r)', r=self.audio_channels)
+        mask_averaging_scale = 1. / mask_averaging_scale.float().clamp(min=1e-8)
+        self.register_buffer('mask_averaging_scale', mask_averaging_scale, persistent=False)
+
         # band split and mask estimator
 
         freqs_per_bands_with_complex = tuple(2 * f * self.audio_channels for f in num_freqs_per_band.tolist())
@@ -558,11 +567,9 @@ class MelBandRoformer(Module):
 
         # index out all frequencies for all frequency ranges across bands ascending in one go
 
-        batch_arange = torch.arange(batch, device=device)[..., None]
-
         # account for stereo
 
-        x = stft_repr[batch_arange, self.freq_indices]
+        x = stft_repr.index_select(1, self.freq_indices)
 
         # fold the complex (real and imag) into the frequencies dimension
 
@@ -624,27 +631,25 @@ class MelBandRoformer(Module):
             masks = torch.stack([fn(x) for fn in self.mask_estimators], dim=1)
         masks = rearrange(masks, 'b n t (f c) -> b n f t c', c=2)
 
-        # modulate frequency representation
-
-        stft_repr = rearrange(stft_repr, 'b f t c -> b 1 f t c')
-
-        # complex number multiplication
-
-        stft_repr = torch.view_as_complex(stft_repr)
-        masks = torch.view_as_complex(masks)
+        # need to average the estimated mask for the overlapped frequencies
+        # sum the band masks into their frequencies along the frequency axis (no per element index tensor),
+        # then scale by the cached 1 / number of bands of each frequency
 
         masks = masks.type(stft_repr.dtype)
 
-        # need to average the estimated mask for the overlapped frequencies
+        masks_summed = stft_repr.new_zeros((batch, num_stems, *stft_repr.shape[1:]))
+        masks_summed.index_add_(2, self.freq_indices, masks)
 
-        scatter_indices = repeat(self.freq_indices, 'f -> b n f t', b=batch, n=num_stems, t=stft_repr.shape[-1])
+        masks_averaged = masks_summed.mul_(self.mask_averaging_scale[:, None, None])
 
-        stft_repr_expanded_stems = repeat(stft_repr, 'b 1 ... -> b n ...', n=num_stems)
-        masks_summed = torch.zeros_like(stft_repr_expanded_stems).scatter_add_(2, scatter_indices, masks)
+        # modulate frequency representation
 
-        denom = repeat(self.num_bands_per_freq, 'f -> (f r) 1', r=channels)
+        stft_repr = rearrange(stft_repr, 'b f t c -> b 1 f t c')
+
+        # complex number multiplication
 
-        masks_averaged = masks_summed / denom.clamp(min=1e-8)
+        stft_repr = torch.view_as_complex(stft_repr)
+        masks_averaged = torch.view_as_complex(masks_averaged)
 
         # modulate stft repr with estimated mask
 
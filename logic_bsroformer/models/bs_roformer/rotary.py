@@ -0,0 +1,82 @@
+from collections import OrderedDict
+
+import torch
+
+from rotary_embedding_torch import RotaryEmbedding as RotaryEmbeddingBase
+
+# helpers
+
+def as_complex_pairs(t):
+    # interleaved pairs (x1, x2) of the last dimension as complex numbers x1 + i x2
+    return torch.view_as_complex(t.unflatten(-1, (-1, 2)))
+
+# main class
+
+class RotaryEmbedding(RotaryEmbeddingBase):
+    """
+    rotary embedding with the rotation table precomputed once per (sequence length, device)
+    the sequence lengths are fixed at inference (stft frames of a chunk for the time transformers, number of
+    bands for the frequency transformers), so the frequencies, cos and sin are not built again for every
+    layer and every chunk
+    the tables are kept in a small lru: the fixed lengths are used by every layer and stay, the lengths of
+    the shorter last chunk of each track are evicted
+    rotating an interleaved pair (x1, x2) by theta is the complex product (x1 + i x2) * (cos + i sin), so
+    queries and keys are rotated together with a single complex multiply
+    same interleaved convention and same parameters (state dict) as rotary_embedding_torch
+    """
+
+    max_rotary_tables = 8
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rotary_tables = OrderedDict()
+
+    def _apply(self, fn, *args, **kwargs):
+        # tables follow the frequencies if the module is moved or cast
+        self.rotary_tables.clear()
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.rotary_tables.clear()
+        return super()._load_from_state_dict(*args, **kwargs)
+
+    def get_rotary_table(self, seq_len, device):
+        key = (seq_len, device)
+
+        if key in self.rotary_tables:
+            self.rotary_tables.move_to_end(key)
+            return self.rotary_tables[key]
+
+        # positions and angles in float32, positions above 256 are not exact in half precision
+        with torch.no_grad():
+            seq = torch.arange(seq_len, device = device, dtype = torch.float32) / self.interpolate_factor
+            freqs = torch.outer(seq, self.freqs.detach().float().to(device))
+            table = torch.polar(torch.ones_like(freqs), freqs)
+
+        self.rotary_tables[key] = table
+        if len(self.rotary_tables) > self.max_rotary_tables:
+            self.rotary_tables.popitem(last = False)
+
+        return table
+
+    def rotate_queries_and_keys_with_tables(self, q, k):
+        """
+        q, k of shape (b h n d), rotated along n
+        the rotation is done in float32 for every dtype (like rotary_embedding_torch, whose tables are float32)
+        """
+
+        assert not self.use_xpos and not self.learned_freq
+
+        dtype = q.dtype
+
+        table = self.get_rotary_table(q.shape[-2], q.device)
+        rot_dim = table.shape[-1] * 2
+
+        qk = torch.stack((q, k)).float()
+        rotated = torch.view_as_real(as_complex_pairs(qk[..., :rot_dim]) * table).flatten(-2)
+
+        if rot_dim < qk.shape[-1]:
+            rotated = torch.cat((rotated, qk[..., rot_dim:]), dim = -1)
+
+        q, k = rotated.to(dtype).unbind(0)
+        return q, k
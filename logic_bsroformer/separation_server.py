@@ -0,0 +1,432 @@
+# coding: utf-8
+
+"""
+Local separation server. Keeps warm models in memory and separates jobs sent over HTTP,
+on localhost (--host/--port) or on a Unix socket (--unix_socket).
+
+    POST /separate  application/json {"input_path": "song.flac", "store_dir": "out", "stems": ["vocals", "bass"]}
+                    stems are written to <--store_dir>/<store_dir>/<track name>/<stem>.wav|flac
+                    (store_dir is optional and relative, format is wav or flac)
+    POST /separate?sample_rate=44100&channels=2&layout=interleaved&dtype=float32&stems=vocals,bass
+                    application/octet-stream body with raw PCM, stems are returned base64 encoded in the same layout
+                    (layout interleaved or planar, dtype float32 or int16, channels 1 or 2)
+    GET  /health    number of workers, busy workers and queued jobs
+
+The response of /separate is streamed as one JSON object per line (queued, started, stem..., done or error).
+If the queue is full the job is rejected at once with 503, so clients never wait behind an unbounded queue.
+
+    python separation_server.py --model_type bs_roformer --config_path configs/logic_pro_config_v1.yaml
+        --start_check_point models/logic_roformer.pt --fast_load --workers 1 --max_queue 8
+    curl -N -X POST localhost:8765/separate -H 'Content-Type: application/json' -d '{"input_path": "song.flac", "store_dir": "out"}'
+
+With --stub_model no checkpoint is needed, the stems are the mixture split evenly (for testing).
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import signal
+import base64
+import threading
+import itertools
+import socketserver
+import librosa
+import torch
+import torch.nn as nn
+import numpy as np
+import soundfile as sf
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from typing import Dict, List
+
+# Using the embedded version of Python can also correctly import the utils module.
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+from utils.settings import parse_args_server, load_config
+from utils.model_utils import demix, prefer_target_instrument
+from utils.audio_utils import load_audio, resample_audio
+from inference import get_device, load_model, separate_mix
+
+import warnings
+
+warnings.filterwarnings("ignore")
+
+
+PCM_DTYPES = {
+    'float32': np.float32,
+    'int16': np.int16,
+}
+
+PCM_LAYOUTS = ('interleaved', 'planar')
+
+OUTPUT_FORMATS = ('wav', 'flac')
+
+
+class StubModel(nn.Module):
+    """
+    Stand-in for the separation model: every stem is the mixture divided by the number of stems.
+    """
+
+    def __init__(self, num_stems: int):
+        super().__init__()
+        self.num_stems = num_stems
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # (b c t) -> (b n c t)
+        return x.unsqueeze(1).repeat(1, self.num_stems, 1, 1) / self.num_stems
+
+
+class Job:
+    """
+    One separation request. The worker puts progress events in `events`, the HTTP handler streams them.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, request: Dict, pcm: bytes = None):
+        self.id = next(self._ids)
+        self.request = request
+        self.pcm = pcm
+        self.events = queue.Queue()
+        self.submitted = time.time()
+        self.cancelled = False
+
+
+class SeparationService:
+    """
+    Bounded job queue served by a pool of worker threads, each with its own warm model.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.jobs = queue.Queue(maxsize=args.max_queue)
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.workers = []
+
+        device_ids = args.device_ids if isinstance(args.device_ids, list) else [args.device_ids]
+        for worker_id in range(max(args.workers, 1)):
+            worker_args = copy.deepcopy(args)
+            worker_args.device_ids = [device_ids[worker_id % len(device_ids)]]
+            model, config, device = self.load_worker_model(worker_args)
+            self.warmup(worker_args, model, config, device)
+            thread = threading.Thread(
+                target=self.worker_loop, args=(worker_id, worker_args, model, config, device), daemon=True
+            )
+            self.workers.append(thread)
+
+        self.sample_rate = getattr(config.audio, 'sample_rate', 44100)
+        self.instruments = prefer_target_instrument(config)[:]
+        for thread in self.workers:
+            thread.start()
+
+    def load_worker_model(self, args):
+        if args.stub_model:
+            config = load_config(args.model_type, args.config_path)
+            config.inference['precision'] = 'fp32'
+            return StubModel(len(prefer_target_instrument(config))), config, 'cpu'
+        return load_model(args, get_device(args))
+
+    def warmup(self, args, model, config, device) -> None:
+        # the first forward allocates buffers and selects kernels, pay it before the first job
+        start_time = time.time()
+        channels = getattr(config.audio, 'num_channels', 2)
+        demix(config, model, np.zeros((channels, config.audio.chunk_size), dtype=np.float32), device,
+              model_type=args.model_type)
+        print(f"Model warmup: {time.time() - start_time:.2f} sec")
+
+    def submit(self, job: Job) -> bool:
+        with self.lock:
+            # 'queued' is the first event of the job, an idle worker may emit 'started' as soon as it is enqueued
+            job.events.put(dict(event='queued', job=job.id, position=self.jobs.qsize() + 1))
+            try:
+                self.jobs.put_nowait(job)
+            except queue.Full:
+                job.events.get_nowait()
+                return False
+        return True
+
+    def status(self) -> Dict:
+        return dict(
+            status='ok',
+            workers=len(self.workers),
+            busy=self.busy,
+            queued=self.jobs.qsize(),
+            max_queue=self.args.max_queue,
+            instruments=self.instruments,
+        )
+
+    def worker_loop(self, worker_id: int, args, model, config, device) -> None:
+        while True:
+            job = self.jobs.get()
+            if job.cancelled:
+                continue
+            with self.lock:
+                self.busy += 1
+            job.events.put(dict(
+                event='started', job=job.id, worker=worker_id, queue_seconds=round(time.time() - job.submitted, 3)
+            ))
+            start_time = time.time()
+            try:
+                self.run_job(job, args, model, config, device)
+                job.events.put(dict(event='done', job=job.id, seconds=round(time.time() - start_time, 3)))
+            except Exception as e:
+                job.events.put(dict(event='error', job=job.id, message=str(e)))
+            finally:
+                with self.lock:
+                    self.busy -= 1
+                job.events.put(None)
+
+    def get_stems(self, request: Dict) -> List[str]:
+        stems = request.get('stems') or self.instruments
+        available = self.instruments + ['instrumental']
+        unknown = [stem for stem in stems if stem not in available]
+        if unknown:
+            raise ValueError(f'Unknown stems {unknown}, available: {available}')
+        return stems
+
+    def get_format(self, request: Dict) -> str:
+        codec = request.get('format') or ('flac' if self.args.flac_file else 'wav')
+        if codec not in OUTPUT_FORMATS:
+            raise ValueError(f'Unknown format {codec!r}, available: {list(OUTPUT_FORMATS)}')
+        return codec
+
+    def get_output_dir(self, request: Dict) -> str:
+        """
+        <--store_dir>/<request store_dir>/<track name>. The store_dir of a request is relative and cannot
+        leave --store_dir, so a request cannot write anywhere else.
+        """
+
+        if not os.path.isfile(request['input_path']):
+            raise ValueError(f"input_path {request['input_path']!r} is not a file")
+        base_dir = os.path.abspath(self.args.store_dir or 'separated')
+        store_dir = request.get('store_dir') or ''
+        parts = store_dir.replace('\\', '/').split('/')
+        if os.path.isabs(store_dir) or os.path.splitdrive(store_dir)[0] or '..' in parts:
+            raise ValueError(f'store_dir {store_dir!r} must be a relative path inside the store directory')
+        output_dir = os.path.abspath(os.path.join(base_dir, store_dir))
+        if os.path.commonpath([base_dir, output_dir]) != base_dir:
+            raise ValueError(f'store_dir {store_dir!r} must be a relative path inside the store directory')
+        file_name = os.path.splitext(os.path.basename(request['input_path']))[0]
+        return os.path.join(output_dir, file_name)
+
+    def validate(self, request: Dict, pcm: bool) -> None:
+        """
+        Raise ValueError for a request which cannot run, before it is queued.
+        """
+
+        self.get_stems(request)
+        if pcm:
+            if request.get('dtype', 'float32') not in PCM_DTYPES:
+                raise ValueError(f"Unknown dtype {request['dtype']!r}, available: {list(PCM_DTYPES)}")
+            if request.get('layout', 'interleaved') not in PCM_LAYOUTS:
+                raise ValueError(f"Unknown layout {request['layout']!r}, available: {list(PCM_LAYOUTS)}")
+            if str(request.get('channels', 2)) not in ('1', '2'):
+                raise ValueError('channels must be 1 or 2')
+            sample_rate = str(request.get('sample_rate', self.sample_rate))
+            if not sample_rate.isdigit() or int(sample_rate) <= 0:
+                raise ValueError(f'sample_rate must be a positive integer, got {sample_rate!r}')
+        else:
+            if 'input_path' not in request:
+                raise ValueError('input_path is required')
+            self.get_format(request)
+            self.get_output_dir(request)
+
+    def run_job(self, job: Job, args, model, config, device) -> None:
+        request = job.request
+        stems = self.get_stems(request)
+
+        job_args = copy.copy(args)
+        job_args.extract_instrumental = args.extract_instrumental or 'instrumental' in stems
+
+        if job.pcm is not None:
+            mix, sr, num_frames = self.decode_pcm(job.pcm, request)
+        else:
+            mix, sr = load_audio(request['input_path'], self.sample_rate)
+
+        waveforms = separate_mix(model, job_args, config, device, mix)
+
+        if job.pcm is not None:
+            for stem in stems:
+                pcm = self.encode_pcm(waveforms[stem], request, num_frames)
+                job.events.put(dict(event='stem', job=job.id, stem=stem, **pcm))
+            return
+
+        output_dir = self.get_output_dir(request)
+        os.makedirs(output_dir, exist_ok=True)
+
+        codec = self.get_format(request)
+        subtype = args.pcm_type if codec == 'flac' else 'FLOAT'
+        for stem in stems:
+            output_path = os.path.join(output_dir, f"{stem}.{codec}")
+            sf.write(output_path, waveforms[stem].T, sr, subtype=subtype)
+            job.events.put(dict(event='stem', job=job.id, stem=stem, path=os.path.abspath(output_path)))
+
+    def decode_pcm(self, pcm: bytes, request: Dict):
+        """
+        Raw PCM of the request -> (channels, time) float32 at the model sample rate and the number of input frames.
+        """
+
+        dtype = PCM_DTYPES[request.get('dtype', 'float32')]
+        channels = int(request.get('channels', 2))
+        sample_rate = int(request.get('sample_rate', self.sample_rate))
+
+        samples = np.frombuffer(pcm, dtype=dtype)
+        if request.get('layout', 'interleaved') == 'interleaved':
+            mix = samples.reshape(-1, channels).T
+        else:
+            mix = samples.reshape(channels, -1)
+        num_frames = mix.shape[-1]
+        if dtype == np.int16:
+            mix = mix / 32768.0
+        mix = mix.astype(np.float32)
+
+        if sample_rate != self.sample_rate:
+            mix = resample_audio(mix, sample_rate, self.sample_rate)
+        if channels == 1:
+            mix = mix[0]
+        return mix, self.sample_rate, num_frames
+
+    def encode_pcm(self, estimates: np.ndarray, request: Dict, num_frames: int) -> Dict:
+        """
+        (channels, time) stem -> base64 PCM with the sample rate, layout, dtype and length of the request input.
+        """
+
+        if int(request.get('channels', 2)) == 1:
+            # a mono input is separated as dual mono, return it with the channel count it was sent with
+            estimates = estimates.mean(axis=0, keepdims=True)
+        sample_rate = int(request.get('sample_rate', self.sample_rate))
+        if sample_rate != self.sample_rate:
+            estimates = resample_audio(estimates, self.sample_rate, sample_rate)
+            estimates = librosa.util.fix_length(estimates, size=num_frames)
+
+        dtype = request.get('dtype', 'float32')
+        layout = request.get('layout', 'interleaved')
+        data = estimates.T if layout == 'interleaved' else estimates
+        if dtype == 'int16':
+            data = np.clip(data * 32768.0, -32768, 32767)
+        data = np.ascontiguousarray(data, dtype=PCM_DTYPES[dtype])
+
+        return dict(
+            sample_rate=sample_rate,
+            channels=estimates.shape[0],
+            layout=layout,
+            dtype=dtype,
+            data=base64.b64encode(data.tobytes()).decode('ascii'),
+        )
+
+
+class SeparationHandler(BaseHTTPRequestHandler):
+    service: SeparationService = None
+
+    def address_string(self):
+        # client address is empty for Unix sockets
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def send_json(self, code: int, data: Dict, headers: Dict = None) -> None:
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self.send_json(200, self.service.status())
+        else:
+            self.send_json(404, dict(error='not found'))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/separate':
+            self.send_json(404, dict(error='not found'))
+            return
+
+        # only these two types: a browser cannot send them cross-origin without a CORS preflight, which is not answered
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type not in ('application/json', 'application/octet-stream'):
+            self.send_json(415, dict(error='Content-Type must be application/json or application/octet-stream'))
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if content_type == 'application/octet-stream':
+                request = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                if 'stems' in request:
+                    request['stems'] = request['stems'].split(',')
+                job = Job(request, pcm=body)
+            else:
+                request = json.loads(body or b'{}')
+                if not isinstance(request, dict):
+                    raise ValueError('request must be a JSON object')
+                job = Job(request)
+            self.service.validate(request, pcm=job.pcm is not None)
+        except (ValueError, json.JSONDecodeError) as e:
+            self.send_json(400, dict(error=str(e)))
+            return
+
+        if not self.service.submit(job):
+            self.send_json(503, dict(error='queue is full', **self.service.status()), {'Retry-After': '1'})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        while True:
+            event = job.events.get()
+            if event is None:
+                break
+            try:
+                self.wfile.write((json.dumps(event) + '\n').encode('utf-8'))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # client is gone, a job which has not started yet is skipped
+                job.cancelled = True
+                break
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(dict_args):
+    args = parse_args_server(dict_args)
+    if not args.config_path:
+        args.config_path = os.path.join(current_dir, 'configs', 'logic_pro_config_v1.yaml')
+
+    model_load_start_time = time.time()
+    SeparationHandler.service = SeparationService(args)
+    print("Model load time: {:.2f} sec".format(time.time() - model_load_start_time))
+
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, SeparationHandler)
+        print(f"Serving on unix socket {args.unix_socket}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), SeparationHandler)
+        print(f"Serving on http://{args.host}:{args.port}")
+
+    # stop on kill as on Ctrl+C, so the socket file is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+
+if __name__ == "__main__":
+    serve(None)
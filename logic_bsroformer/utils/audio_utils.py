@@ -1,9 +1,16 @@
 import argparse
 import numpy as np
 import os
+import json
 import soundfile as sf
-import matplotlib.pyplot as plt
-from typing import Dict, Tuple
+from abc import ABC, abstractmethod
+from math import gcd
+from collections import deque
+from threading import BoundedSemaphore
+from multiprocessing import get_context
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from scipy.signal import resample_poly
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
 from utils.dataset import MSSDataset
 from torch.utils.data import DataLoader
 
@@ -25,7 +32,7 @@ def prepare_data(config: Dict, args: argparse.Namespace, batch_size: int) -> Dat
         config,
         args.data_path,
         batch_size=batch_size,
-        metadata_path=os.path.join(args.results_path, f'metadata_{args.dataset_type}.pkl'),
+        metadata_path=os.path.join(args.results_path, 'metadata.db'),
         dataset_type=args.dataset_type,
     )
 
@@ -74,6 +81,402 @@ def read_audio_transposed(path: str, instr: str = None, skip_err: bool = False)
         return mix.T, sr
 
 
+def resample_audio(audio: np.ndarray, orig_sr: int, target_sr: int) -> np.ndarray:
+    """
+    Resample audio along the last axis with a polyphase filter (scipy `resample_poly`).
+
+    Parameters:
+    ----------
+    audio : np.ndarray
+        Audio array with shape (channels, time) or (time,).
+    orig_sr : int
+        Sample rate of `audio`.
+    target_sr : int
+        Sample rate of the result.
+
+    Returns:
+    -------
+    np.ndarray
+        Resampled float32 audio, `audio` itself if the sample rates are equal.
+    """
+
+    if orig_sr == target_sr:
+        return audio
+
+    factor = gcd(orig_sr, target_sr)
+    audio = resample_poly(audio, target_sr // factor, orig_sr // factor, axis=-1)
+    return audio.astype(np.float32, copy=False)
+
+
+def load_audio(path: str, sample_rate: int, duration: Optional[float] = None) -> Tuple[np.ndarray, int]:
+    """
+    Decode an audio file for inference, a faster replacement of `librosa.load(path, sr=sample_rate, mono=False)`.
+
+    WAV, FLAC, OGG and MP3 are decoded in-process by libsndfile (soundfile) directly to float32,
+    without resampling when the file already has `sample_rate`, otherwise with a polyphase resampler.
+    Other formats (e.g. m4a) fall back to librosa (audioread / ffmpeg).
+
+    Parameters:
+    ----------
+    path : str
+        Path to the audio file.
+    sample_rate : int
+        Sample rate of the model.
+    duration : float, optional
+        Only decode this many seconds from the start.
+
+    Returns:
+    -------
+    Tuple[np.ndarray, int]
+        - Float32 audio with shape (channels, time), or (time,) for mono files (like librosa).
+        - `sample_rate`.
+    """
+
+    try:
+        with sf.SoundFile(path) as f:
+            frames = -1 if duration is None else int(duration * f.samplerate)
+            mix = f.read(frames, dtype='float32', always_2d=True).T
+            sr = f.samplerate
+    except RuntimeError:
+        # format not supported by libsndfile
+        import librosa
+        return librosa.load(path, sr=sample_rate, mono=False, duration=duration)
+
+    mix = np.ascontiguousarray(resample_audio(mix, sr, sample_rate))
+    if mix.shape[0] == 1:
+        mix = mix[0]
+    return mix, sample_rate
+
+
+def prefetch_audio(paths: Iterable[str], sample_rate: int, num_threads: int = 1,
+                   duration: Optional[float] = None) -> Iterator[Tuple[str, Optional[np.ndarray], Optional[Exception]]]:
+    """
+    Decode audio files with `load_audio` in background threads, ahead of the separation.
+
+    At most `num_threads` files are decoded ahead of the one being processed, so memory stays bounded.
+    libsndfile and the resampler release the GIL, so decoding overlaps with the model.
+
+    Parameters:
+    ----------
+    paths : Iterable[str]
+        Audio files, yielded in this order.
+    sample_rate : int
+        Sample rate of the model.
+    num_threads : int
+        Number of decoding threads, 0 decodes in the calling thread.
+    duration : float, optional
+        Only decode this many seconds from the start.
+
+    Yields:
+    ------
+    Tuple[str, Optional[np.ndarray], Optional[Exception]]
+        (path, mix, None) for decoded files and (path, None, error) for files which can not be read.
+    """
+
+    if num_threads <= 0:
+        for path in paths:
+            try:
+                yield path, load_audio(path, sample_rate, duration)[0], None
+            except Exception as e:
+                yield path, None, e
+        return
+
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        pending = deque()
+
+        def submit_next() -> None:
+            path = next(paths, None)
+            if path is not None:
+                pending.append((path, pool.submit(load_audio, path, sample_rate, duration)))
+
+        for _ in range(num_threads):
+            submit_next()
+
+        while pending:
+            path, future = pending.popleft()
+            submit_next()
+            try:
+                yield path, future.result()[0], None
+            except Exception as e:
+                yield path, None, e
+
+
+class AudioSource(ABC):
+    """
+    Audio input read in blocks on demand, so the whole track does not have to be in memory.
+
+    Subclasses implement `read(start, end)` returning float32 samples [start, end) with shape
+    (num_channels, end - start) at the sample rate of the model.
+    """
+
+    def __init__(self, num_channels: int, length: int):
+        self.num_channels = num_channels
+        self.length = length
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.num_channels, self.length
+
+    @abstractmethod
+    def read(self, start: int, end: int) -> np.ndarray:
+        pass
+
+    def read_all(self) -> np.ndarray:
+        return self.read(0, self.length)
+
+    def close(self) -> None:
+        pass
+
+
+class ArraySource(AudioSource):
+    """
+    AudioSource of a (channels, time) array already in memory.
+    """
+
+    def __init__(self, audio: np.ndarray):
+        super().__init__(audio.shape[0], audio.shape[-1])
+        self.audio = audio
+
+    def read(self, start: int, end: int) -> np.ndarray:
+        return np.asarray(self.audio[:, start:end], dtype=np.float32)
+
+
+class SoundFileSource(AudioSource):
+    """
+    AudioSource reading blocks of a file with `soundfile.SoundFile` seek + read, only the requested
+    samples are decoded. The file must have the sample rate of the model (no resampling).
+    Mono files are duplicated to `num_channels` channels on read.
+    """
+
+    def __init__(self, path: str, num_channels: Optional[int] = None):
+        self.file = sf.SoundFile(path)
+        self.file_channels = self.file.channels
+        if self.file_channels == 1 and num_channels:
+            super().__init__(num_channels, self.file.frames)
+        else:
+            super().__init__(self.file_channels, self.file.frames)
+
+    @property
+    def samplerate(self) -> int:
+        return self.file.samplerate
+
+    def read(self, start: int, end: int) -> np.ndarray:
+        self.file.seek(start)
+        block = self.file.read(end - start, dtype='float32', always_2d=True).T
+        if self.file_channels == 1 and self.num_channels > 1:
+            block = np.repeat(block, self.num_channels, axis=0)
+        return np.ascontiguousarray(block)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ReflectPaddedSource(AudioSource):
+    """
+    Virtual `torch.nn.functional.pad(audio, (pad, pad), mode='reflect')` of another source:
+    the padding is produced on read from the samples near the edges, nothing is copied.
+    `pad` must be smaller than the length of the source.
+    """
+
+    def __init__(self, source: AudioSource, pad: int):
+        super().__init__(source.num_channels, source.length + 2 * pad)
+        self.source = source
+        self.pad = pad
+
+    def read(self, start: int, end: int) -> np.ndarray:
+        start, end = start - self.pad, end - self.pad
+        length = self.source.length
+        if start >= 0 and end <= length:
+            return self.source.read(start, end)
+
+        # mirror the indices outside of [0, length) without repeating the edge sample
+        index = np.arange(start, end)
+        index = np.abs(index)
+        index = np.where(index >= length, 2 * length - 2 - index, index)
+        low, high = index.min(), index.max() + 1
+        return self.source.read(low, high)[:, index - low]
+
+    def close(self) -> None:
+        self.source.close()
+
+
+def open_audio_source(path: str, sample_rate: int, num_channels: Optional[int] = None) -> AudioSource:
+    """
+    Open an input for block-wise reading: a `SoundFileSource` when libsndfile can read the file and it
+    has `sample_rate`, otherwise the file is decoded and resampled into memory with `load_audio`.
+    Mono input is converted to `num_channels` channels (e.g. 2 for stereo models).
+    """
+
+    try:
+        source = SoundFileSource(path, num_channels if num_channels else None)
+        if source.samplerate == sample_rate:
+            return source
+        source.close()
+    except RuntimeError:
+        pass
+
+    mix, _ = load_audio(path, sample_rate)
+    if len(mix.shape) == 1:
+        mix = np.stack([mix] * (num_channels or 1), axis=0)
+    return ArraySource(mix)
+
+
+def iter_audio_sources(paths: Iterable[str], sample_rate: int,
+                       num_channels: Optional[int] = None) -> Iterator[Tuple[str, Optional[AudioSource], Optional[Exception]]]:
+    """
+    Open the files one after the other with `open_audio_source`, the streaming counterpart of `prefetch_audio`.
+
+    Yields:
+    ------
+    Tuple[str, Optional[AudioSource], Optional[Exception]]
+        (path, source, None) for readable files and (path, None, error) for files which can not be read.
+        The source is closed when the next one is requested.
+    """
+
+    for path in paths:
+        try:
+            source = open_audio_source(path, sample_rate, num_channels)
+        except Exception as e:
+            yield path, None, e
+            continue
+        try:
+            yield path, source, None
+        finally:
+            source.close()
+
+
+class StemWriter:
+    """
+    Write separated stems in background threads, so FLAC encoding and disk writes of a track overlap
+    with the separation of the next one.
+
+    `submit` blocks while `max_pending` stems are queued or being written (back-pressure), so at most
+    that many stems are kept in memory. With `num_threads` 0 stems are written in the calling thread.
+    Write errors are printed and passed to the `on_error` callback of `submit`, they do not stop the
+    processing of the other tracks. `on_done` is called once the stem is written.
+
+    Usage:
+        with StemWriter(num_threads=2, max_pending=8) as writer:
+            writer.submit(path, stem, sample_rate, 'FLOAT')
+    """
+
+    def __init__(self, num_threads: int = 2, max_pending: int = 8):
+        self.pool = ThreadPoolExecutor(max_workers=num_threads) if num_threads > 0 else None
+        self.max_pending = max(max_pending, 1)
+        self.pending = BoundedSemaphore(self.max_pending)
+
+    # frames per write, only one block of a stem is copied to the (time, channels) layout at a time
+    block_size = 2 ** 20
+
+    @classmethod
+    def write(cls, path: str, audio: np.ndarray, sample_rate: int, subtype: str,
+              on_error: Optional[Callable[[Exception], None]] = None,
+              on_done: Optional[Callable[[], None]] = None) -> None:
+        try:
+            with sf.SoundFile(path, 'w', sample_rate, audio.shape[0], subtype=subtype) as f:
+                for start in range(0, audio.shape[-1], cls.block_size):
+                    # (channels, time) -> contiguous (time, channels), soundfile would copy the transposed view anyway
+                    f.write(np.ascontiguousarray(audio[:, start:start + cls.block_size].T))
+        except Exception as e:
+            # one print, messages of the writer threads do not interleave
+            print(f'Cannot write stem: {path}\nError message: {str(e)}')
+            if on_error is not None:
+                on_error(e)
+            return
+        if on_done is not None:
+            on_done()
+
+    @classmethod
+    def write_npy(cls, output_dir: str, stems: Dict[str, np.ndarray], sample_rate: int,
+                  on_error: Optional[Callable[[Exception], None]] = None,
+                  on_done: Optional[Callable[[], None]] = None) -> None:
+        """
+        Write all (channels, time) stems of a track into one float16 `stems.npy` of shape (stems, channels, time),
+        with the stem names and the sample rate in `stems.json` (read by `remix_stems_npy` in main.py). The same
+        size as 16-bit PCM files and half of float32 ones, without the encoding cost, for intermediate stems.
+        """
+
+        path = os.path.join(output_dir, 'stems.npy')
+        tmp_path = os.path.join(output_dir, 'stems.tmp.npy')
+        try:
+            names = list(stems)
+            shape = (len(names),) + stems[names[0]].shape
+            array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=shape)
+            for i, name in enumerate(names):
+                for start in range(0, shape[-1], cls.block_size):
+                    array[i, :, start:start + cls.block_size] = stems[name][:, start:start + cls.block_size]
+            array.flush()
+            del array
+            with open(os.path.join(output_dir, 'stems.json'), 'w') as f:
+                json.dump({'stems': names, 'sample_rate': sample_rate}, f)
+            # stems.npy only exists once it is complete
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f'Cannot write stems: {path}\nError message: {str(e)}')
+            if on_error is not None:
+                on_error(e)
+            return
+        if on_done is not None:
+            on_done()
+
+    def submit_npy(self, output_dir: str, stems: Dict[str, np.ndarray], sample_rate: int,
+                   on_error: Optional[Callable[[Exception], None]] = None,
+                   on_done: Optional[Callable[[], None]] = None) -> None:
+        """
+        Queue the stems of a track to be written into one `stems.npy` of `output_dir` (see `write_npy`).
+        """
+
+        if self.pool is None:
+            self.write_npy(output_dir, stems, sample_rate, on_error, on_done)
+            return
+
+        self.pending.acquire()
+        future: Future = self.pool.submit(self.write_npy, output_dir, stems, sample_rate, on_error, on_done)
+        future.add_done_callback(lambda _: self.pending.release())
+
+    def submit(self, path: str, audio: np.ndarray, sample_rate: int, subtype: str,
+               on_error: Optional[Callable[[Exception], None]] = None,
+               on_done: Optional[Callable[[], None]] = None) -> None:
+        """
+        Queue the (channels, time) stem `audio` to be written to `path`.
+        `on_error` is called with the exception if the stem can not be written, `on_done` once it is written
+        (both from a writer thread).
+        """
+
+        if self.pool is None:
+            self.write(path, audio, sample_rate, subtype, on_error, on_done)
+            return
+
+        self.pending.acquire()
+        future: Future = self.pool.submit(self.write, path, audio, sample_rate, subtype, on_error, on_done)
+        future.add_done_callback(lambda _: self.pending.release())
+
+    def flush(self) -> None:
+        """
+        Wait until the queued stems are written, the writer can still be used.
+        """
+
+        for _ in range(self.max_pending):
+            self.pending.acquire()
+        for _ in range(self.max_pending):
+            self.pending.release()
+
+    def close(self) -> None:
+        """
+        Wait until all queued stems are written.
+        """
+
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+    def __enter__(self) -> 'StemWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
 def normalize_audio(audio: np.ndarray) -> tuple[np.ndarray, Dict[str, float]]:
     """
     Normalize an audio signal by subtracting the mean and dividing by the standard deviation.
@@ -95,7 +498,7 @@ def normalize_audio(audio: np.ndarray) -> tuple[np.ndarray, Dict[str, float]]:
     return (audio - mean) / std, {"mean": mean, "std": std}
 
 
-def denormalize_audio(audio: np.ndarray, norm_params: Dict[str, float]) -> np.ndarray:
+def denormalize_audio(audio: np.ndarray, norm_params: Dict[str, float], inplace: bool = False) -> np.ndarray:
     """
     Denormalize an audio signal by reversing the normalization process (multiplying by the standard deviation
     and adding the mean).
@@ -106,6 +509,8 @@ def denormalize_audio(audio: np.ndarray, norm_params: Dict[str, float]) -> np.nd
         Normalized audio array to be denormalized.
     norm_params : dict[str, float]
         Dictionary containing the 'mean' and 'std' values used for normalization.
+    inplace : bool, optional
+        If True, `audio` is modified and returned instead of a copy. Default is False.
 
     Returns:
     -------
@@ -113,18 +518,26 @@ def denormalize_audio(audio: np.ndarray, norm_params: Dict[str, float]) -> np.nd
         Denormalized audio array with the same shape as the input.
     """
 
+    if inplace:
+        audio *= norm_params["std"]
+        audio += norm_params["mean"]
+        return audio
     return audio * norm_params["std"] + norm_params["mean"]
 
 
-def draw_spectrogram(waveform, sample_rate, length, output_file):
+def render_spectrogram(Xdb: np.ndarray, sample_rate: int, output_file: str) -> None:
+    """
+    Save a dB-scaled spectrogram as an image.
+
+    A `Figure` created outside of pyplot is not registered in its global figure list, so it is freed
+    after saving instead of accumulating (and it can be rendered from any thread or process).
+    """
+
     import librosa.display
+    from matplotlib.figure import Figure
 
-    # Cut only required part of spectorgram
-    x = waveform[:int(length * sample_rate), :]
-    X = librosa.stft(x.mean(axis=-1))  # perform short-term fourier transform on mono signal
-    Xdb = librosa.amplitude_to_db(np.abs(X), ref=np.max)  # convert an amplitude spectrogram to dB-scaled spectrogram.
-    fig, ax = plt.subplots()
-    # plt.figure(figsize=(30, 10))  # initialize the fig size
+    fig = Figure()
+    ax = fig.subplots()
     img = librosa.display.specshow(
         Xdb,
         cmap='plasma',
@@ -135,5 +548,87 @@ def draw_spectrogram(waveform, sample_rate, length, output_file):
     )
     ax.set(title='File: ' + os.path.basename(output_file))
     fig.colorbar(img, ax=ax, format="%+2.f dB")
-    if output_file is not None:
-        plt.savefig(output_file)
\ No newline at end of file
+    fig.savefig(output_file)
+
+
+def draw_spectrograms(previews: Dict[str, np.ndarray], sample_rate: int, output_files: Dict[str, str]) -> None:
+    """
+    Draw the spectrograms of several stems, with one batched STFT of all of them.
+
+    Parameters:
+    ----------
+    previews : Dict[str, np.ndarray]
+        Stem name -> mono (time,) audio of the part to draw, all of the same length.
+    sample_rate : int
+        Sample rate of the audio.
+    output_files : Dict[str, str]
+        Stem name -> image path.
+    """
+
+    import librosa
+
+    names = list(previews)
+    X = np.abs(librosa.stft(np.stack([previews[name] for name in names])))  # (stems, freqs, frames)
+    for name, S in zip(names, X):
+        try:
+            render_spectrogram(librosa.amplitude_to_db(S, ref=np.max), sample_rate, output_files[name])
+        except Exception as e:
+            print(f'Cannot draw spectrogram: {output_files[name]}\nError message: {str(e)}')
+
+
+class SpectrogramWriter:
+    """
+    Draw the stem spectrograms of `--draw_spectro` in worker processes, so the STFTs and the matplotlib
+    rendering do not stall the separation loop.
+
+    Only the mono mix of the first `length` seconds of every stem is sent to a worker. `submit` blocks
+    while `max_pending` tracks are waiting (back-pressure). With `num_workers` 0 the spectrograms are
+    drawn in the calling process, which is also the default (`None`) on a single CPU, where a worker would
+    only compete with the separation. The pool is started at the first submit.
+    """
+
+    def __init__(self, num_workers: Optional[int] = None, max_pending: int = 2):
+        if num_workers is None:
+            num_workers = 1 if (os.cpu_count() or 1) > 1 else 0
+        self.num_workers = num_workers
+        self.pool = None
+        self.pending = BoundedSemaphore(max(max_pending, 1))
+
+    def submit(self, stems: Dict[str, np.ndarray], sample_rate: int, length: float, output_files: Dict[str, str]) -> None:
+        """
+        Queue the spectrograms of the (channels, time) `stems` of a track.
+        """
+
+        num_samples = int(length * sample_rate)
+        previews = {name: stem[:, :num_samples].mean(axis=0, dtype=np.float32) for name, stem in stems.items()}
+
+        if self.num_workers <= 0:
+            draw_spectrograms(previews, sample_rate, output_files)
+            return
+
+        if self.pool is None:
+            # spawn: no fork of a process with running torch and writer threads
+            self.pool = ProcessPoolExecutor(max_workers=self.num_workers, mp_context=get_context('spawn'))
+
+        self.pending.acquire()
+        future = self.pool.submit(draw_spectrograms, previews, sample_rate, output_files)
+        future.add_done_callback(self.done)
+
+    def done(self, future: Future) -> None:
+        self.pending.release()
+        if future.exception() is not None:
+            print(f'Spectrogram worker failed: {future.exception()}')
+
+    def close(self) -> None:
+        """
+        Wait until all queued spectrograms are drawn.
+        """
+
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+    def __enter__(self) -> 'SpectrogramWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
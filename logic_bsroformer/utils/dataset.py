@@ -7,9 +7,10 @@ import random
 import numpy as np
 import torch
 import soundfile as sf
-import pickle
+import sqlite3
 import itertools
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 from tqdm.auto import tqdm
 from glob import glob
 import audiomentations as AU
@@ -37,22 +38,103 @@ def load_chunk(path, length, chunk_size, offset=None):
     return x.T
 
 
-def get_track_set_length(params):
-    path, instruments, file_types = params
-    # Check lengths of all instruments (it can be different in some cases)
-    lengths_arr = []
+# For the metadata threads
+def get_track_length(params):
+    path = params
+    # number of frames from the file header, the audio is not decoded
+    try:
+        length = sf.info(path).frames
+    except Exception as e:
+        print('Problem with path: {} ({})'.format(path, e))
+        length = None
+    return (path, length)
+
+
+def get_file_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path, None
+    return path, (stat.st_size, stat.st_mtime_ns)
+
+
+class MetadataCache:
+    """
+    SQLite cache of the length of audio files, a length is valid while the size and mtime of the file are unchanged.
+    Only new or modified files are read, their headers are read in parallel threads.
+    """
+
+    def __init__(self, db_path, num_threads=1, verbose=True):
+        self.db_path = db_path
+        self.num_threads = max(num_threads, 1)
+        self.verbose = verbose
+        self.db = sqlite3.connect(db_path, timeout=60)
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS lengths '
+                '(path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, length INTEGER NOT NULL)'
+            )
+
+    def get_lengths(self, paths):
+        """
+        Return {path: length} for the files of `paths`, None for missing or unreadable files.
+        """
+
+        paths = list(dict.fromkeys(paths))
+        with ThreadPool(self.num_threads) as pool:
+            stats = dict(pool.imap(get_file_stat, paths, chunksize=64))
+
+            lengths = dict()
+            cached = dict()
+            for path, size, mtime_ns, length in self.db.execute('SELECT path, size, mtime_ns, length FROM lengths'):
+                cached[path] = ((size, mtime_ns), length)
+            to_read = []
+            for path in paths:
+                if stats[path] is None:
+                    lengths[path] = None
+                elif path in cached and cached[path][0] == stats[path]:
+                    lengths[path] = cached[path][1]
+                else:
+                    to_read.append(path)
+
+            if self.verbose:
+                print('Metadata cache {}: {} files cached, {} to read'.format(
+                    self.db_path, len(paths) - len(to_read), len(to_read))
+                )
+
+            rows = []
+            for path, length in tqdm(pool.imap(get_track_length, to_read, chunksize=16), total=len(to_read)):
+                lengths[path] = length
+                if length is not None:
+                    rows.append((path, stats[path][0], stats[path][1], length))
+
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO lengths VALUES (?, ?, ?, ?)', rows)
+        return lengths
+
+    def close(self):
+        self.db.close()
+
+
+def find_stem_files(path, instruments, file_types):
+    # one listing of the track folder instead of a check per instrument and extension
+    names = set(os.listdir(path))
+    stems = []
     for instr in instruments:
-        length = -1
         for extension in file_types:
-            path_to_audio_file = path + '/{}.{}'.format(instr, extension)
-            if os.path.isfile(path_to_audio_file):
-                length = len(sf.read(path_to_audio_file)[0])
+            if '{}.{}'.format(instr, extension) in names:
+                stems.append(os.path.join(path, '{}.{}'.format(instr, extension)))
                 break
-        if length == -1:
+        else:
             print('Cant find file "{}" in folder {}'.format(instr, path))
-            continue
-        lengths_arr.append(length)
-    lengths_arr = np.array(lengths_arr)
+    return stems
+
+
+def get_track_set_length(path, stems, lengths):
+    # Check lengths of all instruments (it can be different in some cases)
+    lengths_arr = np.array([lengths[stem] for stem in stems if lengths[stem] is not None])
+    if len(lengths_arr) == 0:
+        return path, None
     if lengths_arr.min() != lengths_arr.max():
         print('Warning: lengths of stems are different for path: {}. ({} != {})'.format(
             path,
@@ -63,15 +145,8 @@ def get_track_set_length(params):
     return path, lengths_arr.min()
 
 
-# For multiprocessing
-def get_track_length(params):
-    path = params
-    length = len(sf.read(path)[0])
-    return (path, length)
-
-
 class MSSDataset(torch.utils.data.Dataset):
-    def __init__(self, config, data_path, metadata_path="metadata.pkl", dataset_type=1, batch_size=None, verbose=True):
+    def __init__(self, config, data_path, metadata_path="metadata.db", dataset_type=1, batch_size=None, verbose=True):
         self.verbose = verbose
         self.config = config
         self.dataset_type = dataset_type # 1, 2, 3 or 4
@@ -114,30 +189,6 @@ class MSSDataset(torch.utils.data.Dataset):
     def __len__(self):
         return self.config.training.num_steps * self.batch_size
 
-    def read_from_metadata_cache(self, track_paths, instr=None):
-        metadata = []
-        if os.path.isfile(self.metadata_path):
-            if self.verbose:
-                print('Found metadata cache file: {}'.format(self.metadata_path))
-            old_metadata = pickle.load(open(self.metadata_path, 'rb'))
-        else:
-            return track_paths, metadata
-
-        if instr:
-            old_metadata = old_metadata[instr]
-
-        # We will not re-read tracks existed in old metadata file
-        track_paths_set = set(track_paths)
-        for old_path, file_size in old_metadata:
-            if old_path in track_paths_set:
-                metadata.append([old_path, file_size])
-                track_paths_set.remove(old_path)
-        track_paths = list(track_paths_set)
-        if len(metadata) > 0:
-            print('Old metadata was used for {} tracks.'.format(len(metadata)))
-        return track_paths, metadata
-
-
     def get_metadata(self):
         read_metadata_procs = multiprocessing.cpu_count()
         if 'read_metadata_procs' in self.config['training']:
@@ -146,10 +197,13 @@ class MSSDataset(torch.utils.data.Dataset):
         if self.verbose:
             print(
                 'Dataset type:', self.dataset_type,
-                'Processes to use:', read_metadata_procs,
+                'Threads to use:', read_metadata_procs,
                 '\nCollecting metadata for', str(self.data_path),
             )
 
+        # lengths of the audio files, cached in SQLite by path, size and mtime
+        cache = MetadataCache(self.metadata_path, read_metadata_procs, self.verbose)
+
         if self.dataset_type in [1, 4]:
             track_paths = []
             if type(self.data_path) == list:
@@ -162,28 +216,18 @@ class MSSDataset(torch.utils.data.Dataset):
                 track_paths += sorted(glob(self.data_path + '/*'))
 
             track_paths = [path for path in track_paths if os.path.basename(path)[0] != '.' and os.path.isdir(path)]
-            track_paths, metadata = self.read_from_metadata_cache(track_paths, None)
+            track_stems = {path: find_stem_files(path, self.instruments, self.file_types) for path in track_paths}
+            lengths = cache.get_lengths(itertools.chain.from_iterable(track_stems.values()))
 
-            if read_metadata_procs <= 1:
-                for path in tqdm(track_paths):
-                    track_path, track_length = get_track_set_length((path, self.instruments, self.file_types))
+            metadata = []
+            for path in track_paths:
+                track_path, track_length = get_track_set_length(path, track_stems[path], lengths)
+                if track_length is not None:
                     metadata.append((track_path, track_length))
-            else:
-                p = multiprocessing.Pool(processes=read_metadata_procs)
-                with tqdm(total=len(track_paths)) as pbar:
-                    track_iter = p.imap(
-                        get_track_set_length,
-                        zip(track_paths, itertools.repeat(self.instruments), itertools.repeat(self.file_types))
-                    )
-                    for track_path, track_length in track_iter:
-                        metadata.append((track_path, track_length))
-                        pbar.update()
-                p.close()
 
         elif self.dataset_type == 2:
             metadata = dict()
             for instr in self.instruments:
-                metadata[instr] = []
                 track_paths = []
                 if type(self.data_path) == list:
                     for tp in self.data_path:
@@ -193,59 +237,45 @@ class MSSDataset(torch.utils.data.Dataset):
                     track_paths += sorted(glob(self.data_path + '/{}/*.wav'.format(instr)))
                     track_paths += sorted(glob(self.data_path + '/{}/*.flac'.format(instr)))
 
-                track_paths, metadata[instr] = self.read_from_metadata_cache(track_paths, instr)
-
-                if read_metadata_procs <= 1:
-                    for path in tqdm(track_paths):
-                        length = len(sf.read(path)[0])
-                        metadata[instr].append((path, length))
-                else:
-                    p = multiprocessing.Pool(processes=read_metadata_procs)
-                    for out in tqdm(p.imap(get_track_length, track_paths), total=len(track_paths)):
-                        metadata[instr].append(out)
+                lengths = cache.get_lengths(track_paths)
+                metadata[instr] = [(path, lengths[path]) for path in track_paths if lengths[path] is not None]
 
         elif self.dataset_type == 3:
             import pandas as pd
-            if type(self.data_path) != list:
-                data_path = [self.data_path]
+            data_path = self.data_path
+            if type(data_path) != list:
+                data_path = [data_path]
 
             metadata = dict()
-            for i in range(len(self.data_path)):
+            for i in range(len(data_path)):
                 if self.verbose:
-                    print('Reading tracks from: {}'.format(self.data_path[i]))
-                df = pd.read_csv(self.data_path[i])
+                    print('Reading tracks from: {}'.format(data_path[i]))
+                df = pd.read_csv(data_path[i])
 
-                skipped = 0
                 for instr in self.instruments:
                     part = df[df['instrum'] == instr].copy()
                     print('Tracks found for {}: {}'.format(instr, len(part)))
+
+                # the files of all instruments are read together
+                lengths = cache.get_lengths(df['path'].values)
+                skipped = 0
                 for instr in self.instruments:
                     part = df[df['instrum'] == instr].copy()
                     metadata[instr] = []
-                    track_paths = list(part['path'].values)
-                    track_paths, metadata[instr] = self.read_from_metadata_cache(track_paths, instr)
-
-                    for path in tqdm(track_paths):
-                        if not os.path.isfile(path):
-                            print('Cant find track: {}'.format(path))
-                            skipped += 1
-                            continue
-                        # print(path)
-                        try:
-                            length = len(sf.read(path)[0])
-                        except:
-                            print('Problem with path: {}'.format(path))
+                    for path in part['path'].values:
+                        if lengths[path] is None:
+                            if not os.path.isfile(path):
+                                print('Cant find track: {}'.format(path))
                             skipped += 1
                             continue
-                        metadata[instr].append((path, length))
+                        metadata[instr].append((path, lengths[path]))
                 if skipped > 0:
                     print('Missing tracks: {} from {}'.format(skipped, len(df)))
         else:
             print('Unknown dataset type: {}. Must be 1, 2, 3 or 4'.format(self.dataset_type))
             exit()
 
-        # Save metadata
-        pickle.dump(metadata, open(self.metadata_path, 'wb'))
+        cache.close()
         return metadata
 
     def load_source(self, metadata, instr):
@@ -666,3 +696,43 @@ class MSSDataset(torch.utils.data.Dataset):
             return res[index:index+1], mix
 
         return res, mix
+
+
+class SyntheticMixDataset(torch.utils.data.Dataset):
+    """
+    Random tonal and noise stems, summed to a mixture. Needs no audio files, it is used to test
+    training scripts (e.g. distillation) on CPU. Returns (stems, mix) like MSSDataset.
+    """
+
+    def __init__(self, config, batch_size=None, num_steps=None):
+        self.config = config
+        self.instruments = config.training.instruments
+        self.batch_size = batch_size if batch_size is not None else config.training.batch_size
+        self.num_steps = num_steps if num_steps is not None else config.training.num_steps
+        self.chunk_size = config.audio.chunk_size
+        self.sample_rate = getattr(config.audio, 'sample_rate', 44100)
+        self.channels = getattr(config.audio, 'num_channels', 2)
+
+    def __len__(self):
+        return self.num_steps * self.batch_size
+
+    def random_stem(self):
+        t = np.arange(self.chunk_size) / self.sample_rate
+        stem = np.zeros((self.channels, self.chunk_size), dtype=np.float32)
+        for _ in range(np.random.randint(1, 4)):
+            freq = np.random.uniform(40, 4000)
+            envelope = np.abs(np.sin(2 * np.pi * np.random.uniform(0.5, 4) * t))
+            pan = np.random.uniform(0.2, 1.0, size=(self.channels, 1))
+            stem += pan * envelope * np.sin(2 * np.pi * freq * t + np.random.uniform(0, 2 * np.pi))
+        stem += np.random.uniform(0, 0.05) * np.random.randn(self.channels, self.chunk_size)
+        return stem * np.random.uniform(0.05, 0.3)
+
+    def __getitem__(self, index):
+        res = torch.tensor(np.stack([self.random_stem() for _ in self.instruments]), dtype=torch.float32)
+        mix = res.sum(0)
+
+        if self.config.training.target_instrument is not None:
+            index = self.config.training.instruments.index(self.config.training.target_instrument)
+            return res[index:index+1], mix
+
+        return res, mix
@@ -0,0 +1,265 @@
+import os
+import time
+import sqlite3
+import hashlib
+from typing import Iterator, List, Optional
+
+
+class Manifest:
+    """
+    SQLite manifest of the input files of a folder, for incremental and watch-folder processing.
+
+    One row per file: (path, size, mtime, content hash, status, attempts, error, timings). A scan only lists
+    the folder and compares size and mtime with the rows, so files are not opened again. When the folder
+    itself did not change (no file added, removed or renamed) it is not listed, only the recorded files are
+    stat'ed, to find the ones rewritten in place. A file whose size or mtime changed is hashed: if the content
+    is the same as the processed one it is not processed again.
+
+    Status: 'new' (to process), 'running', 'done', 'failed' (retried up to `max_attempts` times) or 'missing'
+    (removed before it was processed, processed again if it comes back).
+
+    Usage:
+        manifest = Manifest('manifest.db')
+        manifest.scan(folder)
+        for path in manifest.pending():
+            manifest.start(path)
+            ...
+            manifest.finish(path)  # or manifest.fail(path, error)
+    """
+
+    def __init__(self, db_path: str, max_attempts: int = 3):
+        self.max_attempts = max_attempts
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                hash TEXT,
+                status TEXT NOT NULL DEFAULT 'new',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                added REAL,
+                started REAL,
+                finished REAL,
+                elapsed REAL
+            );
+            CREATE INDEX IF NOT EXISTS files_status ON files (status);
+            CREATE TABLE IF NOT EXISTS folders (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL
+            );
+        ''')
+        # files of an interrupted run are processed again
+        with self.db:
+            self.db.execute("UPDATE files SET status = 'new' WHERE status = 'running'")
+
+    @staticmethod
+    def file_hash(path: str, block_size: int = 2 ** 20) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def known_files(self) -> dict:
+        """
+        Rows of the table: path -> (size, mtime_ns, status, hash).
+        """
+
+        return {
+            path: (size, mtime_ns, status, file_hash) for path, size, mtime_ns, status, file_hash in
+            self.db.execute('SELECT path, size, mtime_ns, status, hash FROM files')
+        }
+
+    def scan(self, folder: str, force: bool = False) -> int:
+        """
+        Record the new and changed files of `folder` (not recursive, same files as `glob('*.*')`).
+        Rows of files removed from the folder are kept, as a history.
+
+        Returns:
+            Number of new or changed files.
+        """
+
+        folder = os.path.abspath(folder)
+        folder_mtime = os.stat(folder).st_mtime_ns
+        row = self.db.execute('SELECT mtime_ns FROM folders WHERE path = ?', (folder,)).fetchone()
+
+        known = self.known_files()
+
+        changed = 0
+        if not force and row is not None and row[0] == folder_mtime:
+            # same names as the last scan, a file rewritten in place only changes its own size and mtime
+            with self.db:
+                for path in list(known):
+                    if os.path.dirname(path) != folder:
+                        continue
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    changed += self.record(path, stat, known)
+            return changed
+
+        with self.db:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.') or '.' not in entry.name or not entry.is_file():
+                        continue
+                    changed += self.record(entry.path, entry.stat(), known)
+
+            self.db.execute('INSERT OR REPLACE INTO folders (path, mtime_ns) VALUES (?, ?)', (folder, folder_mtime))
+        return changed
+
+    def add(self, paths: List[str]) -> List[str]:
+        """
+        Record the new and changed files of an explicit list, like `scan` for a folder.
+        Missing files are skipped.
+
+        Returns:
+            The recorded (absolute) paths, in the order of `paths`.
+        """
+
+        known = self.known_files()
+
+        added = []
+        with self.db:
+            for path in paths:
+                path = os.path.abspath(path)
+                try:
+                    stat = os.stat(path)
+                except OSError as e:
+                    print(f'Cannot read track: {path}\nError message: {str(e)}')
+                    continue
+                self.record(path, stat, known)
+                added.append(path)
+        return added
+
+    def record(self, path: str, stat: os.stat_result, known: dict) -> int:
+        """
+        Insert or update the row of `path` (`known`: the rows of `known_files`, kept up to date).
+
+        Returns:
+            1 if the file is new or changed, 0 otherwise.
+        """
+
+        if path not in known:
+            self.db.execute(
+                'INSERT INTO files (path, size, mtime_ns, added) VALUES (?, ?, ?, ?)',
+                (path, stat.st_size, stat.st_mtime_ns, time.time())
+            )
+            known[path] = (stat.st_size, stat.st_mtime_ns, 'new', None)
+            return 1
+
+        size, mtime_ns, status, file_hash = known[path]
+        if status != 'missing' and (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            return 0
+        if status == 'done' and file_hash is not None and file_hash == self.file_hash(path):
+            # touched or copied again, same content
+            self.db.execute(
+                'UPDATE files SET size = ?, mtime_ns = ? WHERE path = ?', (stat.st_size, stat.st_mtime_ns, path)
+            )
+            return 0
+        self.db.execute(
+            "UPDATE files SET size = ?, mtime_ns = ?, hash = NULL, status = 'new', attempts = 0,"
+            " error = NULL, added = ? WHERE path = ?",
+            (stat.st_size, stat.st_mtime_ns, time.time(), path)
+        )
+        return 1
+
+    def pending(self, settle: float = 0, paths: Optional[List[str]] = None) -> List[str]:
+        """
+        Files to process: new ones and failed ones with attempts left, sorted by path.
+        With `settle` > 0, files modified (or failed) in the last `settle` seconds are left for a later
+        call, they may still be copied into the folder. With `paths`, only these files, in this order.
+        """
+
+        now = time.time()
+        if paths is not None:
+            pending = set(self.pending(settle))
+            return [path for path in paths if path in pending]
+        return [path for path, in self.db.execute(
+            "SELECT path FROM files WHERE (status = 'new' OR (status = 'failed' AND attempts < ? AND finished <= ?))"
+            " AND mtime_ns <= ? ORDER BY path",
+            (self.max_attempts, now - settle, int((now - settle) * 1e9))
+        )]
+
+    def start(self, path: str) -> bool:
+        """
+        Mark `path` as being processed.
+
+        Returns:
+            False if the file changed since the scan (it is left for a later call) or was removed.
+        """
+
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            # removed since the scan: not pending any more, a scan records it again if it comes back
+            with self.db:
+                self.db.execute(
+                    "UPDATE files SET status = 'missing', error = ?, finished = ? WHERE path = ?",
+                    (str(e) or repr(e), time.time(), path)
+                )
+            return False
+
+        with self.db:
+            cursor = self.db.execute(
+                "UPDATE files SET status = 'running', attempts = attempts + 1, started = ?"
+                " WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (time.time(), path, stat.st_size, stat.st_mtime_ns)
+            )
+            if cursor.rowcount == 0:
+                self.db.execute(
+                    'UPDATE files SET size = ?, mtime_ns = ? WHERE path = ?', (stat.st_size, stat.st_mtime_ns, path)
+                )
+        return cursor.rowcount > 0
+
+    def finish(self, path: str) -> None:
+        """
+        Mark `path` as processed, with the hash of its content and the processing time.
+        """
+
+        try:
+            file_hash = self.file_hash(path)
+        except OSError:
+            file_hash = None
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                "UPDATE files SET status = 'done', hash = ?, error = NULL, finished = ?, elapsed = ? - started"
+                " WHERE path = ?",
+                (file_hash, now, now, path)
+            )
+
+    def fail(self, path: str, error: Exception) -> None:
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                "UPDATE files SET status = 'failed', error = ?, finished = ?, elapsed = ? - started WHERE path = ?",
+                (str(error) or repr(error), now, now, path)
+            )
+
+    def watch(self, folder: str, interval: float, settle: Optional[float] = None) -> Iterator[List[str]]:
+        """
+        Yield the files to process: the pending files of the whole folder first, then every `interval`
+        seconds the new or changed ones. Runs until interrupted (Ctrl+C while waiting ends it quietly).
+        Files are processed once they were not modified for `settle` seconds (default `interval`).
+        """
+
+        settle = interval if settle is None else settle
+        self.scan(folder, force=True)
+        while True:
+            paths = self.pending(settle)
+            if paths:
+                yield paths
+                continue
+            try:
+                time.sleep(interval)
+            except KeyboardInterrupt:
+                print('Stopped watching')
+                return
+            self.scan(folder)
+
+    def close(self) -> None:
+        self.db.close()
@@ -2,23 +2,41 @@
 __author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
 
 import argparse
+import os
+import json
+import time
+import hashlib
+import tempfile
+from contextlib import contextmanager
 import numpy as np
 import torch
 import torch.nn as nn
 from ml_collections import ConfigDict
 from torch.optim import Adam, AdamW, SGD, RAdam, RMSprop
 from tqdm.auto import tqdm
-from typing import Dict, List, Tuple, Any, Union
+from typing import Dict, List, Optional, Tuple, Any, Union, Set
 import loralib as lora
 
+from utils.audio_utils import AudioSource, ArraySource, ReflectPaddedSource
+
+PRECISION_DTYPES = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+# devices where half precision inference runs under autocast, the input stays float32
+AUTOCAST_DEVICE_TYPES = ['cuda', 'cpu']
+
 
 def demix(
         config: ConfigDict,
         model: torch.nn.Module,
-        mix: torch.Tensor,
+        mix: Union[np.ndarray, AudioSource],
         device: torch.device,
         model_type: str,
-        pbar: bool = False
+        pbar: bool = False,
+        checkpoint_key: Optional[str] = None
 ) -> Tuple[List[Dict[str, np.ndarray]], np.ndarray]:
     """
     Unified function for audio source separation with support for multiple processing modes.
@@ -33,8 +51,9 @@ def demix(
         Configuration object containing audio and inference settings.
     model : torch.nn.Module
         The trained model used for audio source separation.
-    mix : torch.Tensor
-        Input audio tensor with shape (channels, time).
+    mix : Union[np.ndarray, AudioSource]
+        Input audio with shape (channels, time). With an `AudioSource` the generic mode reads it chunk by
+        chunk (edge padding included), so only O(chunk_size) of the input is in memory.
     device : torch.device
         The computation device (CPU or CUDA).
     model_type : str, optional
@@ -43,6 +62,10 @@ def demix(
         Default is "generic".
     pbar : bool, optional
         If True, displays a progress bar during chunk processing. Default is False.
+    checkpoint_key : str, optional
+        With `config.inference.resume_dir`, name of the `DemixCheckpoint` of this input, the separation
+        is checkpointed every `config.inference.checkpoint_interval` seconds and resumed from the last
+        checkpoint after a crash (not with time-frequency chunking).
 
     Returns:
     -------
@@ -51,12 +74,27 @@ def demix(
         - A numpy array of the separated source if only one instrument is present.
     """
 
-    mix = torch.tensor(mix, dtype=torch.float32)
-
     if model_type == 'htdemucs':
         mode = 'demucs'
     else:
         mode = 'generic'
+
+    tf_chunking = mode == 'generic' and getattr(config.inference, 'tf_chunking', False)
+    if mode != 'generic' or tf_chunking:
+        # these modes need the whole track
+        if isinstance(mix, AudioSource):
+            mix = mix.read_all()
+        mix = torch.tensor(mix, dtype=torch.float32)
+    elif not isinstance(mix, AudioSource):
+        # chunks are read from an AudioSource, the reflect padding is virtual
+        mix = ArraySource(np.asarray(mix, dtype=np.float32))
+
+    if tf_chunking:
+        base_model = model.module if isinstance(model, nn.DataParallel) else model
+        if hasattr(base_model, 'forward_core'):
+            return demix_tf(config, base_model, mix, device, pbar=pbar)
+        print('Time-frequency chunking needs a model with stft/forward_core/istft, using audio chunks.')
+        mix = ArraySource(mix.numpy())
     # Define processing parameters based on the mode
     if mode == 'demucs':
         chunk_size = config.training.samplerate * config.training.segment
@@ -75,42 +113,67 @@ def demix(
         windowing_array = _getWindowingArray(chunk_size, fade_size)
         # Add padding for generic mode to handle edge artifacts
         if length_init > 2 * border and border > 0:
-            mix = nn.functional.pad(mix, (border, border), mode="reflect")
+            mix = ReflectPaddedSource(mix, border)
+
+    # short chunks at the end of the track are padded only up to a multiple of this length, 0 pads them to chunk_size
+    hop_length, n_fft = get_stft_lengths(model)
+    length_multiple = get_chunk_frames_multiple(model, config) * hop_length if mode == 'generic' else 0
 
     batch_size = config.inference.batch_size
 
-    use_amp = getattr(config.training, 'use_amp', True)
+    device_type = torch.device(device).type
+    precision = get_inference_precision(config, device)
+    use_amp = precision != 'fp32' and device_type in AUTOCAST_DEVICE_TYPES
 
-    with torch.cuda.amp.autocast(enabled=use_amp):
+    with preview_layers(model, config), \
+            torch.autocast(device_type=device_type, dtype=PRECISION_DTYPES[precision], enabled=use_amp):
         with torch.inference_mode():
-            # Initialize result and counter tensors
+            # Initialize result and counter tensors, the window weights are the same for all stems and channels
             req_shape = (num_instruments,) + mix.shape
-            result = torch.zeros(req_shape, dtype=torch.float32)
-            counter = torch.zeros(req_shape, dtype=torch.float32)
-
+            resume_dir = getattr(config.inference, 'resume_dir', None)
+            checkpoint = None
             i = 0
+            if resume_dir and checkpoint_key:
+                checkpoint = DemixCheckpoint(
+                    resume_dir, checkpoint_key, req_shape, chunk_size,
+                    float(getattr(config.inference, 'checkpoint_interval', 60))
+                )
+                result, counter, i = checkpoint.open()
+            else:
+                result = allocate_accumulator(req_shape, config)
+                counter = allocate_accumulator((mix.shape[-1],), config)
+
             batch_data = []
             batch_locations = []
             progress_bar = tqdm(
-                total=mix.shape[1], desc="Processing audio chunks", leave=False
+                total=mix.shape[1], initial=i, desc="Processing audio chunks", leave=False
             ) if pbar else None
 
             while i < mix.shape[1]:
                 # Extract chunk and apply padding if necessary
-                part = mix[:, i:i + chunk_size].to(device)
+                if mode == "generic":
+                    part = torch.from_numpy(mix.read(i, min(i + chunk_size, mix.shape[1]))).to(device)
+                else:
+                    part = mix[:, i:i + chunk_size].to(device)
                 chunk_len = part.shape[-1]
-                if mode == "generic" and chunk_len > chunk_size // 2:
+                padded_len = get_padded_chunk_length(chunk_len, chunk_size, length_multiple, n_fft)
+                if mode == "generic" and chunk_len > padded_len // 2:
                     pad_mode = "reflect"
                 else:
                     pad_mode = "constant"
-                part = nn.functional.pad(part, (0, chunk_size - chunk_len), mode=pad_mode, value=0)
+                part = nn.functional.pad(part, (0, padded_len - chunk_len), mode=pad_mode, value=0)
 
                 batch_data.append(part)
                 batch_locations.append((i, chunk_len))
                 i += step
 
+                # chunks of another length can not be stacked, the next one goes in a new batch
+                next_len = get_padded_chunk_length(
+                    min(chunk_size, mix.shape[1] - i), chunk_size, length_multiple, n_fft
+                )
+
                 # Process batch if it's full or the end is reached
-                if len(batch_data) >= batch_size or i >= mix.shape[1]:
+                if len(batch_data) >= batch_size or i >= mix.shape[1] or next_len != padded_len:
                     arr = torch.stack(batch_data, dim=0)
                     x = model(arr)
 
@@ -132,16 +195,20 @@ def demix(
                     batch_data.clear()
                     batch_locations.clear()
 
+                    if checkpoint is not None and i < mix.shape[1]:
+                        checkpoint.save(i)
+
                 if progress_bar:
                     progress_bar.update(step)
 
             if progress_bar:
                 progress_bar.close()
 
-            # Compute final estimated sources
-            estimated_sources = result / counter
-            estimated_sources = estimated_sources.cpu().numpy()
-            np.nan_to_num(estimated_sources, copy=False, nan=0.0)
+            # Compute final estimated sources, in place and without copy to numpy
+            normalize_accumulator(result, counter)
+            estimated_sources = result.numpy()
+            if checkpoint is not None:
+                checkpoint.remove()
 
             # Remove padding for generic mode
             if mode == "generic":
@@ -163,6 +230,317 @@ def demix(
 
 
 
+def get_memory_budget(config: ConfigDict) -> int:
+    """
+    Return `config.inference.memory_budget` (GB) in bytes, 0 if there is no budget.
+    """
+
+    return int(float(getattr(config.inference, 'memory_budget', 0) or 0) * 2 ** 30)
+
+
+def allocate_accumulator(shape: Tuple[int, ...], config: ConfigDict) -> torch.Tensor:
+    """
+    Zero float32 tensor for the overlap-add of demix.
+
+    With `config.inference.memmap_accumulators`, or with a memory budget for an accumulator which would take
+    more than half of it (the stems of the previous track can still be waiting for the writer), it is backed
+    by a memory-mapped temporary file in `config.inference.scratch_dir` (default: the system temp directory),
+    so the OS pages it to disk instead of running out of memory. The file is deleted when the array is released.
+
+    Args:
+        shape: Shape of the accumulator.
+        config: Configuration with the optional `inference.memmap_accumulators`, `inference.memory_budget`
+            and `inference.scratch_dir`.
+
+    Returns:
+        Tensor of zeros, in RAM or sharing the memory of a `np.memmap`.
+    """
+
+    num_bytes = int(np.prod(shape)) * 4
+    budget = get_memory_budget(config)
+    memmap = getattr(config.inference, 'memmap_accumulators', False)
+    if not memmap and (budget <= 0 or 2 * num_bytes <= budget):
+        return torch.zeros(shape, dtype=torch.float32)
+
+    scratch_dir = getattr(config.inference, 'scratch_dir', None) or tempfile.gettempdir()
+    if not memmap:
+        print(f'Accumulator of {num_bytes / 2 ** 30:.2f} GB is over the memory budget, mapped to a file in {scratch_dir}')
+
+    # the mapping keeps the (already unlinked) file alive, it is removed when the array is freed
+    with tempfile.TemporaryFile(dir=scratch_dir, suffix='.f32') as f:
+        array = np.memmap(f, dtype=np.float32, mode='w+', shape=shape)
+    return torch.from_numpy(array)
+
+
+def normalize_accumulator(result: torch.Tensor, counter: torch.Tensor, block_size: int = 2 ** 20) -> None:
+    """
+    In place `result /= counter` along the last axis, NaN (samples not covered by any window) become 0.
+
+    Done in blocks of `block_size` samples, so memory-mapped accumulators are streamed through the page
+    cache once instead of being touched as a whole by every operation.
+    """
+
+    for start in range(0, result.shape[-1], block_size):
+        block = result[..., start:start + block_size]
+        block /= counter[start:start + block_size]
+        torch.nan_to_num_(block, nan=0.0)
+
+
+class DemixCheckpoint:
+    """
+    Crash-safe state of `demix` for one track, to resume the separation where it stopped.
+
+    The overlap-add accumulators are memory-mapped files in `directory` (`<key>.result.f32`,
+    `<key>.counter.f32`). Every `interval` seconds, at the end of a batch, they are flushed to disk and
+    `<key>.npz` is replaced atomically with the chunk cursor and a copy of the accumulators from the cursor
+    to one chunk after it. Pages of later batches can reach the disk before the process dies, so on resume
+    this region is restored and everything after it is cleared: the accumulators are exactly those of the
+    checkpoint and the result is the same as without interruption.
+
+    `key` identifies the input, model and configuration, a checkpoint with another shape is ignored.
+    """
+
+    def __init__(self, directory: str, key: str, shape: Tuple[int, ...], chunk_size: int, interval: float = 60):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, key)
+        self.shape = tuple(shape)
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.last_save = time.time()
+        self.result = None
+        self.counter = None
+
+    def open(self) -> Tuple[torch.Tensor, torch.Tensor, int]:
+        """
+        Open the accumulators, restored from the last checkpoint if there is one.
+
+        Returns:
+            (result, counter, cursor): memory-mapped accumulators and the position of the next chunk to process.
+        """
+
+        self.remove_finished()
+
+        cursor = 0
+        state = None
+        if os.path.isfile(self.path + '.npz') and os.path.isfile(self.path + '.result.f32'):
+            with np.load(self.path + '.npz') as data:
+                if tuple(data['shape']) == self.shape:
+                    state = {k: data[k] for k in data.files}
+
+        mode = 'r+' if state is not None else 'w+'
+        self.result = np.memmap(self.path + '.result.f32', dtype=np.float32, mode=mode, shape=self.shape)
+        self.counter = np.memmap(self.path + '.counter.f32', dtype=np.float32, mode=mode, shape=self.shape[-1:])
+
+        if state is not None:
+            cursor = int(state['cursor'])
+            end = cursor + state['counter'].shape[-1]
+            self.result[..., cursor:end] = state['result']
+            self.counter[cursor:end] = state['counter']
+            for start in range(end, self.shape[-1], 2 ** 20):
+                self.result[..., start:start + 2 ** 20] = 0
+                self.counter[start:start + 2 ** 20] = 0
+            print(f'Resume separation at {100 * cursor / self.shape[-1]:.1f}% from {self.path}.npz')
+
+        return torch.from_numpy(self.result), torch.from_numpy(self.counter), cursor
+
+    def save(self, cursor: int, force: bool = False) -> None:
+        """
+        Checkpoint the accumulators after all chunks before `cursor` were added, if `interval` seconds passed.
+        """
+
+        if not force and time.time() - self.last_save < self.interval:
+            return
+
+        self.result.flush()
+        self.counter.flush()
+        end = min(cursor + self.chunk_size, self.shape[-1])
+        tmp_path = self.path + '.tmp.npz'
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f, shape=np.array(self.shape), cursor=np.array(cursor),
+                result=self.result[..., cursor:end], counter=self.counter[cursor:end]
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path + '.npz')
+        self.last_save = time.time()
+
+    def remove(self) -> None:
+        """
+        Delete the checkpoint when the separation is complete. The accumulators stay valid while they are used
+        (on Windows the files of mapped accumulators can not be deleted, they are removed by a later `open`).
+        """
+
+        for suffix in ['.npz', '.result.f32', '.counter.f32']:
+            try:
+                os.remove(self.path + suffix)
+            except OSError:
+                pass
+
+    def remove_finished(self) -> None:
+        """
+        Delete the accumulators left in the directory by completed separations (without checkpoint).
+        """
+
+        directory = os.path.dirname(self.path)
+        for name in os.listdir(directory):
+            # <key>.result.f32, <key>.counter.f32
+            if name.endswith('.f32') and not os.path.isfile(os.path.join(directory, name.rsplit('.', 2)[0] + '.npz')):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+
+
+def get_chunk_frames_multiple(model: torch.nn.Module, config: ConfigDict) -> int:
+    """
+    Return the number of STFT frames the last (short) chunk of a track is rounded up to.
+
+    Models which accept any input length set `variable_length_input = True`, for them the tail chunk
+    is processed at its own length instead of being padded to the full chunk, so the transformer runs
+    on fewer frames. `config.inference.tail_chunk_frames` (default 1) sets the rounding, a larger value
+    bounds the number of distinct shapes for shape-specialized (compiled) models. 0 means the model
+    has a fixed input size (e.g. ONNX Runtime) or the feature is disabled, chunks are padded to chunk_size.
+    """
+
+    model = model.module if isinstance(model, nn.DataParallel) else model
+    if not getattr(model, 'variable_length_input', False):
+        return 0
+    return max(int(getattr(config.inference, 'tail_chunk_frames', 1)), 0)
+
+
+def get_stft_lengths(model: torch.nn.Module) -> Tuple[int, int]:
+    """
+    Return (hop_length, n_fft) of the model STFT, (1, 0) for models without one.
+    """
+
+    model = model.module if isinstance(model, nn.DataParallel) else model
+    stft_kwargs = getattr(model, 'stft_kwargs', None)
+    if not stft_kwargs:
+        return 1, 0
+    return stft_kwargs['hop_length'], stft_kwargs['n_fft']
+
+
+def get_padded_chunk_length(chunk_len: int, chunk_size: int, multiple: int, min_length: int = 0) -> int:
+    """
+    Length a chunk is padded to: chunk_size, or for short chunks the next multiple of `multiple` if it is > 0.
+    Short chunks are not shorter than `min_length` (the centered STFT reflects n_fft // 2 samples on each side).
+    """
+
+    if multiple <= 0:
+        return chunk_size
+    return min(chunk_size, max(-(-chunk_len // multiple) * multiple, min_length))
+
+
+def demix_tf(
+        config: ConfigDict,
+        model: torch.nn.Module,
+        mix: torch.Tensor,
+        device: torch.device,
+        pbar: bool = False
+) -> Dict[str, np.ndarray]:
+    """
+    Source separation with chunking in the time-frequency domain.
+
+    The STFT of the whole track is computed once, overlapping windows of STFT frames (same length
+    and overlap as `chunk_size` / `num_overlap` in samples) go through the model core, the estimated
+    masks are overlap-added with a fade window and a single iSTFT per stem gives the result.
+    Compared to `demix` every sample is transformed once instead of `num_overlap` times in both directions.
+    The mask accumulator (stems x frames x freqs) is kept on CPU.
+
+    Parameters:
+    ----------
+    config : ConfigDict
+        Configuration object containing audio and inference settings.
+    model : torch.nn.Module
+        Model with `stft`, `forward_core` and `istft` (BSRoformer, OnnxRoformer).
+    mix : torch.Tensor
+        Input audio tensor with shape (channels, time).
+    device : torch.device
+        The computation device (CPU or CUDA).
+    pbar : bool, optional
+        If True, displays a progress bar during chunk processing. Default is False.
+
+    Returns:
+    -------
+    Dict[str, np.ndarray]
+        A dictionary mapping target instruments to separated audio sources.
+    """
+
+    instruments = prefer_target_instrument(config)
+    hop_length = model.stft_kwargs['hop_length']
+    chunk_frames = config.audio.chunk_size // hop_length + 1
+    step = chunk_frames // config.inference.num_overlap
+    fade_size = chunk_frames // 10
+    windowing_array = _getWindowingArray(chunk_frames, fade_size)
+    batch_size = config.inference.batch_size
+    frames_multiple = get_chunk_frames_multiple(model, config)
+
+    device_type = torch.device(device).type
+    precision = get_inference_precision(config, device)
+    use_amp = precision != 'fp32' and device_type in AUTOCAST_DEVICE_TYPES
+
+    with preview_layers(model, config), torch.inference_mode():
+        stft_repr = model.stft(mix[None].to(device))
+        _, freqs, num_frames, complex_dim = stft_repr.shape
+
+        # (1 (f s) t c) -> (t (f s c)), the input layout of forward_core
+        x = stft_repr[0].permute(1, 0, 2).reshape(num_frames, freqs * complex_dim)
+
+        result = allocate_accumulator((len(instruments), num_frames, freqs * complex_dim), config)
+        counter = torch.zeros(num_frames, dtype=torch.float32)
+
+        progress_bar = tqdm(
+            total=num_frames, desc="Processing spectrogram chunks", leave=False
+        ) if pbar else None
+
+        # batches of chunks with the same (padded) number of frames, short chunks at the end are not padded to
+        # chunk_frames if the model accepts any length
+        batches = []
+        for start in range(0, num_frames, step):
+            padded_len = get_padded_chunk_length(min(chunk_frames, num_frames - start), chunk_frames, frames_multiple)
+            if batches and len(batches[-1][1]) < batch_size and batches[-1][0] == padded_len:
+                batches[-1][1].append(start)
+            else:
+                batches.append((padded_len, [start]))
+
+        for padded_len, batch_starts in batches:
+            batch_data = []
+            for start in batch_starts:
+                part = x[start:start + chunk_frames]
+                batch_data.append(nn.functional.pad(part, (0, 0, 0, padded_len - part.shape[0])))
+
+            with torch.autocast(device_type=device_type, dtype=PRECISION_DTYPES[precision], enabled=use_amp):
+                masks = model.forward_core(torch.stack(batch_data, dim=0))
+            masks = masks.float().cpu()
+
+            for j, start in enumerate(batch_starts):
+                seg_len = min(chunk_frames, num_frames - start)
+                window = windowing_array.clone()
+                if start == 0:  # First chunk, no fadein
+                    window[:fade_size] = 1
+                if start + step >= num_frames:  # Last chunk, no fadeout
+                    window[-fade_size:] = 1
+
+                result[:, start:start + seg_len] += masks[j, :, :seg_len] * window[:seg_len, None]
+                counter[start:start + seg_len] += window[:seg_len]
+
+            if progress_bar:
+                progress_bar.update(step * len(batch_starts))
+
+        if progress_bar:
+            progress_bar.close()
+
+        result /= counter[None, :, None]
+
+        # one iSTFT per stem and channel for the whole track
+        estimated_sources = model.istft(stft_repr.cpu(), result[None], mix.shape[-1])[0]
+        estimated_sources = estimated_sources.numpy()
+        np.nan_to_num(estimated_sources, copy=False, nan=0.0)
+
+    return {k: v for k, v in zip(instruments, estimated_sources)}
+
+
 def initialize_model_and_device(model: torch.nn.Module, device_ids: List[int]) -> Tuple[Union[torch.device, str], torch.nn.Module]:
     """
     Initialize the model and assign it to the appropriate device (GPU or CPU).
@@ -467,16 +845,18 @@ def load_start_checkpoint(args: argparse.Namespace, model: torch.nn.Module, type
             model.load_state_dict(torch.load(args.start_check_point))
     else:
         device='cpu'
-        if args.model_type in ['htdemucs', 'apollo']:
-            state_dict = torch.load(args.start_check_point, map_location=device, weights_only=False)
-            # Fix for htdemucs pretrained models
-            if 'state' in state_dict:
-                state_dict = state_dict['state']
-            # Fix for apollo pretrained models
-            if 'state_dict' in state_dict:
-                state_dict = state_dict['state_dict']
-        else:
-            state_dict = torch.load(args.start_check_point, map_location=device, weights_only=True)
+        # htdemucs and apollo pretrained models are not plain tensors
+        weights_only = args.model_type not in ['htdemucs', 'apollo']
+        state_dict = torch.load(args.start_check_point, map_location=device, weights_only=weights_only)
+        # Fix for htdemucs pretrained models
+        if 'state' in state_dict:
+            state_dict = state_dict['state']
+        # Fix for apollo pretrained models (and other checkpoints saved with their training state)
+        if 'state_dict' in state_dict:
+            state_dict = state_dict['state_dict']
+        # checkpoints saved from a DataParallel model
+        if state_dict and all(key.startswith('module.') for key in state_dict):
+            state_dict = {key[len('module.'):]: value for key, value in state_dict.items()}
         model.load_state_dict(state_dict)
 
     if args.lora_checkpoint:
@@ -484,6 +864,374 @@ def load_start_checkpoint(args: argparse.Namespace, model: torch.nn.Module, type
         load_lora_weights(model, args.lora_checkpoint)
 
 
+def materialize_meta_buffers(model: torch.nn.Module, device: Union[torch.device, str]) -> None:
+    """
+    Create the non-persistent buffers of a model built on the meta device.
+
+    They are not stored in the checkpoint, so they stay on the meta device after
+    `load_state_dict(..., assign=True)`. For rotary embeddings they are only caches
+    (filled at the first forward), so empty tensors on `device` are enough.
+
+    Raises:
+        RuntimeError: If another module has a buffer which can not be restored.
+    """
+
+    from rotary_embedding_torch import RotaryEmbedding
+
+    for module_name, module in model.named_modules():
+        for name, buffer in module.named_buffers(recurse=False):
+            if not buffer.is_meta:
+                continue
+            if not isinstance(module, RotaryEmbedding):
+                raise RuntimeError(
+                    f'Buffer {module_name}.{name} is not in the checkpoint and can not be created, '
+                    f'load the model without --fast_load'
+                )
+            module._buffers[name] = torch.zeros_like(buffer, device=device)
+
+
+def load_checkpoint_mmap(args: argparse.Namespace, model: torch.nn.Module,
+                         device: Union[torch.device, str]) -> torch.nn.Module:
+    """
+    Fast model loading: fill a model built on the meta device with the memory-mapped checkpoint.
+
+    The random initialization of the weights is skipped (meta parameters have no data) and the
+    checkpoint is not copied into a temporary state dict: on CPU the parameters point directly
+    to the page cache of the checkpoint file (shared between processes loading the same file),
+    on GPU they are copied from the mapped file straight to the device.
+
+    Args:
+        args: Parsed command-line arguments containing the checkpoint path.
+        model: Model created under `with torch.device('meta')`.
+        device: Device of the loaded weights.
+
+    Returns:
+        The model with loaded weights on `device`.
+    """
+
+    print(f'Start from checkpoint (memory-mapped): {args.start_check_point}')
+    state_dict = torch.load(args.start_check_point, map_location=device, mmap=True, weights_only=True)
+    model.load_state_dict(state_dict, assign=True)
+    materialize_meta_buffers(model, device)
+    return model
+
+
+def get_int8_layer_names(model: torch.nn.Module) -> Set[str]:
+    """
+    Collect the names of the Linear layers that are quantized in INT8 CPU inference mode.
+
+    These are the attention `to_qkv`/`to_out` projections, the FeedForward layers and the
+    BandSplit/MaskEstimator MLPs. The tiny per-head `to_gates` projections are kept in float32,
+    they cost almost nothing and the sigmoid gating is sensitive to quantization noise.
+
+    Args:
+        model: PyTorch model to inspect.
+
+    Returns:
+        Set of submodule names accepted by `torch.ao.quantization.quantize_dynamic`.
+    """
+
+    return {
+        name for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and not name.endswith('to_gates')
+    }
+
+
+def quantize_model_int8(model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Apply dynamic INT8 quantization to the Linear layers of a model (CPU only).
+
+    Weights are stored as int8, activations are quantized on the fly per batch, so no
+    calibration data is needed.
+
+    Args:
+        model: PyTorch model in float32 on CPU.
+
+    Returns:
+        The quantized model.
+    """
+
+    model.eval()
+    return torch.ao.quantization.quantize_dynamic(model, get_int8_layer_names(model), dtype=torch.qint8)
+
+
+def get_checkpoint_cache_path(checkpoint_path: str, suffix: str, config: ConfigDict, options: Dict[str, Any]) -> str:
+    """
+    Return the path of a converted model stored next to the original checkpoint,
+    e.g. `models/logic_roformer.pt` -> `models/logic_roformer_int8_<hash>.pt` for suffix `int8`.
+
+    The hash covers `config.model` and the conversion `options`, so a model built from another
+    configuration or converted differently gets its own cache instead of loading a mismatched one.
+    """
+
+    settings = json.dumps([config.model.to_dict(), options], sort_keys=True, default=str)
+    digest = hashlib.sha1(settings.encode('utf-8')).hexdigest()[:12]
+    return os.path.splitext(checkpoint_path)[0] + f'_{suffix}_{digest}.pt'
+
+
+def is_checkpoint_cache_valid(cache_path: str, checkpoint_path: str) -> bool:
+    """
+    The cached model is valid while it is newer than the checkpoint it was made from.
+    """
+
+    return os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(checkpoint_path)
+
+
+def load_int8_checkpoint(args: argparse.Namespace, model: torch.nn.Module, config: ConfigDict) -> torch.nn.Module:
+    """
+    Load the starting checkpoint and return a dynamically INT8-quantized model.
+
+    The quantized state dict is cached next to the checkpoint. The cache is reused while it is
+    newer than the checkpoint and made for the same model configuration, so quantization only
+    happens on the first run.
+
+    Args:
+        args: Parsed command-line arguments containing the checkpoint path.
+        model: Freshly created float32 model.
+        config: Configuration the model was built from.
+
+    Returns:
+        The quantized model on CPU.
+    """
+
+    options = dict(model_type=args.model_type, dtype='qint8', layers=sorted(get_int8_layer_names(model)))
+    cache_path = get_checkpoint_cache_path(args.start_check_point, 'int8', config, options)
+    use_cache = not args.lora_checkpoint
+
+    if use_cache and is_checkpoint_cache_valid(cache_path, args.start_check_point):
+        print(f'Load INT8 model from cache: {cache_path}')
+        model = quantize_model_int8(model)
+        model.load_state_dict(torch.load(cache_path, map_location='cpu', weights_only=True))
+        return model
+
+    load_start_checkpoint(args, model, type_='inference')
+    model = quantize_model_int8(model)
+
+    if use_cache:
+        try:
+            torch.save(model.state_dict(), cache_path)
+            print(f'INT8 model cached to: {cache_path}')
+        except OSError as e:
+            print(f'Cannot cache INT8 model to {cache_path}: {e}')
+
+    return model
+
+
+def get_inference_precision(config: ConfigDict, device: Union[torch.device, str]) -> str:
+    """
+    Return the inference precision: one of 'fp32', 'bf16' or 'fp16'.
+
+    It is taken from `config.inference.precision`. If it is not set, the old behaviour is kept:
+    float16 autocast on CUDA when `config.training.use_amp` is enabled, float32 otherwise.
+    Half precision falls back to float32 on devices without autocast (e.g. MPS), where float32
+    inputs would meet half precision weights.
+
+    Args:
+        config: Configuration object containing inference settings.
+        device: Device used for inference.
+
+    Returns:
+        Name of the precision.
+    """
+
+    precision = getattr(config.inference, 'precision', None)
+    if precision is None:
+        use_amp = getattr(config.training, 'use_amp', True)
+        precision = 'fp16' if use_amp and torch.device(device).type == 'cuda' else 'fp32'
+    if precision not in PRECISION_DTYPES:
+        raise ValueError(f"Unknown precision: {precision}. Must be one of {list(PRECISION_DTYPES)}")
+    device_type = torch.device(device).type
+    if precision != 'fp32' and device_type not in AUTOCAST_DEVICE_TYPES:
+        print(f'Precision {precision} is not supported on {device_type}, use fp32')
+        precision = 'fp32'
+    return precision
+
+
+def cast_model_precision(model: torch.nn.Module, precision: str) -> torch.nn.Module:
+    """
+    Cast model weights to the given precision. Rotary embeddings are kept in float32,
+    their frequency tables lose the position information in half precision.
+
+    Args:
+        model: PyTorch model.
+        precision: One of 'fp32', 'bf16' or 'fp16'.
+
+    Returns:
+        The model with casted weights (modified in place).
+    """
+
+    from rotary_embedding_torch import RotaryEmbedding
+
+    model = model.to(PRECISION_DTYPES[precision])
+    for module in model.modules():
+        if isinstance(module, RotaryEmbedding):
+            module.float()
+    return model
+
+
+def load_half_checkpoint(args: argparse.Namespace, model: torch.nn.Module, precision: str,
+                         config: ConfigDict) -> torch.nn.Module:
+    """
+    Load the starting checkpoint into a model with bfloat16 or float16 weights.
+
+    A pre-cast copy of the weights is cached next to the checkpoint (half the size of the
+    float32 file) and reused while it is newer than the checkpoint and made for the same
+    model configuration.
+
+    Args:
+        args: Parsed command-line arguments containing the checkpoint path.
+        model: Freshly created float32 model.
+        precision: 'bf16' or 'fp16'.
+        config: Configuration the model was built from.
+
+    Returns:
+        The model with half precision weights.
+    """
+
+    options = dict(model_type=args.model_type, precision=precision)
+    cache_path = get_checkpoint_cache_path(args.start_check_point, precision, config, options)
+    use_cache = not args.lora_checkpoint
+
+    model = cast_model_precision(model, precision)
+
+    if use_cache and is_checkpoint_cache_valid(cache_path, args.start_check_point):
+        print(f'Load {precision} model from cache: {cache_path}')
+        model.load_state_dict(torch.load(cache_path, map_location='cpu', weights_only=True))
+        return model
+
+    load_start_checkpoint(args, model, type_='inference')
+
+    if use_cache:
+        try:
+            torch.save(model.state_dict(), cache_path)
+            print(f'{precision} model cached to: {cache_path}')
+        except OSError as e:
+            print(f'Cannot cache {precision} model to {cache_path}: {e}')
+
+    return model
+
+
+@contextmanager
+def preview_layers(model: torch.nn.Module, config: ConfigDict):
+    """
+    Run only a part of the transformer blocks of the model while the context is active (preview quality).
+
+    The blocks are chosen by `config.inference.preview_depth` (number of leading blocks, 0 or unset
+    means all of them) and `config.inference.preview_stride` (run every N-th of them, default 1).
+    The same checkpoint is used, all blocks are restored on exit. Models without `set_active_layers`
+    (everything except BSRoformer, ONNX Runtime) always run in full quality.
+    """
+
+    model = model.module if isinstance(model, nn.DataParallel) else model
+    depth = getattr(config.inference, 'preview_depth', 0) or None
+    stride = getattr(config.inference, 'preview_stride', 1) or 1
+
+    if not hasattr(model, 'set_active_layers') or (depth is None and stride == 1):
+        yield
+        return
+
+    previous = model.active_layers
+    model.set_active_layers(depth, stride)
+    try:
+        yield
+    finally:
+        model.active_layers = previous
+
+
+def setup_attention_backend(
+        model: torch.nn.Module,
+        config: ConfigDict,
+        device: Union[torch.device, str],
+        backend: str = 'auto',
+        cache_path: Optional[str] = None
+) -> None:
+    """
+    Choose the attention backend of the model for inference.
+
+    With 'auto' every available backend is benchmarked once on the real time-axis and band-axis
+    attention shapes of `config.audio.chunk_size` and the fastest one is used per axis. Backends that
+    build the full attention matrix are skipped when it does not fit, so long chunks fall back to the
+    memory efficient 'chunked' backend (block size `config.inference.attention_chunk_size`).
+    Otherwise the given backend is used for both axes. Models without attention backends are skipped.
+
+    Args:
+        model: PyTorch model (can be wrapped in DataParallel).
+        config: Configuration object containing audio and inference settings.
+        device: Device used for inference.
+        backend: 'auto' or the name of a backend from attention_backends.py.
+        cache_path: JSON file keeping the 'auto' benchmark results between runs (see `get_attention_cache_path`),
+            None to benchmark in every process.
+    """
+
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    if not hasattr(model, 'autotune_attention'):
+        return
+
+    # block size of the memory efficient 'chunked' backend
+    attention_chunk_size = getattr(config.inference, 'attention_chunk_size', 256)
+
+    if backend != 'auto':
+        from models.bs_roformer.attention_backends import available_backends
+
+        if backend not in available_backends(device):
+            # e.g. 'sage' without the sageattention package or without CUDA
+            print(f'Attention backend {backend} is not available on {device}, use the fastest available one')
+            backend = 'auto'
+
+    if backend != 'auto':
+        print(f'Attention backend: {backend}')
+        kwargs = dict(chunk_size=attention_chunk_size) if backend == 'chunked' else dict()
+        for axis in ['time', 'freq']:
+            model.set_attention_backend(axis, backend, **kwargs)
+        return
+
+    dtype = torch.float32
+    if torch.device(device).type in ['cuda', 'cpu']:
+        dtype = PRECISION_DTYPES[get_inference_precision(config, device)]
+
+    model.autotune_attention(
+        config.audio.chunk_size,
+        config.inference.batch_size,
+        device,
+        dtype=dtype,
+        attention_chunk_size=attention_chunk_size,
+        cache_path=cache_path
+    )
+
+
+def get_attention_cache_path(checkpoint_path: str) -> Optional[str]:
+    """
+    Return the file of the attention backend benchmark results, next to the checkpoint like the converted
+    models (e.g. `models/logic_roformer_attention.json`), or None without a checkpoint.
+    """
+
+    if not checkpoint_path:
+        return None
+    return os.path.splitext(checkpoint_path)[0] + '_attention.json'
+
+
+def fuse_model_attention(model: torch.nn.Module) -> None:
+    """
+    Replace the attention blocks of the model by their fused inference version, if the model has one.
+
+    The RMSNorm and the gate projection are folded into the qkv projection (one wider GEMM) and the
+    layout copies between the projections and the attention are removed, see `FusedAttention` in
+    bs_roformer.py. Blocks with LoRA or INT8 quantized projections are kept as they are.
+
+    Args:
+        model: PyTorch model (can be wrapped in DataParallel) with the checkpoint already loaded.
+    """
+
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    if not hasattr(model, 'fuse_attention'):
+        print('Fused attention is not supported by this model, skip it')
+        return
+
+    print(f'Fused attention blocks: {model.fuse_attention()}')
+
+
 def bind_lora_to_model(config: Dict[str, Any], model: nn.Module) -> nn.Module:
     """
     Replaces specific layers in the model with LoRA-extended versions.
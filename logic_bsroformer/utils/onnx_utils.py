@@ -0,0 +1,156 @@
+# coding: utf-8
+
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+from ml_collections import ConfigDict
+from typing import Tuple
+
+
+class BSRoformerCore(nn.Module):
+    """
+    Wrapper exposing only the pure tensor part of BSRoformer (band split -> transformers -> mask estimators)
+    as `forward`, so it can be traced and exported without STFT / complex operations.
+    """
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.model.forward_core(x)
+
+
+def get_onnx_path(checkpoint_path: str) -> str:
+    """
+    Return the default path of the exported core, stored next to the checkpoint,
+    e.g. `models/logic_roformer.pt` -> `models/logic_roformer.onnx`.
+    """
+
+    return os.path.splitext(checkpoint_path)[0] + '.onnx'
+
+
+def get_core_input_shape(model: nn.Module, config: ConfigDict, batch_size: int) -> Tuple[int, int, int]:
+    """
+    Compute the input shape (batch, frames, features) of the model core for one `chunk_size` chunk.
+    """
+
+    with torch.no_grad():
+        stft_repr = model.stft(torch.zeros(1, model.audio_channels, config.audio.chunk_size))
+    _, freqs, frames, complex_dim = stft_repr.shape
+    return batch_size, frames, freqs * complex_dim
+
+
+def export_onnx(model: nn.Module, config: ConfigDict, output_path: str, opset_version: int = 17) -> None:
+    """
+    Export the core of BSRoformer to ONNX for the fixed chunk shape of the config.
+    Only the batch dimension is dynamic, so the last (smaller) batch of `demix` can use the same graph.
+
+    Parameters:
+    ----------
+    model : nn.Module
+        BSRoformer model with loaded weights.
+    config : ConfigDict
+        Configuration object containing audio and inference settings.
+    output_path : str
+        Path of the resulting .onnx file.
+    opset_version : int, optional
+        ONNX opset. Default is 17.
+    """
+
+    model.eval()
+    input_shape = get_core_input_shape(model, config, config.inference.batch_size)
+    print(f"Export core with input shape: {input_shape}")
+
+    with torch.no_grad():
+        torch.onnx.export(
+            BSRoformerCore(model),
+            (torch.randn(input_shape),),
+            output_path,
+            input_names=['x'],
+            output_names=['mask'],
+            dynamic_axes={'x': {0: 'batch'}, 'mask': {0: 'batch'}},
+            opset_version=opset_version,
+            do_constant_folding=True,
+            dynamo=False,
+        )
+
+
+class OnnxRoformer:
+    """
+    Drop-in replacement of BSRoformer for `demix` on CPU. STFT and iSTFT run in torch,
+    the transformer core runs in an ONNX Runtime session. It does not need the model code
+    (einops, beartype, rotary embeddings) or the checkpoint, only the config and the .onnx file.
+    """
+
+    def __init__(self, onnx_path: str, config: ConfigDict, num_threads: int = 0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+        self.audio_channels = 2 if config.model.stereo else 1
+        self.num_stems = config.model.num_stems
+        self.stft_kwargs = dict(
+            n_fft=config.model.stft_n_fft,
+            hop_length=config.model.stft_hop_length,
+            win_length=config.model.stft_win_length,
+            normalized=config.model.stft_normalized
+        )
+        self.stft_window = torch.hann_window(config.model.stft_win_length)
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+    def stft(self, raw_audio: torch.Tensor) -> torch.Tensor:
+        # (b s t) -> (b (f s) t c), same layout as BSRoformer.stft
+        batch = raw_audio.shape[0]
+        stft_repr = torch.stft(
+            raw_audio.reshape(-1, raw_audio.shape[-1]), **self.stft_kwargs,
+            window=self.stft_window, return_complex=True
+        )
+        stft_repr = torch.view_as_real(stft_repr)
+        _, freqs, frames, _ = stft_repr.shape
+        stft_repr = stft_repr.reshape(batch, self.audio_channels, freqs, frames, 2).permute(0, 2, 1, 3, 4)
+        return stft_repr.reshape(batch, freqs * self.audio_channels, frames, 2)
+
+    def istft(self, stft_repr: torch.Tensor, mask: torch.Tensor, length: int) -> torch.Tensor:
+        # stft_repr (b (f s) t c), mask (b n t (f c)) -> (b n s t), same as BSRoformer.istft
+        batch, freqs, frames, _ = stft_repr.shape
+        num_stems = mask.shape[1]
+
+        mask = mask.reshape(batch, num_stems, frames, freqs, 2).permute(0, 1, 3, 2, 4).float()
+        stft_repr = torch.view_as_complex(stft_repr.contiguous()).unsqueeze(1) * \
+            torch.view_as_complex(mask.contiguous())
+
+        stft_repr = stft_repr.reshape(batch, num_stems, freqs // self.audio_channels, self.audio_channels, frames)
+        stft_repr = stft_repr.transpose(2, 3).reshape(-1, freqs // self.audio_channels, frames)
+
+        recon_audio = torch.istft(
+            stft_repr, **self.stft_kwargs, window=self.stft_window, return_complex=False, length=length
+        )
+        return recon_audio.reshape(batch, num_stems, self.audio_channels, -1)
+
+    def forward_core(self, x: torch.Tensor) -> torch.Tensor:
+        # x (b t (f c)) -> mask (b n t (f c)), same as BSRoformer.forward_core
+        mask = self.session.run(None, {self.input_name: np.ascontiguousarray(x.float().cpu().numpy())})[0]
+        return torch.from_numpy(mask)
+
+    def __call__(self, raw_audio: torch.Tensor) -> torch.Tensor:
+        raw_audio = raw_audio.float().cpu()
+        stft_repr = self.stft(raw_audio)
+        batch, freqs, frames, complex_dim = stft_repr.shape
+
+        x = stft_repr.transpose(1, 2).reshape(batch, frames, freqs * complex_dim)
+        mask = self.forward_core(x)
+
+        return self.istft(stft_repr, mask, raw_audio.shape[-1])
@@ -127,15 +127,13 @@ def parse_args_valid(dict_args: Union[Dict, None]) -> argparse.Namespace:
     return args
 
 
-def parse_args_inference(dict_args: Union[Dict, None]) -> argparse.Namespace:
+def get_inference_parser() -> argparse.ArgumentParser:
     """
-    Parse command-line arguments for configuring the model, dataset, and training parameters.
-
-    Args:
-        dict_args: Dict of command-line arguments. If None, arguments will be parsed from sys.argv.
+    Create the parser with the model loading and separation options of inference,
+    shared by `parse_args_inference` and `parse_args_server`.
 
     Returns:
-        Namespace object containing parsed arguments and their values.
+        ArgumentParser object with the inference arguments.
     """
     parser = argparse.ArgumentParser()
     parser.add_argument("--model_type", type=str, default='mdx23c',
@@ -144,6 +142,11 @@ def parse_args_inference(dict_args: Union[Dict, None]) -> argparse.Namespace:
     parser.add_argument("--config_path", type=str, help="path to config file")
     parser.add_argument("--start_check_point", type=str, default='', help="Initial checkpoint to valid weights")
     parser.add_argument("--input_folder", type=str, help="folder with mixtures to process")
+    parser.add_argument("--input_files", nargs='+', type=str, default=None,
+                        help="mixtures to process, instead of the files of --input_folder")
+    parser.add_argument("--input_list", type=str, default='',
+                        help="text file with one mixture path per line ('-' reads the list from stdin),"
+                             " instead of the files of --input_folder")
     parser.add_argument("--store_dir", type=str, default="", help="path to store results as wav file")
     parser.add_argument("--draw_spectro", type=float, default=0,
                         help="Code will generate spectrograms for resulted stems."
@@ -156,10 +159,266 @@ def parse_args_inference(dict_args: Union[Dict, None]) -> argparse.Namespace:
     parser.add_argument("--flac_file", action='store_true', help="Output flac file instead of wav")
     parser.add_argument("--pcm_type", type=str, choices=['PCM_16', 'PCM_24'], default='PCM_24',
                         help="PCM type for FLAC files (PCM_16 or PCM_24)")
+    parser.add_argument("--stems_npy", action='store_true',
+                        help="Write all stems of a track into one float16 stems.npy (with stems.json) instead of one"
+                             " file per stem, for intermediate stems which are read back with a memory map")
     parser.add_argument("--use_tta", action='store_true',
                         help="Flag adds test time augmentation during inference (polarity and channel inverse)."
                         "While this triples the runtime, it reduces noise and slightly improves prediction quality.")
     parser.add_argument("--lora_checkpoint", type=str, default='', help="Initial checkpoint to LoRA weights")
+    parser.add_argument("--quantize_int8", action='store_true',
+                        help="Use dynamic INT8 quantization of Linear layers (CPU only). Quantized model is cached"
+                             " next to the checkpoint.")
+    parser.add_argument("--precision", type=str, choices=['fp32', 'bf16', 'fp16'], default=None,
+                        help="Inference precision. bf16/fp16 use autocast on CPU or GPU and half precision weights"
+                             " (cached next to the checkpoint). By default fp16 autocast is used on GPU if"
+                             " use_amp is enabled in config, fp32 otherwise. Other devices (e.g. MPS) run fp32.")
+    parser.add_argument("--attention_backend", type=str, default='auto',
+                        choices=['auto', 'sdpa', 'sdpa_flash', 'sdpa_efficient', 'sdpa_math', 'sage', 'einsum',
+                                 'chunked'],
+                        help="Attention implementation. 'auto' benchmarks available backends once at model load"
+                             " on the real time and band axis shapes and uses the fastest one per axis. The results"
+                             " are kept next to the checkpoint (<checkpoint>_attention.json) for the next runs.")
+    parser.add_argument("--onnx_model", type=str, default='',
+                        help="Run the model core with ONNX Runtime on CPU using this .onnx file (see export_onnx.py)."
+                             " Only bs_roformer is supported.")
+    parser.add_argument("--onnx_threads", type=int, default=0,
+                        help="Number of ONNX Runtime intra-op threads. 0 means ONNX Runtime default")
+    parser.add_argument("--fast_load", action='store_true',
+                        help="Build the model without random init and memory-map the checkpoint. Faster startup and"
+                             " lower peak RAM, on CPU processes share the weights in page cache. Only for float32"
+                             " checkpoints without INT8, half precision or LoRA")
+    parser.add_argument("--preview_depth", type=int, default=0,
+                        help="Preview quality: run only the first N transformer blocks of bs_roformer with the same"
+                             " checkpoint. 0 means all blocks (full quality)")
+    parser.add_argument("--preview_stride", type=int, default=1,
+                        help="Preview quality: run only every N-th transformer block, e.g. 2 for every other block")
+    parser.add_argument("--tf_chunking", action='store_true',
+                        help="Compute the STFT of the whole track once and chunk the spectrogram instead of the audio,"
+                             " with one iSTFT per stem at the end (bs_roformer and ONNX Runtime only)")
+    parser.add_argument("--decode_threads", type=int, default=1,
+                        help="Threads decoding the next input files while the current one is separated,"
+                             " 0 decodes in the main thread")
+    parser.add_argument("--stream_input", action='store_true',
+                        help="Read the input files chunk by chunk during the separation instead of loading them"
+                             " whole (for very long tracks, not with normalization or TTA)")
+    parser.add_argument("--spectro_workers", type=int, default=None,
+                        help="Processes drawing the spectrograms of --draw_spectro, 0 draws them in the main process."
+                             " Default: 1, or 0 on a single CPU")
+    parser.add_argument("--memory_budget", type=float, default=0,
+                        help="RAM budget in GB for the separation of a track (0 = no budget). Above it the"
+                             " overlap-add accumulators are memory-mapped to files in --scratch_dir")
+    parser.add_argument("--memmap_accumulators", action='store_true',
+                        help="Always memory-map the overlap-add accumulators to files in --scratch_dir, for tracks"
+                             " longer than the RAM allows (with --stream_input for the input)")
+    parser.add_argument("--scratch_dir", type=str, default='',
+                        help="Directory of the memory-mapped accumulators (default: system temp directory)")
+    parser.add_argument("--writer_threads", type=int, default=2,
+                        help="Threads writing (FLAC encoding) the stems of a track while the next one is"
+                             " separated, 0 writes in the main thread")
+    parser.add_argument("--fused_attention", action='store_true',
+                        help="Fold the norm and the gates into the qkv projection of every attention block"
+                             " (inference only, same outputs, bs_roformer only). The fused qkv weights (about 5%%"
+                             " of the model) are new tensors, with --fast_load they are not shared between processes")
+    parser.add_argument("--resume_dir", type=str, default='',
+                        help="Checkpoint the separation of every track in this directory (memory-mapped"
+                             " accumulators and chunk cursor), a restart with the same input, model and config"
+                             " resumes from the last checkpoint. Not with --tf_chunking")
+    parser.add_argument("--checkpoint_interval", type=float, default=60,
+                        help="Seconds between two checkpoints of --resume_dir")
+    parser.add_argument("--resume_min_seconds", type=float, default=0,
+                        help="Only checkpoint tracks at least this long with --resume_dir, shorter ones are"
+                             " separated in memory and redone after a crash")
+    parser.add_argument("--manifest", type=str, default='',
+                        help="SQLite manifest of the processed input files (created if missing). Only new, changed"
+                             " or failed files of --input_folder are processed, with status and timings recorded")
+    parser.add_argument("--watch", type=float, default=0,
+                        help="With --manifest, poll --input_folder every N seconds for new files until interrupted")
+    parser.add_argument("--max_attempts", type=int, default=3,
+                        help="With --manifest, number of times a failing file is processed before giving up")
+    return parser
+
+
+def parse_args_inference(dict_args: Union[Dict, None]) -> argparse.Namespace:
+    """
+    Parse command-line arguments for configuring the model, dataset, and training parameters.
+
+    Args:
+        dict_args: Dict of command-line arguments. If None, arguments will be parsed from sys.argv.
+
+    Returns:
+        Namespace object containing parsed arguments and their values.
+    """
+    parser = get_inference_parser()
+
+    if dict_args is not None:
+        args = parser.parse_args([])
+        args_dict = vars(args)
+        args_dict.update(dict_args)
+        args = argparse.Namespace(**args_dict)
+    else:
+        args = parser.parse_args()
+
+    return args
+
+
+def parse_args_server(dict_args: Union[Dict, None]) -> argparse.Namespace:
+    """
+    Parse command-line arguments for the local separation server: all inference options
+    plus the address, the number of warm models and the queue size.
+
+    Args:
+        dict_args: Dict of command-line arguments. If None, arguments will be parsed from sys.argv.
+
+    Returns:
+        Namespace object containing parsed arguments and their values.
+    """
+    parser = get_inference_parser()
+    parser.add_argument("--host", type=str, default='127.0.0.1', help="Address of the HTTP server")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the HTTP server")
+    parser.add_argument("--unix_socket", type=str, default='',
+                        help="Serve HTTP on this Unix socket path instead of host:port")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of warm model instances, each one separates one job at a time")
+    parser.add_argument("--max_queue", type=int, default=8,
+                        help="Maximum number of waiting jobs. New jobs are rejected with 503 when the queue is full")
+    parser.add_argument("--stub_model", action='store_true',
+                        help="Use a stub model which splits the mixture evenly into stems, no checkpoint or"
+                             " model code is needed (for testing)")
+
+    if dict_args is not None:
+        args = parser.parse_args([])
+        args_dict = vars(args)
+        args_dict.update(dict_args)
+        args = argparse.Namespace(**args_dict)
+    else:
+        args = parser.parse_args()
+
+    return args
+
+
+def parse_args_benchmark(dict_args: Union[Dict, None]) -> argparse.Namespace:
+    """
+    Parse command-line arguments for comparing an optimized inference mode against the float32 reference.
+
+    Args:
+        dict_args: Dict of command-line arguments. If None, arguments will be parsed from sys.argv.
+
+    Returns:
+        Namespace object containing parsed arguments and their values.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", type=str, default='bs_roformer', help="Model type, e.g. bs_roformer")
+    parser.add_argument("--config_path", type=str, help="path to config file")
+    parser.add_argument("--start_check_point", type=str, default='', help="Checkpoint of the reference model")
+    parser.add_argument("--input_folder", type=str, help="folder with mixtures used for the comparison")
+    parser.add_argument("--max_seconds", type=float, default=30,
+                        help="Only the first N seconds of every track are used. 0 means whole track")
+    parser.add_argument("--device_ids", nargs='+', type=int, default=0, help='list of gpu ids')
+    parser.add_argument("--force_cpu", action='store_true', help="Force the use of CPU even if CUDA is available")
+    parser.add_argument("--lora_checkpoint", type=str, default='', help="Initial checkpoint to LoRA weights")
+    parser.add_argument("--quantize_int8", action='store_true',
+                        help="Compare dynamic INT8 quantized model against float32 (CPU only)")
+    parser.add_argument("--precision", type=str, nargs='+', choices=['bf16', 'fp16'], default=[],
+                        help="Compare half precision inference against float32")
+    parser.add_argument("--preview_depth", type=int, nargs='+', default=[],
+                        help="Compare preview quality with only the first N transformer blocks against all blocks")
+    parser.add_argument("--preview_stride", type=int, default=1,
+                        help="Run only every N-th of the first --preview_depth transformer blocks")
+    parser.add_argument("--student_config_path", type=str, default='',
+                        help="Compare a distilled student model (see distill.py) against the reference")
+    parser.add_argument("--student_check_point", type=str, default='', help="Checkpoint of the student model")
+
+    if dict_args is not None:
+        args = parser.parse_args([])
+        args_dict = vars(args)
+        args_dict.update(dict_args)
+        args = argparse.Namespace(**args_dict)
+    else:
+        args = parser.parse_args()
+
+    return args
+
+
+def parse_args_export_onnx(dict_args: Union[Dict, None]) -> argparse.Namespace:
+    """
+    Parse command-line arguments for exporting the model core to ONNX.
+
+    Args:
+        dict_args: Dict of command-line arguments. If None, arguments will be parsed from sys.argv.
+
+    Returns:
+        Namespace object containing parsed arguments and their values.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", type=str, default='bs_roformer', help="Only bs_roformer is supported")
+    parser.add_argument("--config_path", type=str, help="path to config file")
+    parser.add_argument("--start_check_point", type=str, default='', help="Checkpoint to export")
+    parser.add_argument("--output_path", type=str, default='',
+                        help="Path of the .onnx file. By default it is stored next to the checkpoint")
+    parser.add_argument("--opset_version", type=int, default=17, help="ONNX opset version")
+    parser.add_argument("--lora_checkpoint", type=str, default='', help="Initial checkpoint to LoRA weights")
+
+    if dict_args is not None:
+        args = parser.parse_args([])
+        args_dict = vars(args)
+        args_dict.update(dict_args)
+        args = argparse.Namespace(**args_dict)
+    else:
+        args = parser.parse_args()
+
+    return args
+
+
+def parse_args_distill(dict_args: Union[Dict, None]) -> argparse.Namespace:
+    """
+    Parse command-line arguments for distilling a large teacher model into a compact student.
+
+    Args:
+        dict_args: Dict of command-line arguments. If None, arguments will be parsed from sys.argv.
+
+    Returns:
+        Namespace object containing parsed arguments and their values.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", type=str, default='bs_roformer',
+                        help="Model type of teacher and student, e.g. bs_roformer")
+    parser.add_argument("--teacher_config_path", type=str, default='configs/logic_pro_config_v1.yaml',
+                        help="path to config file of the teacher")
+    parser.add_argument("--teacher_check_point", type=str, default='models/logic_roformer.pt',
+                        help="Checkpoint of the teacher")
+    parser.add_argument("--config_path", type=str, default='configs/logic_pro_config_student.yaml',
+                        help="path to config file of the student")
+    parser.add_argument("--start_check_point", type=str, default='', help="Initial checkpoint of the student")
+    parser.add_argument("--results_path", type=str,
+                        help="path to folder where results will be stored (weights, metadata)")
+    parser.add_argument("--data_path", nargs="+", type=str, default=None,
+                        help="Dataset data paths. If not set, random synthetic mixtures are used")
+    parser.add_argument("--dataset_type", type=int, default=1,
+                        help="Dataset type. Must be one of: 1, 2, 3 or 4. Details here: https://github.com/ZFTurbo/Music-Source-Separation-Training/blob/main/docs/dataset_types.md")
+    parser.add_argument("--valid_path", type=str, default='',
+                        help="folder with mixtures for the final speed/SDR report. If not set, synthetic mixtures are used")
+    parser.add_argument("--max_seconds", type=float, default=30,
+                        help="Only the first N seconds of every report track are used. 0 means whole track")
+    parser.add_argument("--num_epochs", type=int, default=0, help="Number of epochs. 0 means value from config")
+    parser.add_argument("--num_steps", type=int, default=0, help="Steps per epoch. 0 means value from config")
+    parser.add_argument("--num_workers", type=int, default=0, help="dataloader num_workers")
+    parser.add_argument("--pin_memory", action='store_true', help="dataloader pin_memory")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--device_ids", nargs='+', type=int, default=[0], help='list of gpu ids')
+    parser.add_argument("--force_cpu", action='store_true', help="Force the use of CPU even if CUDA is available")
+    parser.add_argument("--loss", type=str, nargs='+', choices=['masked_loss', 'mse_loss', 'l1_loss',
+                        'multistft_loss', 'spec_masked_loss', 'spec_rmse_loss_coef', 'log_wmse_loss'],
+                        default=['l1_loss'], help="List of loss functions between student and teacher outputs")
+    parser.add_argument("--masked_loss_coef", type=float, default=1., help="Coef for loss")
+    parser.add_argument("--mse_loss_coef", type=float, default=1., help="Coef for loss")
+    parser.add_argument("--l1_loss_coef", type=float, default=1., help="Coef for loss")
+    parser.add_argument("--log_wmse_loss_coef", type=float, default=1., help="Coef for loss")
+    parser.add_argument("--multistft_loss_coef", type=float, default=0.001, help="Coef for loss")
+    parser.add_argument("--spec_masked_loss_coef", type=float, default=1, help="Coef for loss")
+    parser.add_argument("--spec_rmse_loss_coef", type=float, default=1, help="Coef for loss")
+    parser.add_argument("--ground_truth_coef", type=float, default=0.,
+                        help="Weight of the same loss against the dataset stems. 0 trains on teacher outputs only")
 
     if dict_args is not None:
         args = parser.parse_args([])
@@ -464,7 +723,7 @@ def prepare_data_ddp(config: Dict, args: argparse.Namespace, batch_size: int, ra
         config,
         args.data_path,
         batch_size=world_size * batch_size, # to use self.config.training.num_steps without reduction
-        metadata_path=os.path.join(args.results_path, f'metadata_{args.dataset_type}.pkl'),
+        metadata_path=os.path.join(args.results_path, 'metadata.db'),
         dataset_type=args.dataset_type,
     )
 
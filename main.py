@@ -1,8 +1,12 @@
-import shutil
 import subprocess
 import os
 import sys
 import gc
+import json
+from math import gcd
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
 from pydub import AudioSegment
 from tkinter import Tk, filedialog
 
@@ -163,9 +167,103 @@ def remix_channels(input_dir, output_file, channel_count):
     gc.collect()
 
 
-def separate_audio(input_dir, hardware_choice):
+# 各输出声道由哪些分离音频的哪个声道平均得到（0 左声道，1 右声道，None 左右声道平均），与 remix_channels 相同
+SURROUND_LAYOUTS = {
+    5: [
+        [("drums", 0)],  # 左前
+        [("drums", 1)],  # 右前
+        [("vocals", None)],  # 中置
+        [("bass", None)],  # 低音
+        [("piano", 0), ("guitar", 0), ("instrumental", 0), ("other", 0), ("vocals", 0)],  # 左后
+        [("piano", 1), ("guitar", 1), ("instrumental", 1), ("other", 1), ("vocals", 1)],  # 右后
+    ],
+    7: [
+        [("drums", 0)],  # 左前
+        [("drums", 1)],  # 右前
+        [("vocals", None)],  # 中置
+        [("bass", None)],  # 低音
+        [("instrumental", 0), ("piano", 0), ("vocals", 0)],  # 左后
+        [("instrumental", 1), ("piano", 1), ("vocals", 1)],  # 右后
+        [("guitar", 0), ("other", 0), ("instrumental", 0), ("vocals", 0)],  # 左后环绕
+        [("guitar", 1), ("other", 1), ("instrumental", 1), ("vocals", 1)],  # 右后环绕
+    ],
+}
+
+
+def remix_stems_npy(input_dir, output_file, channel_count, sample_rate=48000, block_size=2 ** 18):
+    """
+    与 remix_channels 相同的混音，输入为 inference.py --stems_npy 写出的 stems.npy（float16）。
+    分离音频以内存映射读取，按块混音、重采样并写入 FLAC，内存占用与音频长度无关。
+    """
+    print(f"开始混音为 {channel_count}.1 通道，由 {input_dir} 到 {output_file}")
+
+    with open(os.path.join(input_dir, "stems.json")) as f:
+        info = json.load(f)
+    stems = dict(zip(info["stems"], np.load(os.path.join(input_dir, "stems.npy"), mmap_mode="r")))
+    layout = SURROUND_LAYOUTS[channel_count]
+
+    g = gcd(sample_rate, info["sample_rate"])
+    up, down = sample_rate // g, info["sample_rate"] // g
+    # 每块前后多读的采样数，保证分块重采样与整段重采样结果一致
+    margin = 16 * down
+    block_size = block_size // down * down
+    length = stems[info["stems"][0]].shape[-1]
+
+    def mix_channels(start, end):
+        out = np.empty((len(layout), end - start), dtype=np.float32)
+        for i, sources in enumerate(layout):
+            out[i] = 0
+            for name, channel in sources:
+                part = stems[name][:, start:end] if channel is None else stems[name][channel:channel + 1, start:end]
+                out[i] += part.mean(axis=0, dtype=np.float32)
+            out[i] /= len(sources)
+        return out
+
+    with sf.SoundFile(output_file, "w", sample_rate, len(layout), subtype="PCM_24", format="FLAC") as f:
+        for start in range(0, length, block_size):
+            end = min(start + block_size, length)
+            if up == down:
+                y = mix_channels(start, end)
+            else:
+                a, b = max(start - margin, 0), min(end + margin, length)
+                y = resample_poly(mix_channels(a, b), up, down, axis=-1)
+                offset = (start - a) * up // down
+                y = y[:, offset:] if end == length else y[:, offset:offset + (end - start) * up // down]
+            f.write(np.clip(y, -1, 1).T)
+            update_progress(end, length)
+    print()
+
+    gc.collect()
+
+
+def remix_separated(input_dir, output_file, channel_count):
+    # 优先使用 stems.npy，旧版本分离的 wav 文件仍用 pydub 混音
+    if os.path.isfile(os.path.join(input_dir, "stems.npy")):
+        remix_stems_npy(input_dir, output_file, channel_count)
+    else:
+        remix_channels(input_dir, output_file, channel_count)
+
+
+# 预览质量只运行前 6 个 transformer 块（共 12 个），同一模型，速度约快一倍
+PREVIEW_DEPTH = 6
+
+
+def get_separate_root(quality_choice):
+    # 预览的分离结果单独存放，不会被完整质量当作已分离的文件复用
+    return os.path.join("temp", "separate_preview" if quality_choice == "2" else "separate")
+
+
+def get_output_suffix(channel_count, quality_choice):
+    # 预览的输出文件单独命名，之后以完整质量处理时不会因已存在而被跳过
+    return f"_{channel_count}.1_preview.flac" if quality_choice == "2" else f"_{channel_count}.1.flac"
+
+# 只为较长的音频保存分离进度（程序中断后可继续），普通歌曲直接在内存中分离，不产生大的临时文件
+RESUME_MIN_SECONDS = 15 * 60
+
+
+def separate_audio(input_list, hardware_choice, quality_choice="1"):
     os.environ["TORCH_HOME"] = "./model"
-    tempPath = "./temp/separate"
+    tempPath = get_separate_root(quality_choice)
     if not os.path.exists(tempPath):
         os.mkdir(tempPath)
 
@@ -180,11 +278,18 @@ def separate_audio(input_dir, hardware_choice):
             "logic_bsroformer\\configs/logic_pro_config_v1.yaml",
             "--start_check_point",
             "logic_bsroformer\\models/logic_roformer.pt",
-            "--input_folder",
-            os.path.dirname(input_dir),
+            "--input_list",
+            input_list,
             "--store_dir",
             tempPath,
             "--extract_instrumental",
+            "--fast_load",
+            "--fused_attention",
+            "--resume_dir",
+            "./temp/resume",
+            "--resume_min_seconds",
+            str(RESUME_MIN_SECONDS),
+            "--stems_npy",
         ]
     elif hardware_choice == "2":
         args = [
@@ -196,16 +301,26 @@ def separate_audio(input_dir, hardware_choice):
             "logic_bsroformer\\configs/logic_pro_config_v1.yaml",
             "--start_check_point",
             "logic_bsroformer\\models/logic_roformer.pt",
-            "--input_folder",
-            os.path.dirname(input_dir),
+            "--input_list",
+            input_list,
             "--store_dir",
             tempPath,
             "--extract_instrumental",
+            "--fast_load",
+            "--fused_attention",
+            "--resume_dir",
+            "./temp/resume",
+            "--resume_min_seconds",
+            str(RESUME_MIN_SECONDS),
+            "--stems_npy",
             "--force_cpu",
         ]
     else:
         args = []
 
+    if args and quality_choice == "2":
+        args += ["--preview_depth", str(PREVIEW_DEPTH)]
+
     if args:
         print(f"执行命令: {' '.join(args)}")
         result = subprocess.run(args, check=True)
@@ -225,6 +340,7 @@ def delete_files_only(folder_path):
 def main(isContinue=0):
     hardware_choice = ""
     choice = ""
+    quality_choice = "1"
     if isContinue == 0 or isContinue == 2:
         print("立体声转5.1声道&7.1声道混音工具 v2.0 by 陈缘科技")
         print()
@@ -241,6 +357,11 @@ def main(isContinue=0):
             print("\n输入错误，请重新输入")
             main(2)
 
+        quality_choice = input("请选择分离质量：\n1. 完整质量（默认）\n2. 快速预览\n> ") or "1"
+        if quality_choice not in ["1", "2"]:
+            print("\n输入错误，请重新输入")
+            main(2)
+
     elif isContinue == 1:
         print("继续处理...")
 
@@ -255,38 +376,34 @@ def main(isContinue=0):
     print("请选择输出目录")
     output_directory = filedialog.askdirectory(title="选择输出目录", initialdir=".")
 
+    temp_dir = "temp"
+    os.makedirs(temp_dir, exist_ok=True)
+    # 清理旧版本复制到临时目录的音频文件
+    delete_files_only(temp_dir)
+
+    channel_count = 5 if choice == "1" else 7
+    to_separate = []
+    to_remix = []
     for filename in os.listdir(input_directory):
         file_path = os.path.join(input_directory, filename)
         if not os.path.isfile(file_path):
             print(f"跳过子文件夹: {filename}")
             continue
 
-        temp_dir = "temp"
-        os.makedirs(temp_dir, exist_ok=True)
-        temp_file_path = os.path.join(temp_dir, filename)
-
-        # 删除临时目录中的复制音频文件
-        delete_files_only(temp_dir)
-
-        # 复制文件到临时目录
-        shutil.copy(file_path, temp_file_path)
-
-        isfull = False
+        # 与 inference.py 的输出目录同名
+        separate_dir = os.path.join(get_separate_root(quality_choice), os.path.splitext(filename)[0])
 
         # 检查输出目录下是否已存在最终输出的音频文件
         output_file_51 = os.path.join(
-            output_directory, filename.split(".")[0] + "_5.1.flac"
+            output_directory, filename.split(".")[0] + get_output_suffix(5, quality_choice)
         )
         output_file_71 = os.path.join(
-            output_directory, filename.split(".")[0] + "_7.1.flac"
+            output_directory, filename.split(".")[0] + get_output_suffix(7, quality_choice)
         )
         if os.path.isfile(output_file_51) or os.path.isfile(output_file_71):
             print(f"最终输出的音频文件已存在，跳过文件: {filename}")
 
-            delete_files_only(temp_dir)
-
             # 清理分离后的音频文件
-            separate_dir = os.path.join(temp_dir, "separate", filename.split(".")[0])
             if os.path.exists(separate_dir):
                 delete_files_only(separate_dir)
                 os.rmdir(separate_dir)
@@ -294,8 +411,9 @@ def main(isContinue=0):
 
             continue
 
-        print(f"正在处理文件: {filename}")
+        to_remix.append((filename, separate_dir))
 
+        isfull = False
         for sound in [
             "vocals.wav",
             "bass.wav",
@@ -304,50 +422,42 @@ def main(isContinue=0):
             "instrumental.wav",
             "piano.wav",
             "other.wav",
+            "stems.npy",
         ]:
-            if os.path.isfile(
-                os.path.join(temp_dir, "separate", filename.split(".")[0], sound)
-            ):
+            if os.path.isfile(os.path.join(separate_dir, sound)):
                 isfull = True
                 print(f"{filename} 分离音频文件 {sound} 已存在，跳过分离")
 
         if not isfull:
-            separate_audio(
-                temp_file_path,
-                hardware_choice,
-            )
-
-        if choice == "1":
-            output_file = os.path.join(
-                output_directory, filename.split(".")[0] + "_5.1.flac"
-            )
-            if not os.path.isfile(output_file):
-                remix_channels(
-                    os.path.join(temp_dir, "separate", filename.split(".")[0]),
-                    output_file,
-                    5,
-                )
-            else:
-                print(f"\n5.1混音已存在，请查看输出文件 {output_file}")
-
-        elif choice == "2":
-            output_file = os.path.join(
-                output_directory, filename.split(".")[0] + "_7.1.flac"
-            )
-            if not os.path.isfile(output_file):
-                remix_channels(
-                    os.path.join(temp_dir, "separate", filename.split(".")[0]),
-                    output_file,
-                    7,
-                )
-            else:
-                print(f"\n7.1混音已存在，请查看输出文件 {output_file}")
+            to_separate.append(file_path)
+
+    # 所有需要分离的文件以列表交给 inference.py，直接读取原文件，模型只加载一次
+    if to_separate:
+        input_list = os.path.join(temp_dir, "input_list.txt")
+        with open(input_list, "w", encoding="utf-8") as f:
+            f.write("\n".join(to_separate) + "\n")
+        separate_audio(input_list, hardware_choice, quality_choice)
+
+    for filename, separate_dir in to_remix:
+        print(f"正在处理文件: {filename}")
 
-        delete_files_only(temp_dir)
-        print("temp 中留有分离的音频文件，可自行删除，或者程序再次运行将自动清理")
+        if not any(os.path.isfile(os.path.join(separate_dir, f)) for f in ["stems.npy", "vocals.wav"]):
+            print(f"{filename} 分离失败，跳过混音")
+            continue
+
+        output_file = os.path.join(
+            output_directory, filename.split(".")[0] + get_output_suffix(channel_count, quality_choice)
+        )
+        if not os.path.isfile(output_file):
+            remix_separated(separate_dir, output_file, channel_count)
+        else:
+            print(f"\n{channel_count}.1混音已存在，请查看输出文件 {output_file}")
 
         gc.collect()
 
+    delete_files_only(temp_dir)
+    print("temp 中留有分离的音频文件，可自行删除，或者程序再次运行将自动清理")
+
     input("按任意键退出...")
 
 
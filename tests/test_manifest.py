@@ -0,0 +1,53 @@
+import os
+import sys
+
+logic_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logic_bsroformer')
+sys.path.insert(0, logic_dir)
+
+from utils.manifest import Manifest  # noqa: E402
+
+
+def write_file(path, data=b'audio'):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def test_removed_file_is_not_pending(tmp_path):
+    folder = tmp_path / 'in'
+    folder.mkdir()
+    path = write_file(folder / 'song.wav')
+    manifest = Manifest(str(tmp_path / 'manifest.db'))
+
+    assert manifest.scan(str(folder)) == 1
+    assert manifest.pending() == [path]
+
+    os.remove(path)
+    assert not manifest.start(path)
+    assert manifest.pending() == []
+
+    # later watch cycles do not bring it back
+    manifest.scan(str(folder))
+    assert manifest.pending() == []
+
+    # processed again once it is back
+    write_file(path)
+    assert manifest.scan(str(folder)) == 1
+    assert manifest.pending() == [path]
+    assert manifest.start(path)
+    manifest.close()
+
+
+def test_failed_file_is_retried_up_to_max_attempts(tmp_path):
+    folder = tmp_path / 'in'
+    folder.mkdir()
+    path = write_file(folder / 'song.wav')
+    manifest = Manifest(str(tmp_path / 'manifest.db'), max_attempts=2)
+    manifest.scan(str(folder))
+
+    for _ in range(2):
+        assert manifest.pending() == [path]
+        assert manifest.start(path)
+        manifest.fail(path, ValueError('cannot decode'))
+    assert manifest.pending() == []
+    manifest.close()
@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import base64
+import threading
+import http.client
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+logic_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logic_bsroformer')
+sys.path.insert(0, logic_dir)
+
+from separation_server import Job, SeparationHandler, SeparationService  # noqa: E402
+from utils.settings import parse_args_server  # noqa: E402
+
+SAMPLE_RATE = 44100
+INSTRUMENTS = ['bass', 'drums', 'other', 'vocals', 'guitar', 'piano']
+
+
+@pytest.fixture
+def make_server(tmp_path):
+    servers = []
+
+    def make_server(**options):
+        args = dict(
+            model_type='bs_roformer',
+            config_path=os.path.join(logic_dir, 'configs', 'logic_pro_config_v1.yaml'),
+            stub_model=True,
+            store_dir=str(tmp_path / 'out'),
+        )
+        args.update(options)
+        service = SeparationService(parse_args_server(args))
+        handler = type('TestHandler', (SeparationHandler,), dict(service=service))
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, service
+
+    yield make_server
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def post(server, body, content_type='application/json', query=''):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=60)
+    if isinstance(body, dict):
+        body = json.dumps(body).encode('utf-8')
+    connection.request('POST', '/separate' + query, body=body, headers={'Content-Type': content_type})
+    response = connection.getresponse()
+    data = response.read()
+    connection.close()
+    return response, data
+
+
+def read_events(data):
+    return [json.loads(line) for line in data.decode('utf-8').splitlines()]
+
+
+def write_mix(tmp_path, seconds=1.0):
+    rng = np.random.default_rng(0)
+    mix = (rng.standard_normal((int(SAMPLE_RATE * seconds), 2)) * 0.1).astype(np.float32)
+    path = str(tmp_path / 'mix.wav')
+    sf.write(path, mix, SAMPLE_RATE, subtype='FLOAT')
+    return path, mix
+
+
+def test_path_job(make_server, tmp_path):
+    server, _ = make_server()
+    input_path, mix = write_mix(tmp_path)
+
+    response, data = post(server, dict(input_path=input_path, store_dir='job', stems=['vocals', 'bass']))
+    assert response.status == 200
+    assert response.getheader('Content-Type') == 'application/x-ndjson'
+
+    events = read_events(data)
+    assert [event['event'] for event in events] == ['queued', 'started', 'stem', 'stem', 'done']
+    stems = {event['stem']: event['path'] for event in events if event['event'] == 'stem'}
+    assert set(stems) == {'vocals', 'bass'}
+    for stem, path in stems.items():
+        assert path == str(tmp_path / 'out' / 'job' / 'mix' / f'{stem}.wav')
+        audio, sr = sf.read(path, dtype='float32')
+        assert sr == SAMPLE_RATE
+        assert audio.shape == mix.shape
+        np.testing.assert_allclose(audio, mix / len(INSTRUMENTS), atol=1e-5)
+
+
+@pytest.mark.parametrize('channels, dtype', [(2, 'float32'), (1, 'int16')])
+def test_pcm_round_trip(make_server, channels, dtype):
+    server, _ = make_server()
+    rng = np.random.default_rng(0)
+    mix = (rng.standard_normal((SAMPLE_RATE // 2, channels)) * 0.1).astype(np.float32)
+    if dtype == 'int16':
+        mix = np.round(mix * 32768.0).astype(np.int16)
+
+    query = f'?sample_rate={SAMPLE_RATE}&channels={channels}&dtype={dtype}&stems=vocals,drums'
+    response, data = post(server, mix.tobytes(), 'application/octet-stream', query)
+    assert response.status == 200
+
+    stems = [event for event in read_events(data) if event['event'] == 'stem']
+    assert [stem['stem'] for stem in stems] == ['vocals', 'drums']
+    for stem in stems:
+        assert (stem['sample_rate'], stem['channels'], stem['dtype']) == (SAMPLE_RATE, channels, dtype)
+        audio = np.frombuffer(base64.b64decode(stem['data']), dtype=mix.dtype).reshape(-1, channels)
+        assert audio.shape == mix.shape
+        np.testing.assert_allclose(audio.astype(np.float32), mix / len(INSTRUMENTS), atol=2)
+
+
+def test_queue_full(make_server, tmp_path):
+    server, service = make_server(max_queue=1)
+    input_path, _ = write_mix(tmp_path)
+    release = threading.Event()
+    service.run_job = lambda job, *args: release.wait(60)
+
+    try:
+        running = Job(dict(input_path=input_path))
+        assert service.submit(running)
+        assert running.events.get(timeout=60)['event'] == 'queued'
+        assert running.events.get(timeout=60)['event'] == 'started'
+        assert service.submit(Job(dict(input_path=input_path)))
+
+        response, data = post(server, dict(input_path=input_path))
+        assert response.status == 503
+        assert response.getheader('Retry-After') == '1'
+        assert json.loads(data)['queued'] == 1
+    finally:
+        release.set()
+
+
+@pytest.mark.parametrize('request_options', [
+    dict(store_dir='../evil'),
+    dict(store_dir='job/../../evil'),
+    dict(store_dir='/tmp/evil'),
+    dict(format='exe'),
+    dict(input_path='missing.wav'),
+])
+def test_rejected_requests(make_server, tmp_path, request_options):
+    server, _ = make_server()
+    input_path, _ = write_mix(tmp_path)
+
+    response, data = post(server, dict(dict(input_path=input_path), **request_options))
+    assert response.status == 400
+    assert 'error' in json.loads(data)
+    assert not (tmp_path / 'evil').exists()
+
+
+@pytest.mark.parametrize('query', [
+    '?sample_rate=abc',
+    '?sample_rate=0',
+    '?sample_rate=-44100',
+    '?layout=rows',
+    '?dtype=float64',
+    '?channels=3',
+    '?stems=kazoo',
+])
+def test_rejected_pcm_requests(make_server, query):
+    server, service = make_server()
+
+    response, data = post(server, np.zeros(1024, dtype=np.float32).tobytes(), 'application/octet-stream', query)
+    assert response.status == 400
+    assert 'error' in json.loads(data)
+    assert service.jobs.qsize() == 0
+
+
+def test_queued_is_the_first_event(make_server, tmp_path):
+    _, service = make_server()
+    input_path, _ = write_mix(tmp_path)
+    release = threading.Event()
+    service.run_job = lambda job, *args: release.wait(60)
+
+    try:
+        jobs = [Job(dict(input_path=input_path)) for _ in range(3)]
+        for job in jobs:
+            assert service.submit(job)
+        first_events = [job.events.get(timeout=60) for job in jobs]
+        assert [event['event'] for event in first_events] == ['queued'] * 3
+        assert all(event['position'] >= 1 for event in first_events)
+    finally:
+        release.set()
+
+
+def test_rejects_other_content_types(make_server, tmp_path):
+    server, _ = make_server()
+    input_path, _ = write_mix(tmp_path)
+
+    # a cross-origin form or fetch can send text/plain without a preflight
+    response, _ = post(server, dict(input_path=input_path), content_type='text/plain')
+    assert response.status == 415
+    assert not (tmp_path / 'out').exists()